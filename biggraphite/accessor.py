@@ -24,9 +24,12 @@ import enum
 import itertools
 import json
 import math
+import operator
 import re
 import threading
 
+from biggraphite import sketches
+
 
 class Error(Exception):
     """Base class for all exceptions from this module."""
@@ -81,12 +84,23 @@ class Aggregator(enum.Enum):
     total = "sum"
     average = "avg"
     last = "last"
+    # Percentiles are approximated with a sketches.QuantileSketch per downsampled point.
+    percentile_50 = "p50"
+    percentile_90 = "p90"
+    percentile_99 = "p99"
 
     def __init__(self, carbon_name):
         """Set attributes."""
         self.carbon_name = carbon_name
-        self._downsample = getattr(self, "_downsample_" + self.name)
-        self._merge = getattr(self, "_merge_" + self.name)
+        if self.name.startswith("percentile_"):
+            # The fraction of values below the percentile, used with sketches.
+            self.quantile = int(carbon_name[1:]) / 100.0
+            implementation = "percentile"
+        else:
+            self.quantile = None
+            implementation = self.name
+        self._downsample = getattr(self, "_downsample_" + implementation)
+        self._merge = getattr(self, "_merge_" + implementation)
 
     def merge(self, old, old_weight, fresh):
         """Merge fresh values from a finer grained Stage in a coarser Stage.
@@ -124,6 +138,11 @@ class Aggregator(enum.Enum):
     def _merge_total(self, old, old_weight, fresh):
         return old + fresh
 
+    def _merge_percentile(self, old, old_weight, fresh):
+        # Percentiles cannot be merged without the underlying values, this is only a rough
+        # approximation for when sketches are not available.
+        return self._merge_average(old, old_weight, fresh)
+
     def downsample(self, values=[], counts=[], newest_first=False):
         """Aggregate together values of a given stage.
 
@@ -167,6 +186,27 @@ class Aggregator(enum.Enum):
         total, _ = self.__sum_and_count(values, counts)
         return total
 
+    def _downsample_percentile(self, values, counts, values_newest_first):
+        values = sorted(v for v in values if not math.isnan(v))
+        if not values:
+            return _NAN
+        return values[int(self.quantile * (len(values) - 1))]
+
+    def merge_sketches(self, serialized_sketches):
+        """Compute a percentile from the sketches of several points of a stage.
+
+        Args:
+          serialized_sketches: iterable of sketches.QuantileSketch serialized by to_bytes().
+
+        Returns:
+          The percentile as a float, NaN if there are no values.
+        """
+        assert self.quantile is not None, "%s is not a percentile" % self.name
+        merged = sketches.QuantileSketch()
+        for serialized_sketch in serialized_sketches:
+            merged.merge(sketches.QuantileSketch.from_bytes(serialized_sketch))
+        return merged.quantile(self.quantile)
+
     @classmethod
     def from_carbon_name(cls, name):
         """Make an instance from a carbon-like name."""
@@ -220,6 +260,19 @@ class Aggregator(enum.Enum):
         return minimum, maximum
 
 
+# Aggregators that downsampled points can store besides their value (see the
+# all_aggregates option of drivers), with the index of their column in the rows given to
+# PointGrouper. Averages are computed from totals.
+_TOTAL_ROW_INDEX = 7
+_AGGREGATOR_TO_ROW_INDEX = {
+    Aggregator.minimum: 5,
+    Aggregator.maximum: 6,
+    Aggregator.total: _TOTAL_ROW_INDEX,
+    Aggregator.average: _TOTAL_ROW_INDEX,
+}
+STORED_AGGREGATORS = frozenset(_AGGREGATOR_TO_ROW_INDEX)
+
+
 class Stage(object):
     """One of the element of a retention policy.
 
@@ -479,11 +532,53 @@ class Metric(object):
         return res
 
 
+class DatapointColumns(object):
+    """Datapoints kept as a column of timestamps and a column of values.
+
+    They can be passed wherever an iterable of (timestamp, value) is expected. Writers
+    receiving points as columns save building a tuple per point, and drivers that
+    downsample read the columns directly.
+    """
+
+    __slots__ = ("timestamps", "values")
+
+    def __init__(self, timestamps, values):
+        """Record its arguments, two sequences of the same length."""
+        assert len(timestamps) == len(values), "DatapointColumns: columns length mismatch"
+        self.timestamps = timestamps
+        self.values = values
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        return self.timestamps[index], self.values[index]
+
+    def __iter__(self):
+        return itertools.izip(self.timestamps, self.values)
+
+    def __repr__(self):
+        return "DatapointColumns(%r, %r)" % (self.timestamps, self.values)
+
+    def sorted(self):
+        """Return the points sorted by increasing timestamps, self if they already are.
+
+        Points with the same timestamp are sorted by value, like sorted() sorts tuples.
+        """
+        timestamps = self.timestamps
+        if all(itertools.imap(operator.lt, timestamps, itertools.islice(timestamps, 1, None))):
+            return self
+        values = self.values
+        order = sorted(xrange(len(timestamps)), key=lambda i: (timestamps[i], values[i]))
+        return DatapointColumns([timestamps[i] for i in order], [values[i] for i in order])
+
+
 class Accessor(object):
     """Provides Read/Write accessors to BigGraphite.
 
     It is safe to fork() or start new process until connect() has been called.
-    It is not safe to share a given accessor across threads.
+    It is not safe to share a given accessor across threads, unless the driver documents
+    otherwise.
 
     Calling other methods before connect() will raise NotConnectedError, unless
     noted otherwise.
@@ -499,6 +594,10 @@ class Accessor(object):
     # reasonable limit, also consider other engines.
     MAX_METRIC_PER_GLOB = 5000
 
+    # Whether get_metric() and get_metrics() may be called concurrently from several
+    # threads once connected.
+    THREAD_SAFE_LOOKUPS = False
+
     def __init__(self, backend_name):
         """Set internal variables."""
         self.backend_name = backend_name
@@ -514,6 +613,13 @@ class Accessor(object):
         self.shutdown()
         return False
 
+    def checkpoint(self):
+        """Persist state that is only kept in memory, so that a restart does not lose it.
+
+        Does nothing for accessors without such state.
+        """
+        self._check_connected()
+
     @abc.abstractmethod
     def connect(self, skip_schema_upgrade=False):
         """Establish a connection, idempotent.
@@ -546,7 +652,7 @@ class Accessor(object):
         self._check_connected()
 
     @abc.abstractmethod
-    def fetch_points(self, metric, time_start, time_end, stage):
+    def fetch_points(self, metric, time_start, time_end, stage, aggregator=None, step=None):
         """Fetch points from time_start included to time_end excluded.
 
         Args:
@@ -556,10 +662,17 @@ class Accessor(object):
           time_end: timestamp in seconds from the Unix Epoch as an int, exclusive,
             must be a multiple of stage.precision
           stage: the retention stage at which to fetch data
+          aggregator: Aggregator to use instead of the one of the metric, it must be
+            the one of the metric or in STORED_AGGREGATORS. Downsampled points stored
+            without all aggregates fall back to the aggregator of the metric.
+          step: duration in seconds of the returned points, a multiple of
+            stage.precision, defaults to stage.precision. Points of a coarser step
+            aggregate several points of the stage, merging their sketches for
+            percentile aggregators.
 
         Yields:
           pairs of (timestamp, value) to indicate value is an aggregate for the range
-          [timestamp, timestamp+stage.precision[
+          [timestamp, timestamp+step[
 
         Raises:
           InvalidArgumentError: if time_start or time_end are not as per above
@@ -568,6 +681,10 @@ class Accessor(object):
             raise InvalidArgumentError("%s is not a Metric instance" % metric)
         if not isinstance(stage, Stage):
             raise InvalidArgumentError("%s is not a Stage instance" % stage)
+        if aggregator not in (None, metric.metadata.aggregator) and \
+                aggregator not in STORED_AGGREGATORS:
+            raise InvalidArgumentError(
+                "%s cannot be computed from stored aggregates" % aggregator)
         if time_start % stage.precision or time_start < 0:
             raise InvalidArgumentError(
                 "time_start (%d) is not a multiple of the stage's precision (%s)" % (
@@ -576,12 +693,30 @@ class Accessor(object):
             raise InvalidArgumentError(
                 "time_end (%d) is not a multiple of the stage's precision (%s)" % (
                     time_end, stage.as_string))
+        if step is not None and (step <= 0 or step % stage.precision):
+            raise InvalidArgumentError(
+                "step (%d) is not a multiple of the stage's precision (%s)" % (
+                    step, stage.as_string))
 
     @abc.abstractmethod
     def get_metric(self, metric_name):
         """Return a MetricMetadata for this metric_name, None if no such metric."""
         self._check_connected()
 
+    def get_metrics(self, metric_names):
+        """Return a Metric for each of metric_names, None for those that do not exist.
+
+        Drivers override this to look them up together rather than one after the other.
+
+        Args:
+          metric_names: A list of metric names.
+
+        Returns:
+          A list of Metric or None, in the order of metric_names.
+        """
+        self._check_connected()
+        return [self.get_metric(metric_name) for metric_name in metric_names]
+
     @abc.abstractmethod
     def glob_metric_names(self, glob):
         """Return a sorted list of metric names matching this glob."""
@@ -614,13 +749,86 @@ class Accessor(object):
         if exception_box[0]:
             raise exception_box[0]
 
+    @abc.abstractmethod
+    def iter_all_directories(self, ranges=None):
+        """Yield the names of all directories, in no particular order.
+
+        Args:
+          ranges: A list of ranges as returned by scan_ranges(), defaults to all.
+        """
+        self._check_connected()
+
+    @abc.abstractmethod
+    def iter_all_metrics(self, ranges=None):
+        """Yield all metrics as Metric instances, in no particular order.
+
+        Unlike glob_metric_names() the number of results is not bounded.
+
+        Args:
+          ranges: A list of ranges as returned by scan_ranges(), defaults to all.
+        """
+        self._check_connected()
+
+    @abc.abstractmethod
+    def scan_ranges(self, count):
+        """Split the namespace into ranges for iter_all_metrics() and iter_all_directories().
+
+        Ranges are disjoint and together they cover the whole namespace. Each range can
+        be scanned by a different thread or process, and a scan can be resumed by
+        skipping the ranges that were already done.
+
+        This does not require connect() to have been called.
+
+        Args:
+          count: The number of ranges to return, as an int greater than 0.
+
+        Returns:
+          A list of count ranges, which are opaque but can be pickled.
+        """
+        if count < 1:
+            raise InvalidArgumentError("Can not split in %s ranges" % count)
+
+    def insert_points_batch_async(self, metrics_and_datapoints, on_done=None):
+        """Insert points for several metrics.
+
+        Drivers override this to share the per-call overhead between all metrics.
+
+        Args:
+          metrics_and_datapoints: A list of (metric, datapoints), as arguments of
+            insert_points_async().
+          on_done(e: Exception): called once all points are written, with the first
+            exception or None if succesfull
+        """
+        self._check_connected()
+        if not metrics_and_datapoints:
+            if on_done:
+                on_done(None)
+            return
+
+        lock = threading.Lock()
+        remaining = [len(metrics_and_datapoints)]
+        exception_box = [None]
+
+        def on_metric_done(exception):
+            with lock:
+                remaining[0] -= 1
+                if exception and not exception_box[0]:
+                    exception_box[0] = exception
+                if remaining[0] or not on_done:
+                    return
+            on_done(exception_box[0])
+
+        for metric, datapoints in metrics_and_datapoints:
+            self.insert_points_async(metric, datapoints, on_metric_done)
+
     @abc.abstractmethod
     def insert_points_async(self, metric, datapoints, on_done=None):
         """Insert points for a given metric.
 
         Args:
           metric: The metric definition as per get_metric.
-          datapoints: An iterable of (timestamp in seconds, values as double)
+          datapoints: An iterable of (timestamp in seconds, values as double), or
+            DatapointColumns.
           on_done(e: Exception): called on done, with an exception or None if succesfull
         """
         if not isinstance(metric, Metric):
@@ -643,7 +851,8 @@ class PointGrouper(object):
     abstracted away if more datastores do client-side agregation.
     """
 
-    def __init__(self, metric, time_start_ms, time_end_ms, stage, query_results):
+    def __init__(self, metric, time_start_ms, time_end_ms, stage, query_results,
+                 aggregator=None, step_ms=None):
         """Constructor for PointGrouper.
 
         Args:
@@ -653,16 +862,30 @@ class PointGrouper(object):
           time_end_ms: timestamp in second from the Epoch as an int,
             exclusive, must be a multiple of stage.precision
           stage: the retention stage we are producing points for
-          query_results: query results to fetch values from.
+          query_results: query results to fetch values from, rows are
+            (time_start_ms, time_offset_ms, value, count) optionally followed by the
+            serialized sketch of the point for percentile aggregators, then its
+            minimum, maximum and total (None for points without them).
+          aggregator: Aggregator to use instead of the one of the metric.
+          step_ms: duration in milliseconds of the produced points, a multiple of
+            stage.precision_ms, defaults to stage.precision_ms.
         """
+        if aggregator is None or aggregator == metric.metadata.aggregator:
+            self.aggregator = metric.metadata.aggregator
+            self._row_index = None
+        else:
+            self.aggregator = aggregator
+            self._row_index = _AGGREGATOR_TO_ROW_INDEX[aggregator]
         self.metric = metric
         self.time_start_ms = time_start_ms
         self.time_end_ms = time_end_ms
         self.stage = stage
+        self.step_ms = step_ms or stage.precision_ms
         self.query_results = query_results
 
         self.current_values = array.array("d")
         self.current_counts = array.array("l")
+        self.current_sketches = []
         self.current_timestamp_ms = None
 
     def __iter__(self):
@@ -679,15 +902,21 @@ class PointGrouper(object):
         ret = (None, None)
         if self.current_timestamp_ms is None:
             return ret
-        aggregate = self.metric.metadata.aggregator.downsample(
-            values=self.current_values,
-            counts=self.current_counts,
-            newest_first=True,
-        )
+        aggregator = self.aggregator
+        if len(self.current_sketches) > 1 and None not in self.current_sketches:
+            # Unlike values, sketches can be merged without losing precision.
+            aggregate = aggregator.merge_sketches(self.current_sketches)
+        else:
+            aggregate = aggregator.downsample(
+                values=self.current_values,
+                counts=self.current_counts,
+                newest_first=True,
+            )
         if aggregate is not None:
             ret = (self.current_timestamp_ms / 1000.0, aggregate)
             del self.current_values[:]
             del self.current_counts[:]
+            del self.current_sketches[:]
         return ret
 
     def generate_values(self):
@@ -705,7 +934,7 @@ class PointGrouper(object):
                 timestamp_ms = row[0] + row[1]
                 assert timestamp_ms >= self.time_start_ms
                 assert timestamp_ms < self.time_end_ms
-                timestamp_ms = round_down(timestamp_ms, self.stage.precision_ms)
+                timestamp_ms = round_down(timestamp_ms, self.step_ms)
 
                 if self.current_timestamp_ms != timestamp_ms:
                     ts, point = self.run_aggregator()
@@ -714,7 +943,12 @@ class PointGrouper(object):
 
                     self.current_timestamp_ms = timestamp_ms
 
-                self.current_values.append(row[2])
+                if self._row_index is None:
+                    self.current_values.append(row[2])
+                    if self.aggregator.quantile is not None:
+                        self.current_sketches.append(row[4] if len(row) > 4 else None)
+                else:
+                    self.current_values.append(self._stored_aggregate(row))
                 self.current_counts.append(row[3])
 
         ts, point = self.run_aggregator()
@@ -723,3 +957,15 @@ class PointGrouper(object):
 
         if first_exc:
             raise RetryableError(first_exc)
+
+    def _stored_aggregate(self, row):
+        """Return the value of self.aggregator stored in a row."""
+        if len(row) > self._row_index and row[self._row_index] is not None:
+            return row[self._row_index]
+        # Raw points and points stored without all aggregates only have their value.
+        value, count = row[2], row[3]
+        if self._row_index == _TOTAL_ROW_INDEX and \
+                self.metric.metadata.aggregator is not Aggregator.total:
+            # Exact for averages, an approximation otherwise.
+            return value * count
+        return value
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A CLI to fill the metadata cache of a host before it serves traffic.
+
+The cache can be filled by scanning all metrics in Cassandra, or from a snapshot
+exported by a peer, which is much cheaper for Cassandra when provisioning many hosts.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from biggraphite import metadata_cache as bg_metadata_cache
+from biggraphite.drivers import cassandra as bg_cassandra
+
+
+def _parse_opts(args):
+    parser = argparse.ArgumentParser(description="Fill the BigGraphite metadata cache.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    scan = subparsers.add_parser(
+        "scan", help="fill the cache and rebuild its namespace index from all metrics in Cassandra")
+    scan.add_argument("storage_dir", metavar="STORAGE_DIR",
+                      help="Graphite storage directory, in which the cache lives")
+    scan.add_argument("contact_points", metavar="HOST", nargs="+",
+                      help="hosts used for discovery")
+    scan.add_argument("--keyspace", metavar="NAME",
+                      help="Cassandra keyspace", default="biggraphite")
+    scan.add_argument("--port", metavar="PORT", type=int,
+                      help="the native port to connect to", default=9042)
+    scan.add_argument("--connections", metavar="N", type=int,
+                      help="number of ranges of the metrics table scanned concurrently",
+                      default=16)
+
+    export = subparsers.add_parser("export", help="write the cache to a snapshot file")
+    import_ = subparsers.add_parser("import", help="add a snapshot file to the cache")
+    for subparser in export, import_:
+        subparser.add_argument("storage_dir", metavar="STORAGE_DIR",
+                               help="Graphite storage directory, in which the cache lives")
+        subparser.add_argument("snapshot", metavar="SNAPSHOT", help="path of the snapshot")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Entry point for the module."""
+    if not args:
+        args = sys.argv[1:]
+    opts = _parse_opts(args)
+
+    accessor = None
+    if opts.command == "scan":
+        accessor = bg_cassandra.connect(
+            keyspace=opts.keyspace,
+            contact_points=opts.contact_points,
+            port=opts.port,
+            concurrency=opts.connections,
+        )
+        accessor.connect()
+
+    cache = bg_metadata_cache.DiskCache(accessor, opts.storage_dir)
+    cache.open()
+    try:
+        if opts.command == "scan":
+            metrics = accessor.iter_all_metrics(accessor.scan_ranges(opts.connections))
+            count = cache.fill(metrics, complete=True)
+            print("Cached", count, "metrics", file=sys.stderr)
+        elif opts.command == "export":
+            count = cache.export_snapshot(opts.snapshot)
+            print("Exported", count, "metrics", file=sys.stderr)
+        else:
+            count = cache.import_snapshot(opts.snapshot)
+            print("Imported", count, "metrics", file=sys.stderr)
+    except bg_metadata_cache.SnapshotError as e:
+        raise SystemExit(str(e))
+    finally:
+        cache.close()
+        if accessor:
+            accessor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
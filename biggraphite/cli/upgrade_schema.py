@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A CLI to migrate existing BigGraphite tables to the layout of the current version.
+
+Accessors only create missing tables, so that processes do not all alter the same
+tables when they start. Run this once after upgrading BigGraphite or changing the
+compaction strategy of datapoints tables.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from biggraphite.drivers import cassandra as bg_cassandra
+
+
+def _parse_opts(args):
+    parser = argparse.ArgumentParser(
+        description="Migrate BigGraphite tables to the layout of this version.")
+    parser.add_argument("contact_points", metavar="HOST", nargs="+",
+                        help="hosts used for discovery")
+    parser.add_argument("--keyspace", metavar="NAME",
+                        help="Cassandra keyspace", default="biggraphite")
+    parser.add_argument("--port", metavar="PORT", type=int,
+                        help="the native port to connect to", default=9042)
+    parser.add_argument("--compaction-strategy", metavar="STRATEGY",
+                        choices=(bg_cassandra.DATE_TIERED_COMPACTION,
+                                 bg_cassandra.TIME_WINDOW_COMPACTION),
+                        help="compaction strategy of datapoints tables",
+                        default=bg_cassandra.DATE_TIERED_COMPACTION)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Entry point for the module."""
+    if not args:
+        args = sys.argv[1:]
+    opts = _parse_opts(args)
+
+    accessor = bg_cassandra.connect(
+        keyspace=opts.keyspace,
+        contact_points=opts.contact_points,
+        port=opts.port,
+        compaction_strategy=opts.compaction_strategy,
+    )
+    # Also creates or upgrades the metadata tables.
+    accessor.connect()
+    try:
+        accessor.upgrade_datapoints_tables()
+    finally:
+        accessor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
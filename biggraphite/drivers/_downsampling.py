@@ -18,109 +18,1070 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 from biggraphite import accessor as bg_accessor
+from biggraphite import sketches
 
 import array
+import cStringIO
+import itertools
+import logging
 import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
 
 _NaN = float("NaN")
 
+# A checkpoint is a header followed by one entry per metric, least recently used first.
+# Each entry is a header, the metric name, its metadata as JSON and the arrays of its
+# slot in a _Slab.
+_CHECKPOINT_MAGIC = b"BGDS"
+_CHECKPOINT_VERSION = 2
+_CHECKPOINT_HEADER = struct.Struct("<4sII")  # magic, version, number of entries
+# name len, metadata len, raw capacity, stages, flags
+_CHECKPOINT_ENTRY = struct.Struct("<IIIII")
+# Version 1 had no flags.
+_CHECKPOINT_ENTRY_V1 = struct.Struct("<IIII")
+_CHECKPOINT_FLAG_ALL_AGGREGATES = 1
+# Percentile aggregators are followed by the sketch of the open bucket of each stage.
+_CHECKPOINT_SKETCH = struct.Struct("<I")  # sketch len, 0 for none
+
+# Columns of downsampled points computed when all aggregates are stored, in the order
+# they are kept in _Slab.extras.
+_EXTRA_COLUMNS = ("minimum", "maximum", "total")
+
+# Downsampler identifies metrics by the index of their slab in Downsampler._slabs (low
+# bits) and their slot in it (high bits).
+_SLAB_BITS = 16
+_SLAB_MASK = (1 << _SLAB_BITS) - 1
+# Id of no metric, e.g. the one after the most recently used.
+_NO_ID = -1
+
+
+class CheckpointError(bg_accessor.Error):
+    """A checkpoint file could not be read."""
+
+
+def _sorted_points(datapoints):
+    """Return datapoints sorted by increasing timestamps.
+
+    Points nearly always come in order, checking it is cheaper than sorting a copy of
+    them, so lists that are already sorted are returned as is.
+
+    Args:
+      datapoints: iterable of (timestamp, value), or bg_accessor.DatapointColumns.
+
+    Returns:
+      A sequence of (timestamp, value), or bg_accessor.DatapointColumns for columns.
+    """
+    if isinstance(datapoints, bg_accessor.DatapointColumns):
+        return datapoints.sorted()
+    if not isinstance(datapoints, (list, tuple)):
+        return sorted(datapoints)
+    if len(datapoints) < 2:
+        return datapoints
+    previous = datapoints[0][0]
+    for timestamp, _ in itertools.islice(datapoints, 1, None):
+        # Points with the same timestamp are sorted by value, like sorted() would.
+        if timestamp <= previous:
+            return sorted(datapoints)
+        previous = timestamp
+    return datapoints
+
 
 class Downsampler(object):
-    """Downsampler using MetricAggregates to produce aggregates."""
+    """Downsampler keeping the aggregates of metrics in a _Slab per metric shape.
+
+    It can be bounded to a number of metrics, in which case the least recently fed
+    metrics are evicted. Metrics can also be evicted once they have not been fed for
+    some time, see flush_idle(). The partial aggregates of evicted metrics are flushed
+    to on_evict so that they can be written before being dropped.
+
+    The state of evicted metrics (raw buffer and open buckets) is stashed in their slab
+    for a while, as it was before their points were flushed. Should the metric be fed
+    again, it is restored, so that the points written from then on are the ones that
+    would have been written without eviction.
+    """
 
     CAPACITY = 20
 
     slots = (
+        "_all_aggregates",
         "_capacity",
-        "_names_to_aggregates"
+        "_lru_first",
+        "_lru_last",
+        "_max_metrics",
+        "_names_to_ids",
+        "_on_evict",
+        "_open_buckets_interval",
+        "_shapes",
+        "_slabs",
     )
 
-    def __init__(self, capacity=CAPACITY):
-        """Default constructor."""
+    def __init__(self, capacity=CAPACITY, max_metrics=None, on_evict=None,
+                 open_buckets_interval=0, all_aggregates=False):
+        """Default constructor.
+
+        Args:
+          capacity: number of slots in the raw buffer of each metric.
+          max_metrics: maximum number of metrics to keep aggregates for, None for no limit.
+          on_evict(metric, points): called for each evicted metric with points as returned
+            by feed(), it will usually write them.
+          open_buckets_interval: minimum number of seconds between two times feed()
+            returns the points of buckets that are still open for a given metric. With
+            None, it only returns points of closed buckets, which saves rewriting the
+            same coarse points over and over at the cost of fresh data. Points of stage
+            0 are returned as soon as they leave the raw buffer either way.
+          all_aggregates: if True, points of downsampled stages also carry the minimum,
+            maximum and total of their values, whatever the aggregator of the metric.
+        """
+        self._all_aggregates = all_aggregates
         self._capacity = capacity
-        self._names_to_aggregates = {}
+        self._max_metrics = max_metrics
+        self._open_buckets_interval = open_buckets_interval
+        # Associates names to metric ids, see _metric_id().
+        self._names_to_ids = {}
+        # Ids of the least and most recently fed metrics, the others are linked in
+        # between by the lru_prev and lru_next of their slots.
+        self._lru_first = _NO_ID
+        self._lru_last = _NO_ID
+        self._on_evict = on_evict
+        # The _Slab of each shape, and the index in _slabs of each shape: (number of
+        # stages, raw capacity, all aggregates).
+        self._slabs = []
+        self._shapes = {}
+
+    def __len__(self):
+        """Return the number of metrics aggregates are kept for."""
+        return len(self._names_to_ids)
 
     def feed(self, metric, datapoints):
         """Feed the downsampler and produce points.
 
         Arg:
           metric: Metric
-          datapoints: iterable of (timestamp, value)
+          datapoints: iterable of (timestamp, value), or bg_accessor.DatapointColumns
         Returns:
           Iterable of (timestamp, value, count, precision).
         """
-        # Ensure we have the required aggregation mechanism.
-        if metric.name not in self._names_to_aggregates:
-            metric_aggregates = MetricAggregates(metric.metadata, self._capacity)
-            self._names_to_aggregates[metric.name] = metric_aggregates
+        return self._feed(metric, datapoints, time.time())
+
+    def feed_batch(self, metrics_and_datapoints):
+        """Feed the downsampler with points of several metrics, cheaper than feed().
+
+        Args:
+          metrics_and_datapoints: iterable of (Metric, iterable of (timestamp, value)).
+
+        Returns:
+          The list of (Metric, points) of metrics for which feed() would have produced
+          points.
+        """
+        now = time.time()
+        produced = []
+        for metric, datapoints in metrics_and_datapoints:
+            points = self._feed(metric, datapoints, now)
+            if points:
+                produced.append((metric, points))
+        return produced
 
+    def _feed(self, metric, datapoints, now):
+        """Same as feed(), with the current time."""
         # Sort points by increasing timestamp, because put expects them in order.
-        return self._names_to_aggregates[metric.name].update(metric.metadata, sorted(datapoints))
+        datapoints = _sorted_points(datapoints)
+        metric_id = self._names_to_ids.get(metric.name)
+        if metric_id is not None:
+            slab = self._slabs[metric_id & _SLAB_MASK]
+            slot = metric_id >> _SLAB_BITS
+            known = slab.metrics[slot]
+            if known is not metric and known.metadata is not metric.metadata and \
+                    known.retention != metric.retention:
+                # Aggregates were computed for another retention (e.g. loaded from a
+                # checkpoint), write them for what they are and start over.
+                self._evict_id(metric_id, stash=False)
+                metric_id = None
+            elif metric_id != self._lru_last:
+                self._lru_move_last(metric_id, slab, slot)
+        if metric_id is None:
+            if self._max_metrics is not None:
+                self._evict(self._max_metrics - 1)
+            metric_id = self._add(metric, self._capacity, self._all_aggregates)
+            self._lru_link(metric_id)
+            slab = self._slabs[metric_id & _SLAB_MASK]
+            slot = metric_id >> _SLAB_BITS
+            slab.unstash(slot, _stash_key(metric))
+
+        slab.metrics[slot] = metric
+        slab.fed_at[slot] = now
+        interval = self._open_buckets_interval
+        if interval is None:
+            open_buckets = False
+        elif not interval:
+            open_buckets = True
+        else:
+            open_buckets = now - slab.open_buckets_at[slot] >= interval
+            if open_buckets:
+                slab.open_buckets_at[slot] = now
+        return slab.update(slot, metric.metadata, datapoints, open_buckets)
+
+    def _slab_index(self, stages, raw_capacity, all_aggregates):
+        """Return the index in _slabs of the slab of a shape, creating it if needed."""
+        shape = (stages, raw_capacity, all_aggregates)
+        index = self._shapes.get(shape)
+        if index is None:
+            index = self._shapes[shape] = len(self._slabs)
+            assert index <= _SLAB_MASK, "Too many metric shapes"
+            self._slabs.append(_Slab(*shape))
+        return index
+
+    def _add(self, metric, raw_capacity, all_aggregates):
+        """Start keeping aggregates for a metric, it is not linked to the LRU list yet.
+
+        Returns:
+          The id of the metric.
+        """
+        metric_id = self._allocate(metric, raw_capacity, all_aggregates)
+        self._names_to_ids[metric.name] = metric_id
+        return metric_id
+
+    def _allocate(self, metric, raw_capacity, all_aggregates):
+        """Return the id of a new slot for a metric in the slab of its shape."""
+        index = self._slab_index(
+            len(metric.metadata.retention.stages), raw_capacity, all_aggregates)
+        return _metric_id(index, self._slabs[index].allocate(metric))
+
+    def _release(self, metric_id):
+        """Give the slot of a metric that is not in the LRU list back to its slab."""
+        self._slabs[metric_id & _SLAB_MASK].release(metric_id >> _SLAB_BITS)
+
+    def _lru_link(self, metric_id, before=_NO_ID):
+        """Insert a metric in the LRU list before another one, as the last one by default."""
+        slab = self._slabs[metric_id & _SLAB_MASK]
+        slot = metric_id >> _SLAB_BITS
+        if before == _NO_ID:
+            prev = self._lru_last
+            self._lru_last = metric_id
+        else:
+            before_slab = self._slabs[before & _SLAB_MASK]
+            before_slot = before >> _SLAB_BITS
+            prev = before_slab.lru_prev[before_slot]
+            before_slab.lru_prev[before_slot] = metric_id
+        if prev == _NO_ID:
+            self._lru_first = metric_id
+        else:
+            self._slabs[prev & _SLAB_MASK].lru_next[prev >> _SLAB_BITS] = metric_id
+        slab.lru_prev[slot] = prev
+        slab.lru_next[slot] = before
+
+    def _lru_move_last(self, metric_id, slab, slot):
+        """Move a metric that is not the last one of the LRU list to its end.
+
+        Same as _lru_unlink() then _lru_link(), for the slab and slot of the metric.
+        """
+        slabs = self._slabs
+        prev = slab.lru_prev[slot]
+        next_ = slab.lru_next[slot]
+        if prev == _NO_ID:
+            self._lru_first = next_
+        else:
+            slabs[prev & _SLAB_MASK].lru_next[prev >> _SLAB_BITS] = next_
+        slabs[next_ & _SLAB_MASK].lru_prev[next_ >> _SLAB_BITS] = prev
+        last = self._lru_last
+        slabs[last & _SLAB_MASK].lru_next[last >> _SLAB_BITS] = metric_id
+        slab.lru_prev[slot] = last
+        slab.lru_next[slot] = _NO_ID
+        self._lru_last = metric_id
+
+    def _lru_unlink(self, metric_id):
+        """Remove a metric from the LRU list."""
+        slab = self._slabs[metric_id & _SLAB_MASK]
+        slot = metric_id >> _SLAB_BITS
+        prev = slab.lru_prev[slot]
+        next_ = slab.lru_next[slot]
+        if prev == _NO_ID:
+            self._lru_first = next_
+        else:
+            self._slabs[prev & _SLAB_MASK].lru_next[prev >> _SLAB_BITS] = next_
+        if next_ == _NO_ID:
+            self._lru_last = prev
+        else:
+            self._slabs[next_ & _SLAB_MASK].lru_prev[next_ >> _SLAB_BITS] = prev
+
+    def _iter_lru(self):
+        """Yield the (_Slab, slot) of metrics, least recently used first."""
+        metric_id = self._lru_first
+        while metric_id != _NO_ID:
+            slab = self._slabs[metric_id & _SLAB_MASK]
+            slot = metric_id >> _SLAB_BITS
+            yield slab, slot
+            metric_id = slab.lru_next[slot]
+
+    def flush(self):
+        """Evict all metrics, passing their partial aggregates to on_evict."""
+        self._evict(0)
+
+    def flush_idle(self, max_idle, now=None):
+        """Evict metrics not fed for max_idle seconds, passing their aggregates to on_evict.
+
+        Args:
+          max_idle: number of seconds after which a metric is considered idle.
+          now: current time, time.time() if None.
+        """
+        fed_before = (now or time.time()) - max_idle
+        # The least recently fed metric comes first.
+        while self._lru_first != _NO_ID:
+            metric_id = self._lru_first
+            slab = self._slabs[metric_id & _SLAB_MASK]
+            if slab.fed_at[metric_id >> _SLAB_BITS] >= fed_before:
+                break
+            self._evict_id(metric_id)
+
+    def save(self, path):
+        """Checkpoint the state of all metrics to a file.
+
+        The file is written next to path then renamed, so that a crash never leaves a
+        partially written checkpoint behind. Concurrent saves to the same path do not
+        mix their files, the last one renamed wins.
+
+        Args:
+          path: path of the checkpoint file.
+        """
+        _write_checkpoint(path, [self._dump()])
+
+    def _dump(self):
+        """Serialize the checkpoint entries of all metrics.
+
+        Returns:
+          A tuple of the number of entries and the entries as a string.
+        """
+        f = cStringIO.StringIO()
+        count = 0
+        for slab, slot in self._iter_lru():
+            metric = slab.metrics[slot]
+            name = metric.name  # Already encoded as utf-8.
+            metadata = metric.metadata.as_json().encode("utf-8")
+            flags = 0
+            if slab.all_aggregates:
+                flags |= _CHECKPOINT_FLAG_ALL_AGGREGATES
+            f.write(_CHECKPOINT_ENTRY.pack(
+                len(name), len(metadata), slab.raw_capacity, slab.stages, flags))
+            f.write(name)
+            f.write(metadata)
+            slab.dump(slot, f)
+            count += 1
+        return count, f.getvalue()
+
+    def load(self, path):
+        """Restore the state of metrics from a checkpoint written by save().
+
+        Metrics already known to this instance are kept, a missing file is ignored.
+        Loaded metrics keep computing all aggregates or not, as they did when saved.
+
+        Args:
+          path: path of the checkpoint file.
+
+        Raises:
+          CheckpointError: if the file is not a valid checkpoint.
+        """
+        buf = _map_checkpoint(path)
+        if buf is None:
+            return
+        try:
+            self._load_entries(path, buf, _parse_checkpoint(path, buf))
+        finally:
+            buf.close()
+
+    def _load_entries(self, path, buf, entries):
+        """Restore the state of metrics from entries of a checkpoint.
+
+        Args:
+          path: path of the checkpoint file.
+          buf: content of the checkpoint file.
+          entries: entries of the checkpoint as returned by _parse_checkpoint().
+
+        Raises:
+          CheckpointError: if the state of a metric is invalid.
+        """
+        metric_ids = []
+        try:
+            for metric, raw_capacity, all_aggregates, offset in entries:
+                if metric.name in self._names_to_ids:
+                    continue
+                metric_id = self._allocate(metric, raw_capacity, all_aggregates)
+                metric_ids.append(metric_id)
+                self._slabs[metric_id & _SLAB_MASK].load(metric_id >> _SLAB_BITS, buf, offset)
+        except Exception as e:
+            for metric_id in metric_ids:
+                self._release(metric_id)
+            if isinstance(e, CheckpointError):
+                raise
+            raise CheckpointError("%s: invalid checkpoint (%s)" % (path, e))
+
+        # Loaded metrics are less recently used than the ones already known.
+        first = self._lru_first
+        now = time.time()
+        for metric_id in metric_ids:
+            slab = self._slabs[metric_id & _SLAB_MASK]
+            slot = metric_id >> _SLAB_BITS
+            name = slab.metrics[slot].name
+            if name in self._names_to_ids:
+                slab.release(slot)
+                continue
+            self._names_to_ids[name] = metric_id
+            self._lru_link(metric_id, before=first)
+            # Considered fed when loaded, so that they are not idle right away.
+            slab.fed_at[slot] = now
+        if self._max_metrics is not None:
+            self._evict(self._max_metrics)
+
+    def _evict(self, max_count):
+        """Evict least recently used metrics until there are at most max_count left."""
+        while len(self._names_to_ids) > max_count:
+            self._evict_id(self._lru_first)
+
+    def _evict_id(self, metric_id, stash=True):
+        """Evict a metric, stashing the open buckets of its downsampled stages if asked."""
+        self._lru_unlink(metric_id)
+        slab = self._slabs[metric_id & _SLAB_MASK]
+        slot = metric_id >> _SLAB_BITS
+        metric = slab.metrics[slot]
+        del self._names_to_ids[metric.name]
+        if stash:
+            slab.stash(slot, _stash_key(metric))
+        points = slab.flush(slot, metric.metadata)
+        slab.release(slot)
+        if points and self._on_evict:
+            self._on_evict(metric, points)
+
+
+def _metric_id(slab_index, slot):
+    """Return the id of the metric in a slot of the slab at slab_index in a Downsampler."""
+    return slot << _SLAB_BITS | slab_index
+
+
+def _stash_key(metric):
+    """Return the key of a metric in the stash of its slab, see _Slab.stash()."""
+    # State kept for another retention or aggregator must not be restored.
+    metadata = metric.metadata
+    return hash((metric.name, metadata.retention, metadata.aggregator))
+
+
+def _copy_sketch(sketch):
+    """Return a copy of a sketches.QuantileSketch, or None."""
+    if sketch is None:
+        return None
+    copy = sketches.QuantileSketch()
+    copy.merge(sketch)
+    return copy
+
+
+def _write_checkpoint(path, dumps):
+    """Write a checkpoint file made of the entries dumped by Downsampler._dump().
+
+    Args:
+      path: path of the checkpoint file, it is written to a unique temporary file in the
+        same directory and renamed.
+      dumps: iterable of tuples returned by Downsampler._dump(), consumed as the file is
+        written.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            # The number of entries is only known at the end.
+            f.write(_CHECKPOINT_HEADER.pack(_CHECKPOINT_MAGIC, _CHECKPOINT_VERSION, 0))
+            count = 0
+            for dump_count, entries in dumps:
+                f.write(entries)
+                count += dump_count
+            f.seek(0)
+            f.write(_CHECKPOINT_HEADER.pack(_CHECKPOINT_MAGIC, _CHECKPOINT_VERSION, count))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
 
+def _map_checkpoint(path):
+    """Return the content of a checkpoint file as a read-only mmap, None if it is missing.
 
-class MetricAggregates(object):
-    """Perform aggregation on metric data points."""
+    Raises:
+      CheckpointError: if the file is empty.
+    """
+    try:
+        f = open(path, "rb")
+    except IOError:
+        if os.path.exists(path):
+            raise
+        return None
+    with f:
+        if not os.fstat(f.fileno()).st_size:
+            raise CheckpointError("%s: empty checkpoint" % path)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    DEFAULT_RAW_CAPACITY = 10
+
+def _parse_checkpoint(path, buf):
+    """Return the entries of a checkpoint, without reading the state of their slots.
+
+    Args:
+      path: path of the checkpoint file.
+      buf: content of the checkpoint file.
+
+    Returns:
+      A list of (Metric, raw capacity, all aggregates, offset in buf of the state of its
+      slot), in the order they were saved.
+
+    Raises:
+      CheckpointError: if the file is not a valid checkpoint.
+    """
+    try:
+        magic, version, count = _CHECKPOINT_HEADER.unpack_from(buf, 0)
+        if magic != _CHECKPOINT_MAGIC or version not in (1, _CHECKPOINT_VERSION):
+            raise CheckpointError("%s: unsupported checkpoint format" % path)
+        offset = _CHECKPOINT_HEADER.size
+        entries = []
+        for _ in xrange(count):
+            if version == 1:
+                name_len, metadata_len, raw_capacity, stages = \
+                    _CHECKPOINT_ENTRY_V1.unpack_from(buf, offset)
+                flags = 0
+                offset += _CHECKPOINT_ENTRY_V1.size
+            else:
+                name_len, metadata_len, raw_capacity, stages, flags = \
+                    _CHECKPOINT_ENTRY.unpack_from(buf, offset)
+                offset += _CHECKPOINT_ENTRY.size
+            all_aggregates = bool(flags & _CHECKPOINT_FLAG_ALL_AGGREGATES)
+            name = buf[offset:offset + name_len]
+            offset += name_len
+            metadata = bg_accessor.MetricMetadata.from_json(
+                buf[offset:offset + metadata_len].decode("utf-8"))
+            offset += metadata_len
+            if stages != len(metadata.retention.stages):
+                raise CheckpointError("%s: %s: inconsistent number of stages" % (path, name))
+            entries.append(
+                (bg_accessor.Metric(name, metadata), raw_capacity, all_aggregates, offset))
+            offset = _Slab.skip(buf, offset, metadata, raw_capacity, all_aggregates)
+    except Exception as e:
+        if isinstance(e, CheckpointError):
+            raise
+        raise CheckpointError("%s: invalid checkpoint (%s)" % (path, e))
+    return entries
+
+
+class ShardedDownsampler(object):
+    """Thread-safe Downsampler.
+
+    Metrics are spread by name over several Downsampler, each one with its own lock, so
+    that threads feeding different metrics seldom wait for each other. Locks are released
+    before evicted metrics are passed to on_evict, which usually writes them.
+    """
+
+    DEFAULT_SHARDS = 16
 
     __slots__ = (
-        "_raw_capacity",   # TODO: remove (use stage in methods)
-        "_timestamps",
-        "_values",
-        "_counts",
+        "_evicted",
+        "_locks",
+        "_on_evict",
+        "_shards",
     )
 
-    def __init__(self, metric_metadata, raw_capacity=DEFAULT_RAW_CAPACITY):
-        """"Initialize a MetricAggregates object.
+    def __init__(self, shards=DEFAULT_SHARDS, capacity=Downsampler.CAPACITY,
+                 max_metrics=None, on_evict=None, open_buckets_interval=0,
+                 all_aggregates=False):
+        """Default constructor.
 
         Args:
-          metric_metadata: MetricMetadata object.
-          precision: precision of the raw buffer in seconds.
-          capacity: number of slots in the raw buffer.
+          shards: number of Downsampler to spread metrics over.
+          capacity: see Downsampler.
+          max_metrics: see Downsampler, the limit is split evenly between shards.
+          on_evict(metric, points): see Downsampler, it may be called from any thread
+            feeding the downsampler, without holding any lock.
+          open_buckets_interval: see Downsampler.
+          all_aggregates: see Downsampler.
         """
-        stages = len(metric_metadata.retention.stages)
+        if max_metrics is not None:
+            max_metrics = bg_accessor.round_up(max_metrics, shards) // shards
+        self._locks = [threading.Lock() for _ in xrange(shards)]
+        self._on_evict = on_evict
+        # The (metric, points) evicted by each shard, see _pop_evicted().
+        self._evicted = [[] for _ in xrange(shards)]
+        self._shards = [
+            Downsampler(capacity, max_metrics=max_metrics,
+                        on_evict=self._evicted_appender(evicted) if on_evict else None,
+                        open_buckets_interval=open_buckets_interval,
+                        all_aggregates=all_aggregates)
+            for evicted in self._evicted
+        ]
+
+    @staticmethod
+    def _evicted_appender(evicted):
+        """Return an on_evict for a shard, appending evicted metrics to a list."""
+        def on_evict(metric, points):
+            evicted.append((metric, points))
+        return on_evict
 
-        # _raw_capacity: length of the raw buffer
-        self._raw_capacity = raw_capacity
+    def _shard_index(self, metric_name):
+        return hash(metric_name) % len(self._shards)
 
-        # _timestamps: array of integers:
-        #   - raw timestamp at index 0
-        #   - stage timestamp from index 1
-        # TODO: make sure that each stage timestamp is equal to:
-        # (raw_timestamp - (raw_capacity - 1) * raw_precision) % stage_precision
-        self._timestamps = array.array("i", [-1] * (1 + stages))
+    def _pop_evicted(self, index):
+        """Return and forget the metrics evicted by a shard, whose lock must be held."""
+        evicted = self._evicted[index]
+        if not evicted:
+            return ()
+        popped = list(evicted)
+        del evicted[:]
+        return popped
 
-        # _values: array of doubles:
-        #   - raw buffer values from index 0 with length raw_capacity
-        #   - stage values from index raw_capacity
-        self._values = array.array("d", [_NaN] * (raw_capacity + stages))
+    def _call_on_evict(self, evicted):
+        """Pass metrics returned by _pop_evicted() to on_evict, without holding locks."""
+        for metric, points in evicted:
+            self._on_evict(metric, points)
 
-        # _counts: array of integer: stage counts from index 0
-        self._counts = array.array("i", [0] * stages)
+    def feed(self, metric, datapoints):
+        """Feed the downsampler and produce points, as Downsampler does."""
+        index = self._shard_index(metric.name)
+        with self._locks[index]:
+            points = self._shards[index].feed(metric, datapoints)
+            evicted = self._pop_evicted(index)
+        self._call_on_evict(evicted)
+        return points
+
+    def feed_batch(self, metrics_and_datapoints):
+        """Feed the downsampler with points of several metrics, as Downsampler does.
+
+        Metrics are grouped by shard, so that each lock is only taken once.
+        """
+        by_shard = [[] for _ in self._shards]
+        for metric_and_datapoints in metrics_and_datapoints:
+            by_shard[self._shard_index(metric_and_datapoints[0].name)].append(
+                metric_and_datapoints)
+        produced = []
+        for index, shard_metrics_and_datapoints in enumerate(by_shard):
+            if not shard_metrics_and_datapoints:
+                continue
+            with self._locks[index]:
+                produced.extend(self._shards[index].feed_batch(shard_metrics_and_datapoints))
+                evicted = self._pop_evicted(index)
+            self._call_on_evict(evicted)
+        return produced
+
+    def flush(self):
+        """Evict all metrics, as Downsampler does."""
+        for index, shard in enumerate(self._shards):
+            with self._locks[index]:
+                shard.flush()
+                evicted = self._pop_evicted(index)
+            self._call_on_evict(evicted)
+
+    def flush_idle(self, max_idle, now=None):
+        """Evict metrics not fed for max_idle seconds, as Downsampler does."""
+        for index, shard in enumerate(self._shards):
+            with self._locks[index]:
+                shard.flush_idle(max_idle, now)
+                evicted = self._pop_evicted(index)
+            self._call_on_evict(evicted)
 
-    def _update_raw(self, datapoints, precision):
-        """"Put raw data points in raw buffer and pop expired raw data points.
+    def save(self, path):
+        """Checkpoint the state of all metrics to a file, as Downsampler does.
+
+        Shards are serialized one after the other, each one only being locked while it is
+        copied to memory. Files are written without holding any lock.
+        """
+        _write_checkpoint(path, (self._dump_shard(index) for index in xrange(len(self._shards))))
+
+    def _dump_shard(self, index):
+        with self._locks[index]:
+            return self._shards[index]._dump()
+
+    def load(self, path):
+        """Restore the state of metrics from a checkpoint, as Downsampler does.
+
+        The file is parsed once, then each shard is only locked while its metrics are
+        loaded.
+        """
+        buf = _map_checkpoint(path)
+        if buf is None:
+            return
+        try:
+            by_shard = [[] for _ in self._shards]
+            for entry in _parse_checkpoint(path, buf):
+                by_shard[self._shard_index(entry[0].name)].append(entry)
+            for index, entries in enumerate(by_shard):
+                with self._locks[index]:
+                    self._shards[index]._load_entries(path, buf, entries)
+                    evicted = self._pop_evicted(index)
+                self._call_on_evict(evicted)
+        finally:
+            buf.close()
+
+
+class IdleFlusher(threading.Thread):
+    """Thread periodically evicting idle metrics of a ShardedDownsampler.
+
+    Points of metrics that stop being fed are otherwise kept in memory until the
+    downsampler is flushed.
+    """
+
+    def __init__(self, downsampler, max_idle, interval=None):
+        """Create a stopped flusher, call start() to start it.
 
         Args:
+          downsampler: ShardedDownsampler to flush.
+          max_idle: number of seconds after which a metric is considered idle.
+          interval: number of seconds between flushes, a fraction of max_idle if None.
+        """
+        super(IdleFlusher, self).__init__(name="IdleFlusher")
+        self.daemon = True
+        self._downsampler = downsampler
+        self._max_idle = max_idle
+        self._interval = interval or max_idle / 4.0
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Flush idle metrics until stop() is called."""
+        while not self._stopped.wait(self._interval):
+            try:
+                self._downsampler.flush_idle(self._max_idle)
+            except Exception:
+                logging.exception("Failed to flush idle metrics")
+
+    def stop(self):
+        """Stop the thread and wait for it to terminate."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+class _Slab(object):
+    """Downsampling aggregates of all metrics with the same shape.
+
+    Fields of all metrics are stored back to back in a few arrays (a structure of arrays),
+    each metric being given a slot. This costs a few bytes per metric instead of several
+    Python objects. Slots also hold what Downsampler keeps about their metric.
+
+    Metrics with a percentile aggregator also keep a sketches.QuantileSketch of the open
+    bucket of each stage, which is returned with the points of the stage. Likewise, the
+    minimum, maximum and total of stages are kept and returned if the slab has extras.
+    """
+
+    __slots__ = (
+        "raw_capacity",
+        "stages",
+        "timestamps",
+        "values",
+        "counts",
+        "extras",
+        "sketches",
+        "metrics",
+        "fed_at",
+        "open_buckets_at",
+        "lru_prev",
+        "lru_next",
+        "_empty_timestamps",
+        "_empty_values",
+        "_empty_counts",
+        "_empty_extras",
+        "_free_slots",
+        "_stash_keys",
+        "_stash_timestamps",
+        "_stash_values",
+        "_stash_counts",
+        "_stash_extras",
+        "_stash_sketches",
+    )
+
+    # Minimum number of rows of the stash.
+    _MIN_STASH_ROWS = 64
+    # Sizes of the items of timestamps and counts, and of values and extras.
+    _INT_SIZE = array.array("i").itemsize
+    _DOUBLE_SIZE = array.array("d").itemsize
+
+    def __init__(self, stages, raw_capacity, all_aggregates=False):
+        """Create an empty slab.
+
+        Args:
+          stages: number of stages of metrics.
+          raw_capacity: number of slots in the raw buffer of metrics.
+          all_aggregates: whether metrics also keep the _EXTRA_COLUMNS of their stages.
+        """
+        self.raw_capacity = raw_capacity
+        self.stages = stages
+        # timestamps: per slot, raw timestamp then stage timestamps.
+        self.timestamps = array.array("i")
+        # values: per slot, raw buffer values then stage values.
+        self.values = array.array("d")
+        # counts: per slot, stage counts.
+        self.counts = array.array("i")
+        # extras: per slot, the _EXTRA_COLUMNS of each stage, None if not kept.
+        if all_aggregates:
+            self.extras = array.array("d")
+            self._empty_extras = array.array("d", [_NaN] * (len(_EXTRA_COLUMNS) * stages))
+        else:
+            self.extras = None
+            self._empty_extras = None
+        # sketches: per slot, None or the sketch of the open bucket of each stage (None
+        # until it has points) for percentile aggregators.
+        self.sketches = []
+        # Per slot, for Downsampler: the Metric, the last times it was fed and its open
+        # buckets were returned, and the ids of the metrics fed right before and after it.
+        self.metrics = []
+        self.fed_at = array.array("d")
+        self.open_buckets_at = array.array("d")
+        self.lru_prev = array.array("l")
+        self.lru_next = array.array("l")
+        self._empty_timestamps = array.array("i", [-1] * (1 + stages))
+        self._empty_values = array.array("d", [_NaN] * (raw_capacity + stages))
+        self._empty_counts = array.array("i", [0] * stages)
+        self._free_slots = []
+        # Per row, the key and the fields of the slot of an evicted metric, see stash().
+        # Rows are only allocated once metrics are evicted.
+        self._stash_keys = array.array("l")
+        self._stash_timestamps = array.array("i")
+        self._stash_values = array.array("d")
+        self._stash_counts = array.array("i")
+        self._stash_extras = None if self.extras is None else array.array("d")
+        self._stash_sketches = []
+
+    def __len__(self):
+        """Return the number of slots in use."""
+        return len(self.counts) // self.stages - len(self._free_slots)
+
+    @property
+    def all_aggregates(self):
+        """Whether the _EXTRA_COLUMNS of stages are computed."""
+        return self.extras is not None
+
+    def allocate(self, metric):
+        """Return a new empty slot for a metric of the shape of the slab."""
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            slot = len(self.counts) // self.stages
+            self.timestamps.extend(self._empty_timestamps)
+            self.values.extend(self._empty_values)
+            self.counts.extend(self._empty_counts)
+            if self.extras is not None:
+                self.extras.extend(self._empty_extras)
+            self.sketches.append(None)
+            self.metrics.append(None)
+            self.fed_at.append(0)
+            self.open_buckets_at.append(0)
+            self.lru_prev.append(_NO_ID)
+            self.lru_next.append(_NO_ID)
+        self.metrics[slot] = metric
+        if metric.metadata.aggregator.quantile is not None:
+            self.sketches[slot] = [None] * self.stages
+        return slot
+
+    def release(self, slot):
+        """Reset a slot and make it available to allocate()."""
+        t, v, c, e = self.offsets(slot)
+        self.timestamps[t:t + 1 + self.stages] = self._empty_timestamps
+        self.values[v:v + self.raw_capacity + self.stages] = self._empty_values
+        self.counts[c:c + self.stages] = self._empty_counts
+        if self.extras is not None:
+            self.extras[e:e + len(self._empty_extras)] = self._empty_extras
+        self.sketches[slot] = None
+        self.metrics[slot] = None
+        self.fed_at[slot] = 0
+        self.open_buckets_at[slot] = 0
+        self._free_slots.append(slot)
+
+    def offsets(self, slot):
+        """Return the offsets of a slot in timestamps, values, counts and extras."""
+        return (
+            slot * (1 + self.stages),
+            slot * (self.raw_capacity + self.stages),
+            slot * self.stages,
+            slot * len(_EXTRA_COLUMNS) * self.stages,
+        )
+
+    def _resize_stash(self, rows):
+        """Resize the stash to a power of two of rows, dropping what it holds."""
+        stages = self.stages
+        self._stash_keys = array.array("l", [0] * rows)
+        self._stash_timestamps = array.array("i", [-1] * (rows * (1 + stages)))
+        self._stash_values = array.array("d", [_NaN] * (rows * (self.raw_capacity + stages)))
+        self._stash_counts = array.array("i", [0] * (rows * stages))
+        if self._stash_extras is not None:
+            self._stash_extras = array.array(
+                "d", [_NaN] * (rows * stages * len(_EXTRA_COLUMNS)))
+        self._stash_sketches = [None] * rows
+
+    def stash(self, slot, key):
+        """Keep the state of the slot of a metric being evicted, before it is flushed.
+
+        It is restored by unstash(). The stash has a row per slot or so, and a key only
+        has one possible row. States are thus kept until another key with the same row is
+        stashed. The partial points of the metric are written when it is evicted either
+        way, so a lost state only means that they get overwritten by points computed
+        from the points fed after eviction.
+
+        Args:
+          slot: slot of the metric, before it is flushed.
+          key: see _stash_key().
+        """
+        rows = len(self._stash_keys)
+        if rows * self.stages < len(self.counts):
+            rows = max(2 * rows, self._MIN_STASH_ROWS)
+            while rows * self.stages < len(self.counts):
+                rows *= 2
+            self._resize_stash(rows)
+        row = key & (rows - 1)
+        self._stash_keys[row] = key
+        # Rows of the stash are laid out like slots.
+        self.__copy_slot(self.offsets(slot), self.offsets(row), to_stash=True)
+        slot_sketches = self.sketches[slot]
+        if slot_sketches is not None:
+            # Flushing the slot adds points to its sketches.
+            slot_sketches = [_copy_sketch(sketch) for sketch in slot_sketches]
+        self._stash_sketches[row] = slot_sketches
+
+    def unstash(self, slot, key):
+        """Restore the stashed state of a metric into its new empty slot, if any.
+
+        Evicted metrics have the points of their raw buffer and open buckets written.
+        Without restoring their state, these points would be overwritten by points of
+        the same buckets computed from the points fed after eviction only, and points
+        fed again would be counted twice.
+
+        Args:
+          slot: new slot of the metric.
+          key: see _stash_key().
+        """
+        rows = len(self._stash_keys)
+        if not rows:
+            return
+        row = key & (rows - 1)
+        if self._stash_keys[row] != key:
+            return
+        self.__copy_slot(self.offsets(row), self.offsets(slot), to_stash=False)
+        self.sketches[slot] = self._stash_sketches[row]
+        # Restored at most once, as the slot now owns the sketches. No key has this row
+        # once its low bits are flipped.
+        self._stash_keys[row] = ~key
+        self._stash_sketches[row] = None
+
+    def __copy_slot(self, source_offsets, target_offsets, to_stash):
+        """Copy the fields of a slot to a row of the stash, or the other way around."""
+        stages = self.stages
+        sizes = (1 + stages, self.raw_capacity + stages, stages, len(_EXTRA_COLUMNS) * stages)
+        slot_arrays = (self.timestamps, self.values, self.counts, self.extras)
+        stash_arrays = (
+            self._stash_timestamps, self._stash_values, self._stash_counts,
+            self._stash_extras)
+        if to_stash:
+            sources, targets = slot_arrays, stash_arrays
+        else:
+            sources, targets = stash_arrays, slot_arrays
+        for source, target, source_offset, target_offset, size in zip(
+                sources, targets, source_offsets, target_offsets, sizes):
+            if source is not None:
+                target[target_offset:target_offset + size] = \
+                    source[source_offset:source_offset + size]
+
+    def dump(self, slot, f):
+        """Write the state of a slot to a file object."""
+        t, v, c, e = self.offsets(slot)
+        f.write(self.timestamps[t:t + 1 + self.stages].tostring())
+        f.write(self.values[v:v + self.raw_capacity + self.stages].tostring())
+        f.write(self.counts[c:c + self.stages].tostring())
+        if self.extras is not None:
+            f.write(self.extras[e:e + len(_EXTRA_COLUMNS) * self.stages].tostring())
+        for sketch in self.sketches[slot] or []:
+            data = sketch.to_bytes() if sketch else b""
+            f.write(_CHECKPOINT_SKETCH.pack(len(data)))
+            f.write(data)
+
+    @staticmethod
+    def skip(buf, offset, metric_metadata, raw_capacity, all_aggregates):
+        """Return the offset just after the state written by dump() at offset in buf.
+
+        Args:
+          buf: buffer the state was written to.
+          offset: offset of the state in buf.
+          metric_metadata: MetricMetadata of the metric the state was dumped for.
+          raw_capacity: number of slots in the raw buffer of the metric.
+          all_aggregates: whether the state includes the _EXTRA_COLUMNS of stages.
+        """
+        stages = len(metric_metadata.retention.stages)
+        # Timestamps and counts, then values and extras.
+        offset += _Slab._INT_SIZE * (1 + 2 * stages)
+        offset += _Slab._DOUBLE_SIZE * (raw_capacity + stages)
+        if all_aggregates:
+            offset += _Slab._DOUBLE_SIZE * len(_EXTRA_COLUMNS) * stages
+        if metric_metadata.aggregator.quantile is not None:
+            for _ in xrange(stages):
+                size, = _CHECKPOINT_SKETCH.unpack_from(buf, offset)
+                offset += _CHECKPOINT_SKETCH.size + size
+        if offset > len(buf):
+            raise CheckpointError("truncated checkpoint")
+        return offset
+
+    def load(self, slot, buf, offset):
+        """Read the state written by dump() from buf at offset into a slot.
+
+        Returns:
+          The offset just after what was read.
+        """
+        t, v, c, e = self.offsets(slot)
+        fields = (
+            (self.timestamps, t, 1 + self.stages),
+            (self.values, v, self.raw_capacity + self.stages),
+            (self.counts, c, self.stages),
+        )
+        if self.extras is not None:
+            fields += ((self.extras, e, len(_EXTRA_COLUMNS) * self.stages), )
+        for a, start, length in fields:
+            end = offset + length * a.itemsize
+            if end > len(buf):
+                raise CheckpointError("truncated checkpoint")
+            a[start:start + length] = array.array(a.typecode, buf[offset:end])
+            offset = end
+        slot_sketches = self.sketches[slot]
+        for stage in xrange(len(slot_sketches or [])):
+            size, = _CHECKPOINT_SKETCH.unpack_from(buf, offset)
+            offset += _CHECKPOINT_SKETCH.size
+            if size:
+                try:
+                    slot_sketches[stage] = sketches.QuantileSketch.from_bytes(
+                        buf[offset:offset + size])
+                except sketches.Error as e:
+                    raise CheckpointError(e)
+            offset += size
+        return offset
+
+    def _update_raw(self, slot, datapoints, precision):
+        """"Put raw data points in the raw buffer of a slot and pop expired raw data points.
+
+        Args:
+          slot: slot of the metric.
           datapoints: iterable of (timestamp, value).
           precision: precision of the raw buffer in seconds.
 
         Returns:
           The list of (timestamp, value) expired from the raw buffer.
         """
-        if self._raw_timestamp == -1:
+        # Local variables avoid attribute lookups in the loop.
+        timestamps_offset = slot * (1 + self.stages)
+        raw_timestamp = self.timestamps[timestamps_offset]
+        if raw_timestamp == -1:
             # Raw buffer is empty.
             if not datapoints:
                 # No update => nothing to expire.
                 return []
             # Otherwise, update raw timestamp to first point.
-            first_datapoint = datapoints[0]
-            first_timestamp = first_datapoint[0]
-            self._raw_timestamp = first_timestamp
+            raw_timestamp = datapoints[0][0]
 
+        values = self.values
+        raw_capacity = self.raw_capacity
+        values_offset = slot * (raw_capacity + self.stages)
         expired = []
         for timestamp, value in datapoints:
-            last_update_epoch = self._raw_timestamp // precision
+            last_update_epoch = raw_timestamp // precision
             point_epoch = timestamp // precision
             if point_epoch > last_update_epoch:
                 # Point is more recent than most recent raw point => expire.
@@ -130,46 +1091,78 @@ class MetricAggregates(object):
 
                 # However, N can be larger than the raw buffer capacity.
                 # But we only need to expire as many points as the raw buffer capacity.
-                expired_count = min(expired_count, self._raw_capacity)
+                expired_count = min(expired_count, raw_capacity)
 
                 # The first point to expire is the oldest.
-                start_epoch = last_update_epoch - (self._raw_capacity - 1)
+                start_epoch = last_update_epoch - (raw_capacity - 1)
                 end_epoch = start_epoch + expired_count
                 for epoch in xrange(start_epoch, end_epoch):
-                    index = epoch % self._raw_capacity
-                    if not math.isnan(self._values[index]):
-                        expired.append((epoch * precision, self._values[index]))
-                    self._values[index] = _NaN
-                self._raw_timestamp = bg_accessor.round_down(timestamp, precision)
-                self._values[point_epoch % self._raw_capacity] = value
-            elif point_epoch > last_update_epoch - self._raw_capacity:
+                    index = values_offset + epoch % raw_capacity
+                    if not math.isnan(values[index]):
+                        expired.append((epoch * precision, values[index]))
+                    values[index] = _NaN
+                raw_timestamp = bg_accessor.round_down(timestamp, precision)
+                values[values_offset + point_epoch % raw_capacity] = value
+            elif point_epoch > last_update_epoch - raw_capacity:
                 # Point fits in the buffer => replace value in the raw buffer.
-                self._values[point_epoch % self._raw_capacity] = value
+                values[values_offset + point_epoch % raw_capacity] = value
+        self.timestamps[timestamps_offset] = raw_timestamp
         return expired
 
-    def _update_stage(self, metric_metadata, stage_index, points):
-        """Compute aggregated value for a stage and store it.
+    def _update_stage(self, slot, metric_metadata, stage_index, points, open_bucket=True):
+        """Compute aggregated value for a stage of a slot and store it.
 
         The points have to be sorted by increasing timestamps.
 
         Args:
+          slot: slot of the metric.
           metric_metadata: MetricMetadata object.
           stage_index: index of stage to update with raw points.
           points: raw points to be added into the current stage aggregate.
+          open_bucket: whether to return the point of the bucket that is still open.
 
         Returns:
-          Iterable of (timestamp, value, count, stage).
+          Iterable of (timestamp, value, count, stage), followed for downsampled stages by
+          a dict of extra columns: the serialized "sketch" of the point for percentile
+          aggregators, and the _EXTRA_COLUMNS if all aggregates are computed.
         """
+        # Points of the first stage come from a single raw point, their extra columns
+        # would be the same as their value.
+        if not stage_index:
+            return self._update_stage_value(
+                slot, metric_metadata, stage_index, points, open_bucket)
+        if self.extras is not None:
+            # Must be done first, as it needs the timestamp of the stage before the update.
+            buckets = self._update_stage_extras(slot, metric_metadata, stage_index, points)
+        if self.sketches[slot] is not None:
+            expired = self._update_stage_sketch(
+                slot, metric_metadata, stage_index, points, open_bucket)
+        else:
+            expired = self._update_stage_value(
+                slot, metric_metadata, stage_index, points, open_bucket)
+        if self.extras is None:
+            return expired
+        for i, point in enumerate(expired):
+            columns = point[4] if len(point) > 4 else {}
+            columns.update(zip(_EXTRA_COLUMNS, buckets[point[0]]))
+            expired[i] = point[:4] + (columns, )
+        return expired
+
+    def _update_stage_value(self, slot, metric_metadata, stage_index, points, open_bucket):
+        """Same as _update_stage(), without extra columns."""
         stages = metric_metadata.retention.stages
         stage = stages[stage_index]
         precision = stage.precision
         aggregator = metric_metadata.aggregator
 
-        current_timestamp = self._get_stage_timestamp(stage_index)
-        current_value = self._get_stage_value(stage_index)
-        current_count = self._get_stage_count(stage_index)
+        timestamps_offset = slot * (1 + self.stages) + 1 + stage_index
+        values_offset = slot * (self.raw_capacity + self.stages) + self.raw_capacity + stage_index
+        counts_offset = slot * self.stages + stage_index
+        current_timestamp = self.timestamps[timestamps_offset]
         if current_timestamp == -1 and not points:
             return []
+        current_value = self.values[values_offset]
+        current_count = self.counts[counts_offset]
 
         if current_timestamp == -1:
             # Raw buffer is empty  => take first point timestamp.
@@ -200,104 +1193,168 @@ class MetricAggregates(object):
                 expired.append((epoch * precision, value, 1, stage))
         if expired:
             current_point = expired[-1]
-            self._set_stage_timestamp(stage_index, current_point[0])
-            self._set_stage_value(stage_index, current_point[1])
-            self._set_stage_count(stage_index, current_point[2])
+            self.timestamps[timestamps_offset] = current_point[0]
+            self.values[values_offset] = current_point[1]
+            self.counts[counts_offset] = current_point[2]
+            if not open_bucket:
+                del expired[-1]
 
         return expired
 
-    def update(self, metric_metadata, datapoints):
-        """"Compute aggregated values and store them.
+    def _update_stage_sketch(self, slot, metric_metadata, stage_index, points, open_bucket):
+        """Same as _update_stage() for percentile aggregators."""
+        stage = metric_metadata.retention.stages[stage_index]
+        precision = stage.precision
+        quantile = metric_metadata.aggregator.quantile
 
-        The points have to be sorted by increasing timestamps.
+        timestamps_offset = slot * (1 + self.stages) + 1 + stage_index
+        values_offset = slot * (self.raw_capacity + self.stages) + self.raw_capacity + stage_index
+        counts_offset = slot * self.stages + stage_index
+        current_timestamp = self.timestamps[timestamps_offset]
+        if current_timestamp == -1 and not points:
+            return []
 
-        Args:
-          metric_metadata: MetricMetadata object
-          datapoints: iterable of (timestamp, value).
+        slot_sketches = self.sketches[slot]
+        sketch = slot_sketches[stage_index]
+        if current_timestamp == -1:
+            # Raw buffer is empty  => take first point timestamp.
+            current_timestamp = bg_accessor.round_down(points[0][0], precision)
+            sketch = sketches.QuantileSketch()
+        elif sketch is None:
+            # The bucket was opened by an aggregator without sketches, make do with its value.
+            sketch = sketches.QuantileSketch()
+            count = self.counts[counts_offset]
+            if count:
+                sketch.add(self.values[values_offset], count)
 
-        Returns:
-          The list of expired (timestamp, value, count, stage) for all stages.
-        """
-        stages = metric_metadata.retention.stages
-        raw_precision = stages[0].precision
-        expired_raw = self._update_raw(datapoints, raw_precision)
         expired = []
-        for stage in xrange(len(metric_metadata.retention.stages)):
-            expired.extend(self._update_stage(metric_metadata, stage, expired_raw))
-        return expired
-
-    @property
-    def _raw_timestamp(self):
-        """Get timestamp of raw buffer."""
-        return self._timestamps[0]
-
-    @_raw_timestamp.setter
-    def _raw_timestamp(self, value):
-        """Set timestamp of raw buffer."""
-        self._timestamps[0] = value
-
-    def _get_stage_timestamp(self, stage):
-        """Get timestamp of stage in buffer.
+        current_epoch = current_timestamp // precision
+        for timestamp, value in points:
+            epoch = timestamp // precision
+            if epoch > current_epoch:
+                # Point is in new epoch => the current bucket is closed.
+                if sketch.count:
+                    expired.append((
+                        current_epoch * precision, sketch.quantile(quantile), sketch.count,
+                        stage, {"sketch": sketch.to_bytes()}))
+                current_epoch = epoch
+                sketch = sketches.QuantileSketch()
+            if epoch == current_epoch:
+                sketch.add(value)
 
-        Raw timestamp is at index 0.
-        Stage timestamps start at index 1.
+        current_value = sketch.quantile(quantile)
+        self.timestamps[timestamps_offset] = current_epoch * precision
+        self.values[values_offset] = current_value
+        self.counts[counts_offset] = sketch.count
+        slot_sketches[stage_index] = sketch
+        if open_bucket and sketch.count:
+            expired.append((
+                current_epoch * precision, current_value, sketch.count, stage,
+                {"sketch": sketch.to_bytes()}))
+        return expired
 
-        Args:
-          stage: stage whose timestamp to get.
+    def _update_stage_extras(self, slot, metric_metadata, stage_index, points):
+        """Update the _EXTRA_COLUMNS of a stage, as _update_stage() does for values.
 
         Returns:
-          Timestamp of stage, in seconds.
+          A dict associating the timestamps of the buckets of the stage that were open or
+          that points were added to, to a tuple of their _EXTRA_COLUMNS.
         """
-        return self._timestamps[1 + stage]
-
-    def _set_stage_timestamp(self, stage, timestamp):
-        """Set timestamp of stage in buffer.
+        precision = metric_metadata.retention.stages[stage_index].precision
+        current_timestamp = self.timestamps[slot * (1 + self.stages) + 1 + stage_index]
+        if current_timestamp == -1 and not points:
+            return {}
 
-        Raw timestamp is at index 0.
-        Stage timestamps start at index 1.
+        extras = self.extras
+        offset = len(_EXTRA_COLUMNS) * (slot * self.stages + stage_index)
+        minimum, maximum, total = extras[offset:offset + len(_EXTRA_COLUMNS)]
+        if current_timestamp == -1:
+            current_epoch = points[0][0] // precision
+        else:
+            current_epoch = current_timestamp // precision
 
-        Args:
-          stage: stage whose timestamp to set.
-          timestamp: timestamp to set stage to.
-        """
-        self._timestamps[1 + stage] = timestamp
+        buckets = {}
+        for timestamp, value in points:
+            epoch = timestamp // precision
+            if epoch > current_epoch:
+                buckets[current_epoch * precision] = (minimum, maximum, total)
+                current_epoch = epoch
+                minimum = maximum = total = _NaN
+            if epoch == current_epoch:
+                if math.isnan(total):
+                    minimum = maximum = total = value
+                else:
+                    minimum = min(minimum, value)
+                    maximum = max(maximum, value)
+                    total += value
+        buckets[current_epoch * precision] = (minimum, maximum, total)
+        extras[offset:offset + len(_EXTRA_COLUMNS)] = array.array(
+            "d", (minimum, maximum, total))
+        return buckets
 
-    def _get_stage_value(self, stage):
-        """Get value of stage in buffer.
+    def flush(self, slot, metric_metadata):
+        """Expire all raw points of a slot and return the current aggregates of all stages.
 
         Args:
-          stage: stage whose value to get.
+          slot: slot of the metric.
+          metric_metadata: MetricMetadata object
 
         Returns:
-          Value of stage.
+          The list of (timestamp, value, count, stage) for all stages, see
+          _update_stage() for extra columns.
         """
-        return self._values[self._raw_capacity + stage]
-
-    def _set_stage_value(self, stage, value):
-        """Set value of stage in buffer.
+        stages = metric_metadata.retention.stages
+        precision = stages[0].precision
+        values = self.values
+        raw_capacity = self.raw_capacity
+        timestamps_offset = slot * (1 + self.stages)
+        values_offset = slot * (raw_capacity + self.stages)
+        raw_timestamp = self.timestamps[timestamps_offset]
+        expired_raw = []
+        if raw_timestamp != -1:
+            last_epoch = raw_timestamp // precision
+            for epoch in xrange(last_epoch - (raw_capacity - 1), last_epoch + 1):
+                index = values_offset + epoch % raw_capacity
+                if not math.isnan(values[index]):
+                    expired_raw.append((epoch * precision, values[index]))
+                values[index] = _NaN
+            self.timestamps[timestamps_offset] = -1
+        expired = []
+        for stage in xrange(len(stages)):
+            expired.extend(self._update_stage(slot, metric_metadata, stage, expired_raw))
+        return expired
 
-        Args:
-          stage: stage whose value to set.
-          value: value to set stage to.
-        """
-        self._values[self._raw_capacity + stage] = value
+    def update(self, slot, metric_metadata, datapoints, open_buckets=True):
+        """"Compute aggregated values of a slot and store them.
 
-    def _get_stage_count(self, stage):
-        """Get count of stage in buffer.
+        The points have to be sorted by increasing timestamps.
 
         Args:
-          stage: stage whose count to get.
+          slot: slot of the metric.
+          metric_metadata: MetricMetadata object
+          datapoints: iterable of (timestamp, value).
+          open_buckets: whether to return the points of buckets that are still open.
 
         Returns:
-          Count of stage.
-        """
-        return self._counts[stage]
-
-    def _set_stage_count(self, stage, count):
-        """Set count of stage in buffer.
-
-        Args:
-          stage: stage whose count to set.
-          count: count to set stage to.
+          The list of expired (timestamp, value, count, stage) for all stages, see
+          _update_stage() for extra columns.
         """
-        self._counts[stage] = count
+        stages = metric_metadata.retention.stages
+        expired_raw = self._update_raw(slot, datapoints, stages[0].precision)
+        if not expired_raw and not open_buckets:
+            # Stages are unchanged and only their open buckets could be returned.
+            return []
+        # Buckets of stage 0 hold a single raw point, they are closed as soon as it expires
+        # from the raw buffer. The last one is thus returned even without open buckets,
+        # unlike the bucket stage 0 had before, unless points were added to it.
+        expired = self._update_stage_value(slot, metric_metadata, 0, expired_raw, True)
+        if not open_buckets and expired[0][0] != expired_raw[0][0]:
+            del expired[0]
+        if self.extras is None and self.sketches[slot] is None:
+            # Skips a call per stage in the common case.
+            update_stage = self._update_stage_value
+        else:
+            update_stage = self._update_stage
+        for stage in xrange(1, len(stages)):
+            expired.extend(update_stage(slot, metric_metadata, stage, expired_raw, open_buckets))
+        return expired
@@ -70,3 +70,94 @@ class CountDown(object):
     def on_cassandra_failure(self, exc):
         """Call cancel(), suitable for Cassandra's execute_async."""
         self.cancel(Error(exc))
+
+
+class WriteWindow(object):
+    """Bounds the number of in-flight statements.
+
+    What happens when the window is full depends on the policy:
+      - BLOCK: acquire() waits until enough statements completed.
+      - DROP: acquire() returns False, the statements must not be sent.
+      - CALLBACK: like DROP, then on_capacity() is called once the window is half empty
+        so that callers can resume sending.
+
+    With BLOCK, acquire() must not be called from the callbacks of the statements, as they
+    are run by the threads that would release the window.
+    """
+
+    BLOCK = "block"
+    DROP = "drop"
+    CALLBACK = "callback"
+    POLICIES = (BLOCK, DROP, CALLBACK)
+
+    __slots__ = (
+        "_capacity", "_condition", "_in_flight", "_on_capacity", "_on_capacity_pending",
+        "_policy", "dropped_count",
+    )
+
+    def __init__(self, capacity, policy=BLOCK, on_capacity=None):
+        """Record parameters.
+
+        Args:
+          capacity: Maximum number of in-flight statements, must be > 0.
+          policy: One of POLICIES.
+          on_capacity: Called without argument when there is room again after acquire()
+            returned False, mandatory with CALLBACK.
+        """
+        assert capacity > 0
+        if policy not in self.POLICIES:
+            raise bg_accessor.InvalidArgumentError("Unknown window policy: %s" % policy)
+        if policy == self.CALLBACK and not on_capacity:
+            raise bg_accessor.InvalidArgumentError("%s requires on_capacity" % policy)
+        self._capacity = capacity
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._on_capacity = on_capacity
+        self._on_capacity_pending = False
+        self._policy = policy
+        self.dropped_count = 0
+
+    @property
+    def in_flight(self):
+        """The number of statements that were acquired and not released."""
+        return self._in_flight
+
+    def acquire(self, count):
+        """Reserve room for count statements.
+
+        When count is larger than the capacity, it is granted once the window is empty.
+
+        Returns:
+          True if the statements can be sent, False if they must be dropped.
+        """
+        with self._condition:
+            while self._in_flight and self._in_flight + count > self._capacity:
+                if self._policy != self.BLOCK:
+                    self.dropped_count += count
+                    self._on_capacity_pending = self._policy == self.CALLBACK
+                    return False
+                self._condition.wait()
+            self._in_flight += count
+            return True
+
+    def release(self, count=1):
+        """Free room reserved by acquire(), call on_capacity if needed."""
+        on_capacity = None
+        with self._condition:
+            self._in_flight -= count
+            assert self._in_flight >= 0
+            self._condition.notify_all()
+            if self._on_capacity_pending and self._in_flight <= self._capacity // 2:
+                self._on_capacity_pending = False
+                on_capacity = self._on_capacity
+        # Called without the lock so that it can acquire() again.
+        if on_capacity:
+            on_capacity()
+
+    def on_cassandra_result(self, unused_result):
+        """Call release(), suitable for Cassandra's execute_async."""
+        self.release()
+
+    def on_cassandra_failure(self, unused_exc):
+        """Call release(), suitable for Cassandra's execute_async."""
+        self.release()
@@ -17,7 +17,10 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import json
 import logging
+import re
+import threading
 
 import cassandra
 from cassandra import cluster as c_cluster
@@ -51,6 +54,10 @@ class TooManyMetrics(CassandraError):
     """A name glob yielded more than Accessor.MAX_METRIC_PER_GLOB metrics."""
 
 
+class TooManyInFlightWrites(RetryableCassandraError):
+    """A write was dropped because too many writes were in flight."""
+
+
 class InvalidArgumentError(Error, bg_accessor.InvalidArgumentError):
     """Callee did not follow requirements on the arguments."""
 
@@ -62,7 +69,6 @@ class InvalidGlobError(InvalidArgumentError):
 # ====================
 # The following few constants are heuristics that are used to tune
 # the datatable.
-# TODO: Consider switching to TWCS after Cassandra 3.8
 # We expect timestamp T to be written at T +/- _OUT_OF_ORDER_S
 # As result we delay expiry and compaction by that much time
 _OUT_OF_ORDER_S = 15 * 60
@@ -74,6 +80,28 @@ _EXPECTED_POINTS_PER_READ = 256
 # often to make sure they are persisted.
 _FLUSH_MEMORY_EVERY_S = 15 * 60
 
+# Default bound on the number of insert statements waiting for a reply. Past that,
+# writes are blocked (or dropped depending on the policy) instead of being queued
+# in the driver, which would otherwise grow without bounds when Cassandra is slow.
+_DEFAULT_MAX_IN_FLIGHT_WRITES = 10000
+# What happens to writes when there are too many in flight, see _utils.WriteWindow.
+WRITE_WINDOW_BLOCK = _utils.WriteWindow.BLOCK
+WRITE_WINDOW_DROP = _utils.WriteWindow.DROP
+WRITE_WINDOW_CALLBACK = _utils.WriteWindow.CALLBACK
+
+# Event loops the driver can run its connections on. With CONNECTION_TWISTED, requests
+# are sent and their callbacks run from the Twisted reactor (started in a thread unless
+# already running) instead of a thread of the driver. As connect() waits for the reactor,
+# it must then be called from another thread, and once the reactor runs if another
+# component runs it, like Carbon does.
+CONNECTION_ASYNCORE = "asyncore"
+CONNECTION_TWISTED = "twisted"
+
+# Number of token ranges scanned by iter_all_*() when the caller does not provide any.
+# Ranges are scanned with a concurrency bounded by the accessor's concurrency, having
+# many small ones makes it less likely to wait on a single slow range.
+_DEFAULT_SCAN_RANGES = 256
+
 _COMPONENTS_MAX_LEN = 64
 _LAST_COMPONENT = "__END__"
 _METADATA_CREATION_CQL_PATH_COMPONENTS = ", ".join(
@@ -119,17 +147,104 @@ _DATAPOINTS_CREATION_CQL_TEMPLATE = str(
     "  time_offset_ms int,"       # time_start_ms + time_offset_ms = timestamp
     "  value double,"             # Value for the point.
     "  count int,"                # If value is sum, divide by count to get the avg.
+    "  sketch blob,"              # For percentile aggregators, see sketches.QuantileSketch.
+    "  minimum double,"           # For downsampled points, when all aggregates are stored.
+    "  maximum double,"
+    "  total double,"
     "  PRIMARY KEY ((metric, time_start_ms), time_offset_ms)"
     ")"
     "  WITH CLUSTERING ORDER BY (time_offset_ms DESC)"
     "  AND default_time_to_live = %(default_time_to_live)d"
-    "  AND compaction = {"
+    "  AND comment = '%(comment)s'"
+    "  AND compaction = %(compaction)s;"
+)
+_DATAPOINTS_UPGRADE_CQL_TEMPLATE = str(
+    "ALTER TABLE %(table)s"
+    "  WITH comment = '%(comment)s'"
+    "  AND compaction = %(compaction)s;"
+)
+# Columns added after the first release, in the order they are selected. Tables missing
+# them get them from upgrade_datapoints_tables(), until then they are not read or written.
+_DATAPOINTS_ADDED_COLUMNS = [
+    ("sketch", "blob"),
+    ("minimum", "double"),
+    ("maximum", "double"),
+    ("total", "double"),
+]
+_DATAPOINTS_ADD_COLUMN_CQL_TEMPLATE = "ALTER TABLE %(table)s ADD %(column)s %(type)s;"
+_DATAPOINTS_TABLE_RE = re.compile(r"^datapoints_(?P<points>[\d]+)p_(?P<precision>[\d]+)s$")
+
+# Compaction strategies supported for datapoints tables.
+DATE_TIERED_COMPACTION = "DateTieredCompactionStrategy"
+TIME_WINDOW_COMPACTION = "TimeWindowCompactionStrategy"
+
+# The layout of a datapoints table is identified by the "schema_version" stored in its
+# comment. Tables are only ever upgraded to a greater version, never downgraded.
+#  - 0: DateTieredCompactionStrategy (tables without comment are assumed to be version 0)
+#  - 1: TimeWindowCompactionStrategy with windows derived from precision and row size,
+#    it requires Cassandra 3.8 or later.
+_COMPACTION_TO_SCHEMA_VERSION = {
+    DATE_TIERED_COMPACTION: 0,
+    TIME_WINDOW_COMPACTION: 1,
+}
+_DATAPOINTS_DTCS_CQL_TEMPLATE = str(
+    "{"
     "    'class': 'DateTieredCompactionStrategy',"
     "    'base_time_seconds': '%(base_time_seconds)d',"
     "    'max_window_size_seconds': %(max_window_size_seconds)d,"
     "    'timestamp_resolution': 'MICROSECONDS'"
-    "  };"
+    "  }"
+)
+_DATAPOINTS_TWCS_CQL_TEMPLATE = str(
+    "{"
+    "    'class': 'TimeWindowCompactionStrategy',"
+    "    'compaction_window_unit': 'MINUTES',"
+    "    'compaction_window_size': %(compaction_window_minutes)d,"
+    "    'timestamp_resolution': 'MICROSECONDS'"
+    "  }"
 )
+# With TWCS data is never compacted across windows, so the number of sstables to read
+# when looking at the whole retention is about the number of windows. 30 is what the
+# TWCS documentation recommends.
+_MAX_WINDOWS_PER_TABLE = 30
+
+
+def _time_window_seconds(stage):
+    """Return the size of a TWCS window for a stage.
+
+    A window is a multiple of the row size, so that a row is written in at most two
+    windows, and large enough to keep about _MAX_WINDOWS_PER_TABLE windows alive.
+
+    Args:
+      stage: The stage the datapoints table is for.
+
+    Returns:
+      The window size, in seconds.
+    """
+    row_size_s = _ROW_SIZE_MS // 1000
+    time_to_live = stage.duration + _OUT_OF_ORDER_S
+    window_s = bg_accessor.round_up(time_to_live // _MAX_WINDOWS_PER_TABLE, row_size_s)
+    return max(window_s, row_size_s)
+
+
+# Bounds of the Murmur3Partitioner token ring, no partition key has the minimum token.
+_MIN_TOKEN = -2 ** 63
+_MAX_TOKEN = 2 ** 63 - 1
+
+
+def _split_token_ring(count):
+    """Split the token ring in ranges of similar sizes.
+
+    Args:
+      count: The number of ranges, as an int.
+
+    Returns:
+      A list of (start, end) tuples, where start is excluded and end is included.
+    """
+    step = (_MAX_TOKEN - _MIN_TOKEN) // count
+    bounds = [_MIN_TOKEN + n * step for n in xrange(count)]
+    bounds.append(_MAX_TOKEN)
+    return zip(bounds[:-1], bounds[1:])
 
 
 class _CappedConnection(c_asyncorereactor.AsyncoreConnection):
@@ -139,6 +254,21 @@ class _CappedConnection(c_asyncorereactor.AsyncoreConnection):
     max_in_flight = 300
 
 
+def _connection_class(connection):
+    """Return the class of capped connections running on the given event loop."""
+    if connection != CONNECTION_TWISTED:
+        return _CappedConnection
+    # Twisted is only required by this event loop.
+    from cassandra.io import twistedreactor as c_twistedreactor
+
+    class _TwistedCappedConnection(c_twistedreactor.TwistedConnection):
+        """A Twisted connection with a cap on the number of in-flight requests per host."""
+
+        max_in_flight = _CappedConnection.max_in_flight
+
+    return _TwistedCappedConnection
+
+
 class _LazyPreparedStatements(object):
     """On demand factory of prepared statements and tables.
 
@@ -146,59 +276,160 @@ class _LazyPreparedStatements(object):
     This creates tables and corresponding prepared statements once they are needed.
     """
 
-    def __init__(self, session, keyspace):
+    def __init__(self, session, keyspace, compaction_strategy=DATE_TIERED_COMPACTION):
         self._keyspace = keyspace
         self._session = session
+        self._compaction_strategy = compaction_strategy
+        self._schema_version = _COMPACTION_TO_SCHEMA_VERSION[compaction_strategy]
         self.__stage_to_insert = {}
         self.__stage_to_select = {}
 
-    def _create_datapoints_table(self, stage):
+    def _datapoints_table_options(self, stage):
+        """Return the parameters of _DATAPOINTS_*_CQL_TEMPLATE for a stage."""
         # Time after which data expire.
         time_to_live = stage.duration + _OUT_OF_ORDER_S
 
-        # Time it takes to receive a step
-        arrival_time = stage.precision + _OUT_OF_ORDER_S
-
-        # Estimate the age of the oldest data we still expect to read
-        fresh_time = stage.precision * _EXPECTED_POINTS_PER_READ
-        # See http://www.datastax.com/dev/blog/datetieredcompactionstrategy
-        #  - If too small: Reads need to touch many sstables
-        #  - If too big: We pay compaction overhead for data that are never accessed anymore
-        #    and get huge sstables
-        # We set a minimum of arrival_time so that data are in order
-        max_window_size_seconds = max(fresh_time, arrival_time + 1)
-
-        statement_str = _DATAPOINTS_CREATION_CQL_TEMPLATE % {
+        if self._compaction_strategy == TIME_WINDOW_COMPACTION:
+            compaction = _DATAPOINTS_TWCS_CQL_TEMPLATE % {
+                "compaction_window_minutes": _time_window_seconds(stage) // 60,
+            }
+        else:
+            # Time it takes to receive a step
+            arrival_time = stage.precision + _OUT_OF_ORDER_S
+
+            # Estimate the age of the oldest data we still expect to read
+            fresh_time = stage.precision * _EXPECTED_POINTS_PER_READ
+            # See http://www.datastax.com/dev/blog/datetieredcompactionstrategy
+            #  - If too small: Reads need to touch many sstables
+            #  - If too big: We pay compaction overhead for data that are never accessed
+            #    anymore and get huge sstables
+            # We set a minimum of arrival_time so that data are in order
+            max_window_size_seconds = max(fresh_time, arrival_time + 1)
+            compaction = _DATAPOINTS_DTCS_CQL_TEMPLATE % {
+                # When we start compacting
+                "base_time_seconds": arrival_time,
+                "max_window_size_seconds": max_window_size_seconds,
+            }
+
+        comment = json.dumps({
+            "created_by": "biggraphite",
+            "schema_version": self._schema_version,
+        })
+        return {
             "table": self._get_table_name(stage),
             "default_time_to_live": time_to_live,
-            # When we start compacting
-            "base_time_seconds": arrival_time,
-            "max_window_size_seconds": max_window_size_seconds,
-            "memtable_flush_period_in_ms": _FLUSH_MEMORY_EVERY_S * 1000,
-            "comment": "{\"created_by\": \"biggraphite\", \"schema_version\": 0}",
+            "compaction": compaction,
+            "comment": comment,
         }
+
+    def _create_datapoints_table(self, stage):
+        """Create the table of a stage if it does not exist, return the set of its columns."""
+        options = self._datapoints_table_options(stage)
         # The statement is idempotent
-        self._session.execute(statement_str)
+        self._session.execute(_DATAPOINTS_CREATION_CQL_TEMPLATE % options)
+        return self._get_columns(stage)
+
+    def _get_schema_version(self, stage):
+        """Return the schema_version of the table of a stage, None if it does not exist."""
+        statement_str = (
+            "SELECT comment FROM system_schema.tables"
+            " WHERE keyspace_name = %s AND table_name = %s;"
+        )
+        table_name = "datapoints_{}p_{}s".format(stage.points, stage.precision)
+        rows = list(self._session.execute(statement_str, (self._keyspace, table_name)))
+        if not rows:
+            return None
+        try:
+            return int(json.loads(rows[0][0])["schema_version"])
+        except (TypeError, ValueError, KeyError):
+            # Tables created before we started tracking versions have no usable comment.
+            return 0
+
+    def upgrade_datapoints_table(self, stage):
+        """Migrate the table of a stage to the configured layout if it is older.
+
+        Args:
+          stage: The stage whose table to upgrade.
+        """
+        schema_version = self._get_schema_version(stage)
+        if schema_version is None:
+            return
+        options = self._datapoints_table_options(stage)
+        if schema_version < self._schema_version:
+            logging.info(
+                "upgrading %s from schema version %d to %d",
+                options["table"], schema_version, self._schema_version)
+            # The statement is idempotent
+            self._session.execute(_DATAPOINTS_UPGRADE_CQL_TEMPLATE % options)
+
+        columns = self._get_columns(stage)
+        for column, column_type in _DATAPOINTS_ADDED_COLUMNS:
+            if column in columns:
+                continue
+            logging.info("adding column %s to %s", column, options["table"])
+            self._session.execute(_DATAPOINTS_ADD_COLUMN_CQL_TEMPLATE % {
+                "table": options["table"], "column": column, "type": column_type,
+            })
+
+    def _get_columns(self, stage):
+        """Return the set of column names of the table of a stage."""
+        statement_str = (
+            "SELECT column_name FROM system_schema.columns"
+            " WHERE keyspace_name = %s AND table_name = %s;"
+        )
+        table_name = "datapoints_{}p_{}s".format(stage.points, stage.precision)
+        return set(row[0] for row in self._session.execute(
+            statement_str, (self._keyspace, table_name)))
+
+    def upgrade_datapoints_tables(self):
+        """Migrate all existing datapoints tables to the configured layout."""
+        statement_str = "SELECT table_name FROM system_schema.tables WHERE keyspace_name = %s;"
+        for row in self._session.execute(statement_str, (self._keyspace, )):
+            match = _DATAPOINTS_TABLE_RE.match(row[0])
+            if not match:
+                continue
+            stage = bg_accessor.Stage(
+                points=int(match.group("points")),
+                precision=int(match.group("precision")),
+            )
+            self.upgrade_datapoints_table(stage)
 
     def _get_table_name(self, stage):
         return "\"{}\".\"datapoints_{}p_{}s\"".format(self._keyspace, stage.points, stage.precision)
 
-    def prepare_insert(self, stage, metric_name, time_start_ms, time_offset_ms, value, count):
-        statement = self.__stage_to_insert.get(stage)
+    def prepare_insert(self, stage, metric_name, time_start_ms, time_offset_ms, value, count,
+                       extras=None):
+        # Inserting a null would write a tombstone, so points only mention the extra
+        # columns they have, with a statement for each set of columns.
+        extra_columns = tuple(sorted(extras)) if extras else ()
+        prepared = self.__stage_to_insert.get((stage, extra_columns))
+        if not prepared:
+            prepared = self.__prepare_insert(stage, extra_columns)
+            self.__stage_to_insert[(stage, extra_columns)] = prepared
+        statement, written_columns = prepared
         args = (metric_name, time_start_ms, time_offset_ms, value, count)
-        if statement:
-            return statement, args
+        args += tuple(extras[column] for column in written_columns)
+        return statement, args
 
-        self._create_datapoints_table(stage)
-        statement_str = (
-            "INSERT INTO %(table)s"
-            " (metric, time_start_ms, time_offset_ms, value, count)"
-            " VALUES (?, ?, ?, ?, ?);"
-        ) % {"table": self._get_table_name(stage)}
+    def __prepare_insert(self, stage, extra_columns):
+        """Return a statement inserting points with extra columns, and the ones it writes."""
+        table_columns = self._create_datapoints_table(stage)
+        written_columns = tuple(c for c in extra_columns if c in table_columns)
+        if written_columns != extra_columns:
+            logging.warning(
+                "%s lacks columns %s, see upgrade_datapoints_tables()",
+                self._get_table_name(stage),
+                ", ".join(c for c in extra_columns if c not in table_columns))
+        columns = ("metric", "time_start_ms", "time_offset_ms", "value", "count")
+        columns += written_columns
+        statement_str = "INSERT INTO %(table)s (%(columns)s) VALUES (%(markers)s);" % {
+            "table": self._get_table_name(stage),
+            "columns": ", ".join(columns),
+            "markers": ", ".join("?" * len(columns)),
+        }
         statement = self._session.prepare(statement_str)
         statement.consistency_level = cassandra.ConsistencyLevel.ANY
-        self.__stage_to_insert[stage] = statement
-        return statement, args
+        return statement, written_columns
 
     def prepare_select(self, stage, metric_name, row_start_ms, row_min_offset, row_max_offset):
         statement = self.__stage_to_select.get(stage)
@@ -206,13 +437,19 @@ class _LazyPreparedStatements(object):
         if statement:
             return statement, args
 
-        self._create_datapoints_table(stage)
+        table_columns = self._create_datapoints_table(stage)
+        columns = ["time_start_ms", "time_offset_ms", "value", "count"]
+        # Rows are read by position, fetch_points() takes missing trailing columns as nulls.
+        for column, _ in _DATAPOINTS_ADDED_COLUMNS:
+            if column not in table_columns:
+                break
+            columns.append(column)
         statement_str = (
-            "SELECT time_start_ms, time_offset_ms, value, count FROM %(table)s"
+            "SELECT %(columns)s FROM %(table)s"
             " WHERE metric=? AND time_start_ms=?"
             " AND time_offset_ms >= ? AND time_offset_ms < ? "
             " ORDER BY time_offset_ms;"
-        ) % {"table": self._get_table_name(stage)}
+        ) % {"table": self._get_table_name(stage), "columns": ", ".join(columns)}
         statement = self._session.prepare(statement_str)
         statement.consistency_level = cassandra.ConsistencyLevel.LOCAL_ONE
         self.__stage_to_select[stage] = statement
@@ -223,8 +460,13 @@ class _CassandraAccessor(bg_accessor.Accessor):
     """Provides Read/Write accessors to Cassandra.
 
     Please refer to bg_accessor.Accessor.
+
+    Once connected, insert_points_async(), insert_points(), get_metric() and get_metrics()
+    may be called concurrently from several threads.
     """
 
+    THREAD_SAFE_LOOKUPS = True
+
     _MAX_QUERY_RANGE_MS = 365 * 24 * _ROW_SIZE_MS
 
     # Current value is based on page settings, so that everything fits in a single Cassandra
@@ -238,7 +480,13 @@ class _CassandraAccessor(bg_accessor.Accessor):
 
     _DEFAULT_CASSANDRA_PORT = 9042
 
-    def __init__(self, keyspace, contact_points, port=None, concurrency=4, default_timeout=None):
+    def __init__(self, keyspace, contact_points, port=None, concurrency=4, default_timeout=None,
+                 compaction_strategy=None,
+                 max_in_flight_writes=_DEFAULT_MAX_IN_FLIGHT_WRITES,
+                 write_window_policy=WRITE_WINDOW_BLOCK, on_write_capacity=None,
+                 downsampler_max_metrics=None, downsampler_checkpoint=None,
+                 downsampler_max_idle=None, downsampler_open_buckets_interval=0,
+                 downsampler_all_aggregates=False, connection=CONNECTION_ASYNCORE):
         """Record parameters needed to connect.
 
         Args:
@@ -246,6 +494,34 @@ class _CassandraAccessor(bg_accessor.Accessor):
           contact_points: list of strings, the hostnames or IP to use to discover Cassandra.
           port: The port to connect to, as an int.
           concurrency: How many worker threads to use.
+          default_timeout: Default timeout for synchronous queries, in seconds.
+          compaction_strategy: Compaction strategy of datapoints tables, one of
+            DATE_TIERED_COMPACTION (the default) or TIME_WINDOW_COMPACTION.
+          max_in_flight_writes: Maximum number of insert statements waiting for a reply.
+          write_window_policy: What to do with writes past max_in_flight_writes, one of
+            WRITE_WINDOW_BLOCK (the default), WRITE_WINDOW_DROP or WRITE_WINDOW_CALLBACK.
+            Dropped writes call on_done with TooManyInFlightWrites.
+          on_write_capacity: With WRITE_WINDOW_CALLBACK, called without arguments when
+            writes can be sent again after some were dropped.
+          downsampler_max_metrics: Maximum number of metrics to keep downsampling aggregates
+            for, the partial aggregates of least recently written ones are written and
+            dropped. None for no limit.
+          downsampler_checkpoint: Path of a file in which to keep downsampling aggregates
+            across restarts, None to not keep them. It is loaded by the first write and
+            written by checkpoint() and shutdown() once loaded, so that processes that
+            only read never touch it. Processes writing concurrently must each have
+            their own.
+          downsampler_max_idle: Number of seconds after which the downsampling aggregates
+            of a metric that is not written anymore are written and dropped. None to keep
+            them until shutdown.
+          downsampler_open_buckets_interval: Minimum number of seconds between two writes
+            of the points of a metric whose buckets are still open. None to only write
+            points once their buckets are closed.
+          downsampler_all_aggregates: Whether downsampled points also store the minimum,
+            maximum and total of their values, so that fetch_points() can return any of
+            them whatever the aggregator of the metric.
+          connection: Event loop of connections, CONNECTION_ASYNCORE (the default) or
+            CONNECTION_TWISTED.
         """
         backend_name = "cassandra:" + keyspace
         super(_CassandraAccessor, self).__init__(backend_name)
@@ -253,13 +529,32 @@ class _CassandraAccessor(bg_accessor.Accessor):
         self.keyspace_metadata = keyspace + "_metadata"
         self.contact_points = contact_points
         self.port = port or self._DEFAULT_CASSANDRA_PORT
+        compaction_strategy = compaction_strategy or DATE_TIERED_COMPACTION
+        if compaction_strategy not in _COMPACTION_TO_SCHEMA_VERSION:
+            raise InvalidArgumentError("Unknown compaction strategy: %s" % compaction_strategy)
+        self.compaction_strategy = compaction_strategy
+        if connection not in (CONNECTION_ASYNCORE, CONNECTION_TWISTED):
+            raise InvalidArgumentError("Unknown connection: %s" % connection)
+        self.__connection = connection
+        self.__write_window = _utils.WriteWindow(
+            max_in_flight_writes, write_window_policy, on_write_capacity)
         self.__concurrency = concurrency
-        self.__downsampler = _downsampling.Downsampler()
+        self.__downsampler = _downsampling.ShardedDownsampler(
+            max_metrics=downsampler_max_metrics, on_evict=self.__insert_evicted_points,
+            open_buckets_interval=downsampler_open_buckets_interval,
+            all_aggregates=downsampler_all_aggregates)
+        self.__downsampler_checkpoint = downsampler_checkpoint
+        self.__checkpoint_lock = threading.Lock()
+        self.__checkpoint_loaded = False
+        self.__downsampler_max_idle = downsampler_max_idle
+        self.__idle_flusher = None  # setup by connect()
         self.__cluster = None  # setup by connect()
         self.__lazy_statements = None  # setup by connect()
         self.__default_timeout = default_timeout
         self.__insert_metrics_statement = None  # setup by connect()
         self.__select_metric_statement = None  # setup by connect()
+        self.__scan_metrics_statement = None  # setup by connect()
+        self.__scan_directories_statement = None  # setup by connect()
         self.__session = None  # setup by connect()
 
     def connect(self, skip_schema_upgrade=False):
@@ -270,15 +565,20 @@ class _CassandraAccessor(bg_accessor.Accessor):
         self.__cluster = c_cluster.Cluster(
             self.contact_points, self.port, executor_threads=executor_threads,
         )
-        self.__cluster.connection_class = _CappedConnection  # Limits in flight requests
+        # Limits in flight requests
+        self.__cluster.connection_class = _connection_class(self.__connection)
         self.__cluster.row_factory = c_query.tuple_factory  # Saves 2% CPU
         self.__session = self.__cluster.connect()
         if self.__default_timeout:
             self.__session.default_timeout = self.__default_timeout
+        self.__lazy_statements = _LazyPreparedStatements(
+            self.__session, self.keyspace, self.compaction_strategy)
         if not skip_schema_upgrade:
             self._upgrade_schema()
-
-        self.__lazy_statements = _LazyPreparedStatements(self.__session, self.keyspace)
+        if self.__downsampler_max_idle:
+            self.__idle_flusher = _downsampling.IdleFlusher(
+                self.__downsampler, self.__downsampler_max_idle)
+            self.__idle_flusher.start()
 
         # Metadata (metrics and directories)
         components_names = ", ".join("component_%d" % n for n in range(_COMPONENTS_MAX_LEN))
@@ -294,6 +594,14 @@ class _CassandraAccessor(bg_accessor.Accessor):
         self.__select_metric_statement = self.__session.prepare(
             "SELECT config FROM \"%s\".metrics WHERE name = ?;" % self.keyspace_metadata
         )
+        self.__scan_metrics_statement = self.__session.prepare(
+            "SELECT name, config FROM \"%s\".metrics"
+            " WHERE token(name) > ? AND token(name) <= ?;" % self.keyspace_metadata
+        )
+        self.__scan_directories_statement = self.__session.prepare(
+            "SELECT name FROM \"%s\".directories"
+            " WHERE token(name) > ? AND token(name) <= ?;" % self.keyspace_metadata
+        )
 
         self.is_connected = True
 
@@ -351,10 +659,10 @@ class _CassandraAccessor(bg_accessor.Accessor):
             for table in tables:
                 self.__session.execute("TRUNCATE \"%s\".\"%s\";" % (keyspace, table))
 
-    def fetch_points(self, metric, time_start, time_end, stage):
+    def fetch_points(self, metric, time_start, time_end, stage, aggregator=None, step=None):
         """See bg_accessor.Accessor."""
         super(_CassandraAccessor, self).fetch_points(
-            metric, time_start, time_end, stage)
+            metric, time_start, time_end, stage, aggregator, step)
 
         logging.debug(
             "fetch: [%s, start=%d, end=%d, stage=%s]",
@@ -373,8 +681,9 @@ class _CassandraAccessor(bg_accessor.Accessor):
             concurrency=self.__concurrency,
             results_generator=True,
         )
+        step_ms = step * 1000 if step else None
         return bg_accessor.PointGrouper(
-            metric, time_start_ms, time_end_ms, stage, query_results)
+            metric, time_start_ms, time_end_ms, stage, query_results, aggregator, step_ms)
 
     def _fetch_points_make_selects(self, metric_name, time_start_ms,
                                    time_end_ms, stage):
@@ -412,6 +721,31 @@ class _CassandraAccessor(bg_accessor.Accessor):
         return bg_accessor.Metric(
             metric_name, bg_accessor.MetricMetadata.from_string_dict(config))
 
+    def get_metrics(self, metric_names):
+        """See bg_accessor.Accessor."""
+        super(_CassandraAccessor, self).get_metrics([])
+        metric_names = [bg_accessor.encode_metric_name(name) for name in metric_names]
+        statements_and_args = [
+            (self.__select_metric_statement, (metric_name, )) for metric_name in metric_names
+        ]
+        query_results = c_concurrent.execute_concurrent(
+            self.__session,
+            statements_and_args,
+            concurrency=self.__concurrency,
+            raise_on_first_error=False,
+        )
+        metrics = []
+        for metric_name, (success, rows_or_exception) in zip(metric_names, query_results):
+            if not success:
+                raise RetryableCassandraError(rows_or_exception)
+            rows = list(rows_or_exception)
+            if not rows:
+                metrics.append(None)
+                continue
+            metrics.append(bg_accessor.Metric(
+                metric_name, bg_accessor.MetricMetadata.from_string_dict(rows[0][0])))
+        return metrics
+
     def glob_directory_names(self, glob):
         """Return a sorted list of metric directories matching this glob."""
         super(_CassandraAccessor, self).glob_directory_names(glob)
@@ -448,6 +782,58 @@ class _CassandraAccessor(bg_accessor.Accessor):
         metrics_names.sort()
         return metrics_names
 
+    @property
+    def in_flight_writes(self):
+        """The number of insert statements waiting for a reply."""
+        return self.__write_window.in_flight
+
+    @property
+    def dropped_writes(self):
+        """The number of insert statements dropped because of max_in_flight_writes."""
+        return self.__write_window.dropped_count
+
+    def iter_all_directories(self, ranges=None):
+        """See bg_accessor.Accessor."""
+        super(_CassandraAccessor, self).iter_all_directories(ranges)
+        for row in self.__scan(self.__scan_directories_statement, ranges):
+            yield row[0]
+
+    def iter_all_metrics(self, ranges=None):
+        """See bg_accessor.Accessor."""
+        super(_CassandraAccessor, self).iter_all_metrics(ranges)
+        for name, config in self.__scan(self.__scan_metrics_statement, ranges):
+            if not config:
+                # Partially written row, get_metric() would also ignore it.
+                continue
+            yield bg_accessor.Metric(name, bg_accessor.MetricMetadata.from_string_dict(config))
+
+    def scan_ranges(self, count):
+        """See bg_accessor.Accessor.
+
+        Ranges are (start, end) tuples describing token ranges, start is excluded.
+        """
+        super(_CassandraAccessor, self).scan_ranges(count)
+        return _split_token_ring(count)
+
+    def __scan(self, statement, ranges):
+        """Yield the rows of statement for each range, scanning ranges concurrently."""
+        if ranges is None:
+            ranges = self.scan_ranges(_DEFAULT_SCAN_RANGES)
+        statements_and_args = [(statement, token_range) for token_range in ranges]
+        try:
+            query_results = c_concurrent.execute_concurrent(
+                self.__session,
+                statements_and_args,
+                concurrency=self.__concurrency,
+                results_generator=True,
+            )
+            # Following pages of a given range are fetched while iterating.
+            for unused_success, rows in query_results:
+                for row in rows:
+                    yield row
+        except Exception as e:
+            raise RetryableCassandraError(e)
+
     def insert_points_async(self, metric, datapoints, on_done=None):
         """See bg_accessor.Accessor.
 
@@ -461,35 +847,132 @@ class _CassandraAccessor(bg_accessor.Accessor):
 
         logging.debug("insert: [%s, %s]", metric.name, datapoints)
 
+        if self.__downsampler_checkpoint and not self.__checkpoint_loaded:
+            self.__load_checkpoint()
         downsampled = self.__downsampler.feed(metric, datapoints)
-        if not downsampled and on_done:
-            on_done(None)
+        self.__insert_downsampled_points(metric, downsampled, on_done)
+
+    def insert_points_batch_async(self, metrics_and_datapoints, on_done=None):
+        """See bg_accessor.Accessor.
+
+        The write window is acquired once and on_done is shared by all points.
+        """
+        super(_CassandraAccessor, self).insert_points_batch_async([])
+        if self.__downsampler_checkpoint and not self.__checkpoint_loaded:
+            self.__load_checkpoint()
+        self.__insert_downsampled_batch(
+            self.__downsampler.feed_batch(metrics_and_datapoints), on_done)
+
+    def __load_checkpoint(self):
+        with self.__checkpoint_lock:
+            if self.__checkpoint_loaded:
+                return
+            # Only tried once, an invalid checkpoint is replaced by the next one.
+            self.__checkpoint_loaded = True
+            try:
+                self.__downsampler.load(self.__downsampler_checkpoint)
+            except _downsampling.CheckpointError:
+                logging.exception("Ignoring downsampler checkpoint")
+
+    def __insert_downsampled_points(self, metric, downsampled, on_done=None):
+        """Insert points produced by the downsampler.
+
+        Args:
+          metric: The metric definition as per get_metric.
+          downsampled: A list of (timestamp, value, count, stage), optionally followed by
+            a dict associating extra columns to their values.
+          on_done(e: Exception): called on done, with an exception or None if succesfull
+        """
+        self.__insert_downsampled_batch([(metric, downsampled)], on_done)
+
+    def __insert_evicted_points(self, metric, downsampled):
+        """Insert points of a metric evicted from the downsampler, logging errors.
+
+        Evictions are not caused by the write they happen during, if any: idle metrics
+        are evicted by a background thread. Their errors are thus not reported to writers.
+        """
+        def on_done(e):
+            if e:
+                logging.error("Failed to write evicted points of %s: %s", metric.name, e)
+
+        self.__insert_downsampled_points(metric, downsampled, on_done)
+
+    def __insert_downsampled_batch(self, metrics_and_downsampled, on_done=None):
+        """Insert points produced by the downsampler for several metrics.
+
+        Args:
+          metrics_and_downsampled: A list of (metric, downsampled), as arguments of
+            __insert_downsampled_points().
+          on_done(e: Exception): called once all points are written, with an exception or
+            None if succesfull
+        """
+        points_count = sum(len(downsampled) for _, downsampled in metrics_and_downsampled)
+        if not points_count:
+            if on_done:
+                on_done(None)
+            return
+
+        if not self.__write_window.acquire(points_count):
+            if on_done:
+                if len(metrics_and_downsampled) == 1:
+                    what = metrics_and_downsampled[0][0].name
+                else:
+                    what = "%d metrics" % len(metrics_and_downsampled)
+                on_done(TooManyInFlightWrites("%s: dropped %d points" % (what, points_count)))
             return
 
         count_down = None
         if on_done:
-            count_down = _utils.CountDown(count=len(downsampled), on_zero=on_done)
-
-        for timestamp, value, count, stage in downsampled:
-            timestamp_ms = int(timestamp) * 1000
-            time_offset_ms = timestamp_ms % _ROW_SIZE_MS
-            time_start_ms = timestamp_ms - time_offset_ms
-
-            statement, args = self.__lazy_statements.prepare_insert(
-                stage=stage, metric_name=metric.name, time_start_ms=time_start_ms,
-                time_offset_ms=time_offset_ms, value=value, count=count,
-            )
-            future = self.__session.execute_async(query=statement, parameters=args)
-            if count_down:
+            count_down = _utils.CountDown(count=points_count, on_zero=on_done)
+
+        executed = 0
+        for metric, downsampled in metrics_and_downsampled:
+            for point in downsampled:
+                try:
+                    future = self.__execute_insert(metric, point)
+                except Exception:
+                    # Statements from this one onward will never complete.
+                    self.__write_window.release(points_count - executed)
+                    raise
+                executed += 1
+                # Registered first so that the window is released when on_done is called.
                 future.add_callbacks(
-                    count_down.on_cassandra_result,
-                    count_down.on_cassandra_failure,
+                    self.__write_window.on_cassandra_result,
+                    self.__write_window.on_cassandra_failure,
                 )
+                if count_down:
+                    future.add_callbacks(
+                        count_down.on_cassandra_result,
+                        count_down.on_cassandra_failure,
+                    )
+
+    def __execute_insert(self, metric, point):
+        """Start the insertion of a point produced by the downsampler, return its future."""
+        timestamp, value, count, stage = point[:4]
+        extras = point[4] if len(point) > 4 else None
+        timestamp_ms = int(timestamp) * 1000
+        time_offset_ms = timestamp_ms % _ROW_SIZE_MS
+        time_start_ms = timestamp_ms - time_offset_ms
+        statement, args = self.__lazy_statements.prepare_insert(
+            stage=stage, metric_name=metric.name, time_start_ms=time_start_ms,
+            time_offset_ms=time_offset_ms, value=value, count=count, extras=extras,
+        )
+        return self.__session.execute_async(query=statement, parameters=args)
+
+    def checkpoint(self):
+        """See bg_accessor.Accessor."""
+        super(_CassandraAccessor, self).checkpoint()
+        if self.__checkpoint_loaded:
+            self.__downsampler.save(self.__downsampler_checkpoint)
 
     def shutdown(self):
         """See bg_accessor.Accessor."""
         super(_CassandraAccessor, self).shutdown()
         if self.is_connected:
+            if self.__idle_flusher:
+                self.__idle_flusher.stop()
+                self.__idle_flusher = None
+            self.checkpoint()
             try:
                 self.__cluster.shutdown()
             except Exception as exc:
@@ -498,6 +981,21 @@ class _CassandraAccessor(bg_accessor.Accessor):
             self.is_connected = False
 
     def _upgrade_schema(self):
+        self.__upgrade_metadata_schema()
+
+    def upgrade_datapoints_tables(self):
+        """Migrate existing datapoints tables to the layout of this accessor.
+
+        Tables get the compaction strategy of the accessor if their schema version is
+        older, and the columns added since they were created. connect() does not do it
+        as every process would alter every table, run bg-upgrade-schema once instead.
+        Until then, accessors neither read nor write the missing columns.
+        """
+        self._check_connected()
+        # Datapoints tables are created on demand, only existing ones may need an upgrade.
+        self.__lazy_statements.upgrade_datapoints_tables()
+
+    def __upgrade_metadata_schema(self):
         # Currently no change, so only upgrade operation is to setup
         try:
             self.__session.execute("SELECT name FROM directories LIMIT 1;")
@@ -516,5 +1014,23 @@ def connect(*args, **kwargs):
       contact_points: list of strings, the hostnames or IP to use to discover Cassandra.
       port: The port to connect to, as an int.
       concurrency: How many worker threads to use.
+      default_timeout: Default timeout for synchronous queries, in seconds.
+      compaction_strategy: Compaction strategy of datapoints tables, one of
+        DATE_TIERED_COMPACTION (the default) or TIME_WINDOW_COMPACTION.
+      max_in_flight_writes: Maximum number of insert statements waiting for a reply.
+      write_window_policy: What to do with writes past max_in_flight_writes, one of
+        WRITE_WINDOW_BLOCK (the default), WRITE_WINDOW_DROP or WRITE_WINDOW_CALLBACK.
+      on_write_capacity: With WRITE_WINDOW_CALLBACK, called when writes can be sent again.
+      downsampler_max_metrics: Maximum number of metrics to keep downsampling aggregates for.
+      downsampler_checkpoint: Path of a file in which to keep downsampling aggregates across
+        restarts.
+      downsampler_max_idle: Number of seconds after which the downsampling aggregates of a
+        metric that is not written anymore are written and dropped.
+      downsampler_open_buckets_interval: Minimum number of seconds between two writes of
+        points whose buckets are still open, None to only write closed buckets.
+      downsampler_all_aggregates: Whether downsampled points also store the minimum,
+        maximum and total of their values.
+      connection: Event loop of connections, CONNECTION_ASYNCORE (the default) or
+        CONNECTION_TWISTED.
     """
     return _CassandraAccessor(*args, **kwargs)
@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Stores timeseries on the local disk, for single node setups and benchmarks.
+
+Metadata (metrics and directories) are stored in lmdb, like the metadata cache, so that
+they can be shared by multiple processes.
+Points are stored in one file per metric, made of one fixed-size archive per retention
+stage (similar to whisper files). Files are mmap()ed and accesses are serialized across
+processes with flock().
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import errno
+import fcntl
+import fnmatch
+import logging
+import mmap
+import os
+from os import path as os_path
+import re
+import shutil
+import struct
+import sys
+import urllib
+
+import lmdb
+
+from biggraphite import accessor as bg_accessor
+from biggraphite.drivers import _downsampling
+
+
+class Error(bg_accessor.Error):
+    """Base class for all exceptions from this module."""
+
+
+class TooManyMetrics(Error):
+    """A name glob yielded more than Accessor.MAX_METRIC_PER_GLOB metrics."""
+
+
+class InvalidArgumentError(Error, bg_accessor.InvalidArgumentError):
+    """Callee did not follow requirements on the arguments."""
+
+
+# Archives start with: magic, format version, number of stages.
+_HEADER = struct.Struct("<4sII")
+_HEADER_MAGIC = "BGLA"
+_HEADER_VERSION = 1
+# Followed by, for each stage: points, precision.
+_STAGE_HEADER = struct.Struct("<II")
+# Followed by, for each stage, stage.points slots of: timestamp, value, count.
+# A slot with a count of 0 is empty.
+_SLOT = struct.Struct("<qdi")
+
+_ARCHIVE_SUFFIX = ".bgl"
+# Used in archive paths in place of empty components, which urllib.quote() never returns.
+_EMPTY_COMPONENT = "%"
+
+# Characters with a special meaning in fnmatch patterns.
+_GLOB_CHARS_RE = re.compile(r"[*?\[]")
+
+# Scans copy that many entries per read transaction, so that they do not keep old
+# pages of the database alive for too long.
+_SCAN_BATCH_SIZE = 1000
+# Scan ranges split the key space on the first two bytes of the names.
+_SCAN_PREFIX = struct.Struct(">H")
+_SCAN_PREFIX_COUNT = 2 ** 16
+
+
+class _Archive(object):
+    """The points of a metric, stored in a memory-mapped file.
+
+    Not thread-safe, but safe to share between processes.
+    """
+
+    __slots__ = ("_fd", "_header", "_mmap", "_size", "_stage_to_offset", "retention",
+                 "writable", )
+
+    def __init__(self, path, retention, writable=False):
+        """Open the archive at path for a given retention.
+
+        Read-only archives never modify the file, which reads as empty as long as it does
+        not match the retention (e.g. the metric was re-created with another retention
+        and not written since). Writable archives create the file if needed, and reset
+        it if it does not match the retention.
+
+        Raises:
+          OSError: if the archive is read-only and the file does not exist.
+        """
+        self.retention = retention
+        self.writable = writable
+        self._stage_to_offset = {}
+        size = _HEADER.size + _STAGE_HEADER.size * len(retention.stages)
+        for stage in retention.stages:
+            self._stage_to_offset[stage] = size
+            size += _SLOT.size * stage.points
+        self._size = size
+
+        self._header = _HEADER.pack(_HEADER_MAGIC, _HEADER_VERSION, len(retention.stages))
+        self._header += "".join(
+            _STAGE_HEADER.pack(s.points, s.precision) for s in retention.stages)
+
+        self._mmap = None
+        if not writable:
+            # Mapped by read() once the file matches the retention.
+            self._fd = os.open(path, os.O_RDONLY)
+            return
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if not self._matches():
+                    # New file, or the metric was re-created with another retention.
+                    self._reset()
+                self._mmap = mmap.mmap(self._fd, size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def close(self):
+        """Release the file, safe to call multiple times."""
+        if self._fd is not None:
+            if self._mmap is not None:
+                self._mmap.close()
+            os.close(self._fd)
+            self._fd = None
+
+    def _matches(self):
+        """Return whether the file has the layout of the retention, call it locked.
+
+        Another process may have reset the file since it was opened, mapped pages past
+        its end must then not be touched.
+        """
+        if os.fstat(self._fd).st_size != self._size:
+            return False
+        if self._mmap is not None:
+            return self._mmap[:len(self._header)] == self._header
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        return os.read(self._fd, len(self._header)) == self._header
+
+    def _reset(self):
+        """Drop all points and write the header of the retention, call it locked."""
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, self._size)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, self._header)
+
+    def read(self, stage, time_start, time_end):
+        """Return the points of a stage in [time_start, time_end[ as a list of rows.
+
+        Rows are (timestamp_ms, 0, value, count) as expected by PointGrouper.
+        """
+        offset = self._stage_to_offset.get(stage)
+        if offset is None:
+            return []
+        res = []
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
+        try:
+            if not self._matches():
+                return res
+            if self._mmap is None:
+                self._mmap = mmap.mmap(self._fd, self._size, access=mmap.ACCESS_READ)
+            for step in xrange(stage.step(time_start), stage.step(time_end)):
+                slot_offset = offset + (step % stage.points) * _SLOT.size
+                timestamp, value, count = _SLOT.unpack_from(self._mmap, slot_offset)
+                if count and timestamp == step * stage.precision:
+                    res.append((timestamp * 1000, 0, value, count))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return res
+
+    def write(self, points):
+        """Write downsampled points, the archive must be writable.
+
+        Args:
+          points: An iterable of (timestamp, value, count, stage), sketches of percentile
+            aggregators that may follow are not stored.
+        """
+        assert self.writable
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if not self._matches():
+                # Reset by a process writing with another retention.
+                self._reset()
+            for point in points:
+                timestamp, value, count, stage = point[:4]
+                offset = self._stage_to_offset[stage]
+                step = stage.step(timestamp)
+                slot_offset = offset + (step % stage.points) * _SLOT.size
+                _SLOT.pack_into(self._mmap, slot_offset, step * stage.precision, value, count)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class _LocalAccessor(bg_accessor.Accessor):
+    """Provides Read/Write accessors to a directory on the local disk.
+
+    Please refer to bg_accessor.Accessor.
+    """
+
+    # Maximum number of concurrent readers of the metadata, see metadata_cache.DiskCache.
+    _MAX_READERS = 2048
+    # Each open archive uses one file descriptor.
+    _MAX_OPEN_ARCHIVES = 1024
+
+    def __init__(self, path, downsampler_max_metrics=None, downsampler_checkpoint=None,
+                 downsampler_max_idle=None):
+        """Record parameters needed to connect.
+
+        Args:
+          path: The directory in which to store data, it is created if needed.
+          downsampler_max_metrics: Maximum number of metrics to keep downsampling aggregates
+            for, the partial aggregates of least recently written ones are written and
+            dropped. None for no limit.
+          downsampler_checkpoint: Path of a file in which to keep downsampling aggregates
+            across restarts, None to not keep them. It is loaded by the first write and
+            written by checkpoint() and shutdown() once loaded, so that processes that
+            only read never touch it. Processes writing concurrently must each have
+            their own.
+          downsampler_max_idle: Number of seconds after which the downsampling aggregates of
+            a metric that is not written anymore are written and dropped, None to keep
+            them until evicted or shutdown. There is no background thread, idle metrics
+            are looked for by writes.
+        """
+        path = os_path.abspath(path)
+        super(_LocalAccessor, self).__init__("local:" + path)
+        self.path = path
+        self.__metadata_path = os_path.join(path, "metadata")
+        self.__points_path = os_path.join(path, "points")
+        self.__checkpoint_path = downsampler_checkpoint
+        self.__checkpoint_loaded = False
+        self.__downsampler_max_idle = downsampler_max_idle
+        self.__downsampler = _downsampling.Downsampler(
+            max_metrics=downsampler_max_metrics, on_evict=self.__write_downsampled_points)
+        self.__env = None  # setup by connect()
+        self.__metrics_db = None  # setup by connect()
+        self.__directories_db = None  # setup by connect()
+        # Least recently used archives come first.
+        self.__archives = collections.OrderedDict()
+
+    def connect(self, skip_schema_upgrade=False):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).connect(skip_schema_upgrade=skip_schema_upgrade)
+        if self.is_connected:
+            return
+        for directory in self.__metadata_path, self.__points_path:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # Directory already exists
+        map_size = 1024*1024*1024  # 1G on 32 bits systems
+        if sys.maxsize > 2**32:
+            map_size *= 16  # 16G on 64 bits systems
+        self.__env = lmdb.open(
+            self.__metadata_path,
+            map_size=map_size,
+            metasync=False,
+            writemap=True,
+            max_readers=self._MAX_READERS,
+            max_dbs=4,
+        )
+        self.__metrics_db = self.__env.open_db("metrics")
+        self.__directories_db = self.__env.open_db("directories")
+        self.is_connected = True
+
+    def checkpoint(self):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).checkpoint()
+        if self.__checkpoint_loaded:
+            self.__downsampler.save(self.__checkpoint_path)
+
+    def create_metric(self, metric):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).create_metric(metric)
+        with self.__env.begin(write=True) as txn:
+            directory_path = []
+            for component in metric.name.split(".")[:-1]:
+                directory_path.append(component)
+                txn.put(".".join(directory_path), "", db=self.__directories_db)
+            txn.put(metric.name, metric.metadata.as_json(), db=self.__metrics_db)
+
+    def drop_all_metrics(self):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).drop_all_metrics()
+        with self.__env.begin(write=True) as txn:
+            txn.drop(self.__metrics_db, delete=False)
+            txn.drop(self.__directories_db, delete=False)
+        self.__close_archives()
+        shutil.rmtree(self.__points_path, ignore_errors=True)
+        os.makedirs(self.__points_path)
+
+    def fetch_points(self, metric, time_start, time_end, stage, aggregator=None, step=None):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).fetch_points(
+            metric, time_start, time_end, stage, aggregator, step)
+        logging.debug(
+            "fetch: [%s, start=%d, end=%d, stage=%s]",
+            metric.name, time_start, time_end, stage)
+
+        rows = []
+        archive = self.__get_archive(metric)
+        if archive is not None:
+            rows = archive.read(stage, time_start, time_end)
+        query_results = [(True, rows)]
+
+        time_start_ms = int(time_start) * 1000
+        time_end_ms = int(time_end) * 1000
+        step_ms = step * 1000 if step else None
+        return bg_accessor.PointGrouper(
+            metric, time_start_ms, time_end_ms, stage, query_results, aggregator, step_ms)
+
+    def get_metric(self, metric_name):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).get_metric(metric_name)
+        metric_name = bg_accessor.encode_metric_name(metric_name)
+        with self.__env.begin(self.__metrics_db, write=False) as txn:
+            metadata_str = txn.get(metric_name)
+        if not metadata_str:
+            return None
+        return bg_accessor.Metric(
+            metric_name, bg_accessor.MetricMetadata.from_json(metadata_str))
+
+    def glob_directory_names(self, glob):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).glob_directory_names(glob)
+        return self.__glob_names(self.__directories_db, glob)
+
+    def glob_metric_names(self, glob):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).glob_metric_names(glob)
+        return self.__glob_names(self.__metrics_db, glob)
+
+    def __glob_names(self, db, glob):
+        glob = bg_accessor.encode_metric_name(glob)
+        components = glob.split(".")
+        # Names are sorted, so we only look at the ones sharing the literal prefix.
+        prefix_components = []
+        for component in components:
+            if _GLOB_CHARS_RE.search(component):
+                break
+            prefix_components.append(component)
+        if len(prefix_components) == len(components):
+            prefix = glob
+        else:
+            prefix = ".".join(prefix_components + [""])
+        dots_count = glob.count(".")
+        glob_re = re.compile(fnmatch.translate(glob))
+
+        res = []
+        with self.__env.begin(db, write=False) as txn:
+            cursor = txn.cursor()
+            if not cursor.set_range(prefix):
+                return res
+            for name in cursor.iternext(keys=True, values=False):
+                if not name.startswith(prefix):
+                    break
+                # "*" can match dots for fnmatch
+                if name.count(".") == dots_count and glob_re.match(name):
+                    res.append(name)
+                    if len(res) > self.MAX_METRIC_PER_GLOB:
+                        msg = "%s yields more than %d results" % (glob, self.MAX_METRIC_PER_GLOB)
+                        raise TooManyMetrics(msg)
+        return res
+
+    def insert_points_async(self, metric, datapoints, on_done=None):
+        """See bg_accessor.Accessor.
+
+        Points are written synchronously, on_done is called before returning.
+        """
+        super(_LocalAccessor, self).insert_points_async(metric, datapoints, on_done)
+        logging.debug("insert: [%s, %s]", metric.name, datapoints)
+        try:
+            if self.__checkpoint_path and not self.__checkpoint_loaded:
+                self.__load_checkpoint()
+            if self.__downsampler_max_idle is not None:
+                self.__downsampler.flush_idle(self.__downsampler_max_idle)
+            downsampled = self.__downsampler.feed(metric, datapoints)
+            self.__write_downsampled_points(metric, downsampled)
+        except Exception as e:
+            if not on_done:
+                raise
+            on_done(Error(e))
+            return
+        if on_done:
+            on_done(None)
+
+    def __load_checkpoint(self):
+        # Only tried once, an invalid checkpoint is replaced by the next one.
+        self.__checkpoint_loaded = True
+        try:
+            self.__downsampler.load(self.__checkpoint_path)
+        except _downsampling.CheckpointError:
+            logging.exception("Ignoring downsampler checkpoint")
+
+    def __write_downsampled_points(self, metric, downsampled):
+        if downsampled:
+            self.__get_archive(metric, writable=True).write(downsampled)
+
+    def iter_all_directories(self, ranges=None):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).iter_all_directories(ranges)
+        for name, _ in self.__scan(self.__directories_db, ranges):
+            yield name
+
+    def iter_all_metrics(self, ranges=None):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).iter_all_metrics(ranges)
+        for name, metadata_str in self.__scan(self.__metrics_db, ranges):
+            yield bg_accessor.Metric(name, bg_accessor.MetricMetadata.from_json(metadata_str))
+
+    def scan_ranges(self, count):
+        """See bg_accessor.Accessor.
+
+        Ranges are (start, end) tuples of names, start is included and end excluded.
+        None means unbounded.
+        """
+        super(_LocalAccessor, self).scan_ranges(count)
+        bounds = [None]
+        for n in xrange(1, count):
+            bounds.append(_SCAN_PREFIX.pack(n * _SCAN_PREFIX_COUNT // count))
+        bounds.append(None)
+        return zip(bounds[:-1], bounds[1:])
+
+    def __scan(self, db, ranges):
+        if ranges is None:
+            ranges = self.scan_ranges(1)
+        for start, end in ranges:
+            resume_from = start or ""
+            last_key = None
+            while True:
+                batch = []
+                with self.__env.begin(db, write=False) as txn:
+                    cursor = txn.cursor()
+                    if cursor.set_range(resume_from):
+                        for key, value in cursor.iternext():
+                            if key == last_key:
+                                continue  # Returned by the previous batch.
+                            if end is not None and key >= end:
+                                break
+                            batch.append((key, value))
+                            if len(batch) >= _SCAN_BATCH_SIZE:
+                                break
+                for key_and_value in batch:
+                    yield key_and_value
+                if len(batch) < _SCAN_BATCH_SIZE:
+                    break
+                resume_from = last_key = batch[-1][0]
+
+    def _archive_path(self, metric_name):
+        """Return the path of the archive of a metric, it may not exist."""
+        components = [
+            urllib.quote(c, safe="") or _EMPTY_COMPONENT
+            for c in metric_name.split(".")
+        ]
+        return os_path.join(self.__points_path, *components) + _ARCHIVE_SUFFIX
+
+    def __get_archive(self, metric, writable=False):
+        """Return the archive of a metric, None if it is read-only and does not exist."""
+        archive = self.__archives.pop(metric.name, None)
+        if archive is not None and (archive.retention != metric.metadata.retention or
+                                    writable and not archive.writable):
+            # The metric was re-created with another retention, or is now written.
+            archive.close()
+            archive = None
+        if archive is None:
+            path = self._archive_path(metric.name)
+            if writable:
+                try:
+                    os.makedirs(os_path.dirname(path))
+                except OSError:
+                    pass  # Directory already exists
+            try:
+                archive = _Archive(path, metric.metadata.retention, writable)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return None
+            if len(self.__archives) >= self._MAX_OPEN_ARCHIVES:
+                _, oldest = self.__archives.popitem(last=False)
+                oldest.close()
+        # Re-inserting makes it the most recently used.
+        self.__archives[metric.name] = archive
+        return archive
+
+    def __close_archives(self):
+        for archive in self.__archives.itervalues():
+            archive.close()
+        self.__archives.clear()
+
+    def shutdown(self):
+        """See bg_accessor.Accessor."""
+        super(_LocalAccessor, self).shutdown()
+        if self.is_connected:
+            self.checkpoint()
+            self.__close_archives()
+            self.__env.close()
+            self.__env = None
+            self.is_connected = False
+
+
+def connect(*args, **kwargs):
+    """Return a bg_accessor.Accessor storing data on the local disk.
+
+    Args:
+      path: The directory in which to store data, it is created if needed.
+      downsampler_max_metrics: Maximum number of metrics to keep downsampling aggregates for.
+      downsampler_checkpoint: Path of a file in which to keep downsampling aggregates
+        across restarts, None to not keep them.
+      downsampler_max_idle: Number of seconds after which the downsampling aggregates of a
+        metric that is not written anymore are written by the next write.
+    """
+    return _LocalAccessor(*args, **kwargs)
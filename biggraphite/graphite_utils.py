@@ -19,10 +19,15 @@ from os import path as os_path
 import re
 
 from biggraphite.drivers import cassandra as bg_cassandra
+from biggraphite.drivers import local as bg_local
 
 # http://graphite.readthedocs.io/en/latest/render_api.html#paths-and-wildcards
 _GRAPHITE_GLOB_RE = re.compile(r"^[^*?{}\[\]]+$")
 
+# Default bounds of batches of writes, see write_batch_from_settings().
+DEFAULT_WRITE_BATCH_POINTS = 1000
+DEFAULT_WRITE_BATCH_DELAY_MS = 100
+
 
 class Error(Exception):
     """Base class for all exceptions from this module."""
@@ -43,22 +48,162 @@ def _get_setting(settings, name, optional=False):
     return res
 
 
-def accessor_from_settings(settings):
+# Values of boolean settings, as Carbon only parses "True" and "False" into booleans.
+_BOOLEANS = {
+    "true": True, "yes": True, "on": True, "1": True,
+    "false": False, "no": False, "off": False, "0": False,
+}
+
+
+def _get_bool_setting(settings, name):
+    """Return a boolean setting, False if not set.
+
+    Raises:
+      ConfigError: if the value is not a boolean.
+    """
+    res = _get_setting(settings, name, optional=True)
+    if res is None:
+        return False
+    if isinstance(res, bool):
+        return res
+    value = str(res).strip().lower()
+    if value not in _BOOLEANS:
+        raise ConfigError("%s is set to a non boolean value: '%s'" % (name, res))
+    return _BOOLEANS[value]
+
+
+def accessor_from_settings(settings, writer_index=None):
     """Get Accessor from configuration.
 
     Args:
       settings: either carbon_conf.Settings or a Django-like settings object
+      writer_index: Index of the writer process the accessor is for, if any, so that
+        each writer keeps its own downsampling aggregates. See writer_pool.
 
     Returns:
-      Cassandra accessor (not connected)
+      Cassandra accessor (not connected), or a local accessor if BG_DRIVER is "local".
     """
+    kwargs = {}
+    downsampler_max_metrics = _get_setting(
+        settings, "BG_DOWNSAMPLER_MAX_METRICS", optional=True)
+    if downsampler_max_metrics is not None:
+        kwargs["downsampler_max_metrics"] = int(downsampler_max_metrics)
+    downsampler_checkpoint = _get_setting(settings, "BG_DOWNSAMPLER_CHECKPOINT", optional=True)
+    if downsampler_checkpoint:
+        if writer_index is not None:
+            downsampler_checkpoint += ".%d" % writer_index
+        kwargs["downsampler_checkpoint"] = downsampler_checkpoint
+    downsampler_max_idle = _get_setting(settings, "BG_DOWNSAMPLER_MAX_IDLE", optional=True)
+    if downsampler_max_idle is not None:
+        kwargs["downsampler_max_idle"] = float(downsampler_max_idle)
+
+    driver = _get_setting(settings, "BG_DRIVER", optional=True) or "cassandra"
+    if driver == "local":
+        path = _get_setting(settings, "BG_LOCAL_PATH", optional=True)
+        if not path:
+            path = os_path.join(storage_path_from_settings(settings), "biggraphite", "local")
+        return bg_local.connect(path, **kwargs)
+    elif driver != "cassandra":
+        raise ConfigError("BG_DRIVER is set to an unknown driver: '%s'" % driver)
+
     keyspace = _get_setting(settings, "BG_KEYSPACE")
     contact_points_str = _get_setting(settings, "BG_CONTACT_POINTS")
     port = _get_setting(settings, "BG_PORT", optional=True)
     if port is not None:
         port = int(port)
+    compaction_strategy = _get_setting(settings, "BG_COMPACTION_STRATEGY", optional=True)
+    max_in_flight_writes = _get_setting(settings, "BG_MAX_IN_FLIGHT_WRITES", optional=True)
+    if max_in_flight_writes is not None:
+        kwargs["max_in_flight_writes"] = int(max_in_flight_writes)
+    open_buckets_interval = _get_setting(
+        settings, "BG_DOWNSAMPLER_OPEN_BUCKETS_INTERVAL", optional=True)
+    if open_buckets_interval is not None:
+        # A negative interval means that open buckets are never written.
+        open_buckets_interval = float(open_buckets_interval)
+        if open_buckets_interval < 0:
+            open_buckets_interval = None
+        kwargs["downsampler_open_buckets_interval"] = open_buckets_interval
+    if _get_bool_setting(settings, "BG_DOWNSAMPLER_ALL_AGGREGATES"):
+        kwargs["downsampler_all_aggregates"] = True
+    connection = cassandra_connection_from_settings(settings)
+    if connection:
+        kwargs["connection"] = connection
     contact_points = [s.strip() for s in contact_points_str.split(",")]
-    return bg_cassandra.connect(keyspace, contact_points, port)
+    return bg_cassandra.connect(
+        keyspace, contact_points, port, compaction_strategy=compaction_strategy, **kwargs)
+
+
+def cassandra_connection_from_settings(settings):
+    """Get the event loop of the connections of the Cassandra driver from configuration.
+
+    Args:
+      settings: either carbon_conf.Settings or a Django-like settings object
+
+    Returns:
+      The value of BG_CASSANDRA_CONNECTION, None (the driver's default) if not set.
+    """
+    return _get_setting(settings, "BG_CASSANDRA_CONNECTION", optional=True)
+
+
+def index_max_age_from_settings(settings):
+    """Get the maximum age of the namespace index of the metadata cache from configuration.
+
+    Args:
+      settings: either carbon_conf.Settings or a Django-like settings object
+
+    Returns:
+      A number of seconds, or None if BG_INDEX_MAX_AGE is not set.
+    """
+    index_max_age = _get_setting(settings, "BG_INDEX_MAX_AGE", optional=True)
+    if index_max_age is None:
+        return None
+    return float(index_max_age)
+
+
+def metadata_cache_ttl_from_settings(settings):
+    """Get the TTL of the entries of the metadata cache from configuration.
+
+    Args:
+      settings: either carbon_conf.Settings or a Django-like settings object
+
+    Returns:
+      A number of seconds, or None (no expiration) if BG_METADATA_CACHE_TTL is not set.
+    """
+    ttl = _get_setting(settings, "BG_METADATA_CACHE_TTL", optional=True)
+    if ttl is None:
+        return None
+    return float(ttl)
+
+
+def writer_processes_from_settings(settings):
+    """Get the number of writer processes of the Carbon plugin from configuration.
+
+    Args:
+      settings: either carbon_conf.Settings or a Django-like settings object
+
+    Returns:
+      The value of BG_WRITER_PROCESSES, 0 (write from the Carbon process) if not set.
+    """
+    return int(_get_setting(settings, "BG_WRITER_PROCESSES", optional=True) or 0)
+
+
+def write_batch_from_settings(settings):
+    """Get the bounds of batches of writes of the Carbon plugin from configuration.
+
+    Args:
+      settings: either carbon_conf.Settings or a Django-like settings object
+
+    Returns:
+      A tuple of (maximum number of points, maximum delay in seconds), from
+      BG_WRITE_BATCH_POINTS and BG_WRITE_BATCH_DELAY_MS.
+    """
+    max_points = _get_setting(settings, "BG_WRITE_BATCH_POINTS", optional=True)
+    if max_points is None:
+        max_points = DEFAULT_WRITE_BATCH_POINTS
+    max_delay_ms = _get_setting(settings, "BG_WRITE_BATCH_DELAY_MS", optional=True)
+    if max_delay_ms is None:
+        max_delay_ms = DEFAULT_WRITE_BATCH_DELAY_MS
+    return int(max_points), float(max_delay_ms) / 1000
 
 
 def storage_path_from_settings(settings):
@@ -114,19 +259,28 @@ def _filter_metrics(metrics, glob):
     return sorted(matches)
 
 
-def glob(accessor, graphite_glob):
+def glob(accessor, graphite_glob, metadata_cache=None):
     """Get Cassandra metrics & directories matching a Graphite glob.
 
     Args:
       accessor: Cassandra accessor
       graphite_glob: Graphite glob expression
+      metadata_cache: Optional DiskCache, whose namespace index is used instead of the
+        accessor if it is up to date and has matches. Otherwise, names found by the
+        accessor are added to it.
 
     Returns:
       A tuple:
         First element: sorted list of Cassandra metrics matched by the glob.
         Second element: sorted list of Cassandra directories matched by the glob.
     """
+    if metadata_cache:
+        found = metadata_cache.glob(graphite_glob)
+        if found is not None:
+            return found
     accessor_components = _graphite_glob_to_accessor_components(graphite_glob)
     metrics = _filter_metrics(accessor.glob_metric_names(accessor_components), graphite_glob)
     directories = _filter_metrics(accessor.glob_directory_names(accessor_components), graphite_glob)
+    if metadata_cache:
+        metadata_cache.add_to_index(metrics, directories)
     return (metrics, directories)
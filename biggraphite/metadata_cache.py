@@ -15,26 +15,105 @@
 """Implements the DiskCache for metrics metadata.
 
 The DiskCache is implemented with lmdb, an on-disk file DB that can be accessed
-by multiple processes. Keys are metric names, values are json-serialised metadata.
+by multiple processes. Keys are metric names, values are the time they were written
+followed by json-serialised metadata.
 In deployment the graphite storage dir is used as a rendez-vous point where all processes
 (carbon, graphite, ...) can find the metadata.
+In front of it, each process keeps the most recently used Metric instances in memory, as
+lmdb lookups are frequent enough (once per write) for their cost to show up.
 
-TODO(b.arnould): Currently that cache never expires, as we don't allow for deletion.
+Metrics can be deleted or recreated with other metadata, possibly from other hosts, so
+entries can expire after a TTL (by default they are kept until the cache is removed).
+To avoid reading them again from the accessor one at a time on the write path, entries
+are then refreshed in the background once they are half way through their TTL. As
+entries refreshed by a process are fresh for the others, processes take turns: only the
+first one to wake up in a period refreshes, the others skip it.
+
+Metrics that do not exist are also cached in lmdb, until an expiration time, as lookups
+of absent names (typos, bots, exists() before create()) would otherwise all hit the
+accessor. Creating a metric through any DiskCache removes its entry.
+
+lmdb only allows one writer at a time across processes, so writes are queued and
+committed together by a thread of each process, after at most a small delay. Until
+then, the process that queued them reads them from memory.
+
+Graphite globs are cached too, so that all the workers of a host share the results of
+the two queries they cost. Their keys start with the part of the glob before its first
+wildcard, so that creating a metric only has to remove the few ranges of keys that
+could match it. Metrics created by processes not sharing this cache are only seen once
+the results expire.
+
+Optionally, the cache also indexes the namespace so that globs can be resolved without
+the accessor. Each name is stored under a "parent NUL child" key, which lets a glob be
+resolved component by component with range scans. The metrics tables have no creation
+time to sync from, so metrics created elsewhere are only known to the index after it is
+rebuilt by a full scan, see fill(), or once found by the accessor: globs that match
+nothing in the index fall back to it, and the index is only trusted for a while after
+the last scan.
+
+A new host can be given the cache of a peer with export_snapshot() and
+import_snapshot(), or fill its own with fill(), instead of starting empty.
 """
 
 from __future__ import absolute_import
 from __future__ import print_function
 
+import collections
+import fnmatch
+import gzip
+import logging
 import os
 from os import path as os_path
+import re
+import struct
 import sys
+import tempfile
 import threading
+import time
+import zlib
 
 import lmdb
 
 from biggraphite import accessor as bg_accessor
 
 
+# Values of the absent metrics DB: expiration time, in seconds since the Epoch.
+_ABSENT_EXPIRATION = struct.Struct("<d")
+# Values of the metadata DB start with the time they were written, in seconds since the
+# Epoch.
+_METADATA_WRITE_TIME = struct.Struct("<d")
+
+# Values of the globs DB: expiration time, in seconds since the Epoch, and number of
+# metrics. They are followed by the metrics then the directories, separated by NUL.
+_GLOB_HEADER = struct.Struct("<dI")
+# Separates the literal prefix of a glob from the glob in keys of the globs DB.
+_GLOB_KEY_SEPARATOR = b"\0"
+_GLOB_NAMES_SEPARATOR = b"\0"
+# http://graphite.readthedocs.io/en/latest/render_api.html#paths-and-wildcards
+_GLOB_WILDCARD_RE = re.compile(r"[*?{}\[\]]")
+
+# Values of the namespace DB: whether the name is a metric, a directory or both.
+_NAMESPACE_FLAGS = struct.Struct("<B")
+_NAMESPACE_METRIC = 1
+_NAMESPACE_DIRECTORY = 2
+# Key of the namespace info DB, whose value is the time of the scan it was built from.
+_NAMESPACE_INDEXED_AT_KEY = b"indexed_at"
+_NAMESPACE_INDEXED_AT = struct.Struct("<d")
+
+# Key of the info DB whose value is the time a process last started refreshing entries.
+_INFO_REFRESHED_AT_KEY = b"refreshed_at"
+_INFO_REFRESHED_AT = struct.Struct("<d")
+
+# A snapshot is a gzipped header followed by one entry per metric. Each entry is a
+# header, the name and, the first time a metadata is used, its JSON. Few metadata are in
+# use at a given time, so later entries refer to it by index.
+_SNAPSHOT_MAGIC = b"BGMC"
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct("<4sI")  # magic, version
+_SNAPSHOT_ENTRY = struct.Struct("<IId")  # name len, metadata index, write time
+_SNAPSHOT_METADATA = struct.Struct("<I")  # JSON len
+
+
 class Error(Exception):
     """Base class for all exceptions from this module."""
 
@@ -43,6 +122,104 @@ class InvalidArgumentError(Error):
     """Callee did not follow requirements on the arguments."""
 
 
+class SnapshotError(Error):
+    """A snapshot file could not be read."""
+
+
+def _glob_prefix(glob):
+    """Return the components of glob that all its matches start with, dot-terminated."""
+    prefix = []
+    for component in glob.split(".")[:-1]:
+        if _GLOB_WILDCARD_RE.search(component):
+            break
+        prefix.append(component + ".")
+    return b"".join(prefix)
+
+
+def _glob_key(glob):
+    return _glob_prefix(glob) + _GLOB_KEY_SEPARATOR + glob
+
+
+def _expand_braces(glob):
+    """Return the globs matching the same names as glob, without its first braces.
+
+    Like graphite_utils.glob(), only one pair of braces is supported.
+    """
+    brace_open, brace_close = glob.find("{"), glob.find("}")
+    if brace_open < 0 or brace_close < brace_open:
+        return [glob]
+    return [
+        glob[:brace_open] + variant + glob[brace_close + 1:]
+        for variant in glob[brace_open + 1:brace_close].split(",")
+    ]
+
+
+def _namespace_key(name):
+    parent, _, child = name.rpartition(".")
+    return parent + _GLOB_KEY_SEPARATOR + child
+
+
+class _SecondChanceCache(object):
+    """A size-bounded dict approximating a LRU, without taking a lock on hits.
+
+    Entries are evicted in insertion order, except those read since they were inserted
+    or last considered for eviction: they are given a second chance and moved last.
+    get() only relies on dict lookups and list assignments being atomic.
+    """
+
+    def __init__(self, size):
+        """Create an empty cache of at most size entries."""
+        self.__size = size
+        self.__lock = threading.Lock()
+        # Associates keys to [value, whether it was read].
+        self.__entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """Return the value of key, None if not cached."""
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        entry[1] = True
+        return entry[0]
+
+    def put(self, key, value):
+        """Cache the value of key, evicting an entry if the cache is full."""
+        if not self.__size:
+            return
+        with self.__lock:
+            entries = self.__entries
+            entry = entries.get(key)
+            if entry is not None:
+                entry[0] = value
+                return
+            while len(entries) >= self.__size:
+                old_key, old_entry = entries.popitem(last=False)
+                if old_entry[1]:
+                    old_entry[1] = False
+                    entries[old_key] = old_entry
+            entries[key] = [value, False]
+
+    def clear(self):
+        """Remove all entries."""
+        with self.__lock:
+            self.__entries.clear()
+
+
+class _Lookup(object):
+    """A lookup of a metric in the accessor, which other threads can wait for."""
+
+    __slots__ = ("done", "metric", "exception", )
+
+    def __init__(self):
+        """Create a lookup in progress."""
+        self.done = threading.Event()
+        self.metric = None
+        self.exception = None
+
+
 class DiskCache(object):
     """A metadata cache that can be shared between processes trusting each other.
 
@@ -57,13 +234,82 @@ class DiskCache(object):
     # According to LMDB's author, 128 readers is about 8KiB of RAM, 1024 is about 128kiB and even
     # 4096 is safe: https://twitter.com/armon/status/534867803426533376
     _MAX_READERS = 2048
+    # Default number of Metric kept in memory, a few hundred bytes each.
+    DEFAULT_FRONT_CACHE_SIZE = 100 * 1000
+    # Default number of seconds for which absent metrics are cached.
+    DEFAULT_ABSENT_TTL = 60
+    # Default number of seconds for which metadata are cached, None for no expiration.
+    DEFAULT_TTL = None
+    # Number of metrics refreshed together.
+    _REFRESH_BATCH_SIZE = 1000
+    # Number of metrics written per transaction by fill() and import_snapshot().
+    _FILL_BATCH_SIZE = 10 * 1000
+    # Default number of seconds writes are queued for before being committed.
+    DEFAULT_WRITE_DELAY = 1.0
+    # Default number of seconds for which the results of globs are cached.
+    DEFAULT_GLOB_TTL = 60
+
+    def __init__(self, accessor, path, front_cache_size=DEFAULT_FRONT_CACHE_SIZE,
+                 absent_ttl=DEFAULT_ABSENT_TTL, ttl=DEFAULT_TTL,
+                 write_delay=DEFAULT_WRITE_DELAY, glob_ttl=DEFAULT_GLOB_TTL,
+                 index_max_age=None):
+        """Create a new DiskCache.
 
-    def __init__(self, accessor, path):
-        """Create a new DiskCache."""
+        Args:
+          accessor: The accessor to read metrics from on cache misses.
+          path: The storage directory shared by processes using the cache.
+          front_cache_size: Number of metrics to keep in memory in front of lmdb, 0 to
+            always read lmdb.
+          absent_ttl: Number of seconds for which metrics that do not exist are cached,
+            0 to always ask the accessor.
+          ttl: Number of seconds for which metadata are cached, None to cache them until
+            the cache is removed. Entries are refreshed in the background once half as
+            old by one of the processes sharing the cache, see refresh(). The refresh is
+            skipped for accessors that are not THREAD_SAFE_LOOKUPS, as it would hold the
+            accessor for lookups of the write path.
+          write_delay: Maximum number of seconds writes are queued for, so that they are
+            committed together. 0 to commit each write right away.
+          glob_ttl: Number of seconds for which the results of globs are cached, 0 to
+            not cache them.
+          index_max_age: Number of seconds after the scan it was built from for which the
+            namespace index is used by glob(), None to never use it.
+        """
+        # Hits are on either the in memory or the on disk cache, misses go to the accessor.
         self.hit_count = 0
         self.miss_count = 0
+        self.front_hit_count = 0
+        self.front_miss_count = 0
+        # Hits of absent metrics, also counted as hits.
+        self.absent_hit_count = 0
+        self.__absent_ttl = absent_ttl
+        self.__absent_db = None
+        self.__ttl = ttl
+        self.__refresher = None  # setup by open()
+        self.__writer = None  # setup by open()
+        # Set to stop the threads.
+        self.__stopped = threading.Event()
+        self.__write_delay = write_delay
+        # Associates metric names to (MetricMetadata or None, time queued) of writes
+        # queued for the writer, see flush().
+        self.__pending_lock = threading.Lock()
+        self.__pending = {}
+        # Associates globs to (metrics, directories, expiration) of queued results.
+        self.__pending_globs = {}
+        # Names of the metrics created since the last flush().
+        self.__created = set()
+        self.__glob_ttl = glob_ttl
+        self.__globs_db = None
+        self.__index_max_age = index_max_age
+        self.__namespace_db = None
+        self.__namespace_info_db = None
+        self.__info_db = None
+        self.__front_cache = _SecondChanceCache(front_cache_size)
+        # Only used if the accessor is not THREAD_SAFE_LOOKUPS.
         self.__accessor_lock = threading.Lock()
         self.__accessor = accessor
+        # Associates metric names to the _Lookup in progress for them.
+        self.__lookups_lock = threading.Lock()
+        self.__lookups = {}
         self.__env = None
         # __json_cache associates unparsed json to metadata instances. The idea is that there are
         # very few configs in use in a given cluster so the few same strings will show up over
@@ -71,7 +317,8 @@ class DiskCache(object):
         self.__json_cache_lock = threading.Lock()
         self.__json_cache = {}
         self.__metric_to_metadata_db = None
-        self.__path = os_path.join(path, "biggraphite", "cache", "version1")
+        # version1 did not record when entries were written.
+        self.__path = os_path.join(path, "biggraphite", "cache", "version2")
 
     def open(self):
         """Allocate ressources used by the cache.
@@ -104,15 +351,41 @@ class DiskCache(object):
             max_spare_txns=128,
         )
         self.__metric_to_metadata_db = self.__env.open_db("metric_to_meta")
+        self.__absent_db = self.__env.open_db("absent")
+        self.__globs_db = self.__env.open_db("globs")
+        self.__namespace_db = self.__env.open_db("namespace")
+        self.__namespace_info_db = self.__env.open_db("namespace_info")
+        self.__info_db = self.__env.open_db("info")
+        self.__stopped.clear()
+        if self.__ttl and self.__accessor.THREAD_SAFE_LOOKUPS:
+            self.__refresher = self.__start_thread(
+                self.__refresh_periodically, "DiskCacheRefresher")
+        if self.__write_delay:
+            self.__writer = self.__start_thread(self.__write_periodically, "DiskCacheWriter")
+
+    @staticmethod
+    def __start_thread(target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
 
     def close(self):
-        """Free resources allocated by open().
+        """Free resources allocated by open(), after committing queued writes.
 
         Safe to call multiple time.
         """
+        self.__stopped.set()
+        for thread in self.__refresher, self.__writer:
+            if thread:
+                thread.join()
+        self.__refresher = None
+        self.__writer = None
         if self.__env:
+            self.flush()
             self.__env.close()
             self.__env = None
+        self.__front_cache.clear()
 
     def create_metric(self, metric):
         """Create a metric definition from a Metric.
@@ -121,38 +394,643 @@ class DiskCache(object):
           metric: The metric definition.
         """
         self.__accessor.create_metric(metric)
-        self._cache(metric.name, metric.metadata)
+        self._cache([(metric.name, metric.metadata)], created=True)
+        self.__front_cache.put(
+            bg_accessor.encode_metric_name(metric.name), (metric, self.__expiration()))
+
+    def get_glob(self, glob):
+        """Return the cached results of a Graphite glob.
+
+        Args:
+          glob: A Graphite glob, see graphite_utils.glob().
+
+        Returns:
+          A tuple of (metrics, directories) lists, None if not cached or expired.
+        """
+        if not self.__glob_ttl:
+            return None
+        glob = bg_accessor.encode_metric_name(glob)
+        now = time.time()
+        pending = self.__pending_globs.get(glob)
+        if pending is not None and pending[2] > now:
+            return pending[0], pending[1]
+        with self.__env.begin(self.__globs_db, write=False) as txn:
+            value = txn.get(_glob_key(glob))
+        if not value:
+            return None
+        expiration, metrics_count = _GLOB_HEADER.unpack_from(value)
+        if expiration <= now:
+            return None
+        names_str = value[_GLOB_HEADER.size:]
+        names = names_str.split(_GLOB_NAMES_SEPARATOR) if names_str else []
+        return names[:metrics_count], names[metrics_count:]
+
+    def cache_glob(self, glob, metrics, directories):
+        """Cache the results of a Graphite glob, until a metric they could include is created.
+
+        Args:
+          glob: A Graphite glob, see graphite_utils.glob().
+          metrics: The list of metrics it matches.
+          directories: The list of directories it matches.
+        """
+        if not self.__glob_ttl:
+            return
+        glob = bg_accessor.encode_metric_name(glob)
+        expiration = time.time() + self.__glob_ttl
+        if not self.__writer:
+            self.__write([], {glob: (metrics, directories, expiration)}, ())
+            return
+        with self.__pending_lock:
+            self.__pending_globs[glob] = (metrics, directories, expiration)
+
+    def glob(self, glob):
+        """Resolve a Graphite glob with the namespace index.
+
+        Metrics and directories queued for writing are not visible yet.
+
+        Args:
+          glob: A Graphite glob, see graphite_utils.glob().
+
+        Returns:
+          A tuple of (metrics, directories) sorted lists, None if the index is disabled,
+          was never built, was built more than index_max_age ago or if nothing matches, as
+          the names may have been created on other hosts since the last scan.
+        """
+        if self.__index_max_age is None:
+            return None
+        glob = bg_accessor.encode_metric_name(glob)
+        metrics = set()
+        directories = set()
+        with self.__env.begin(self.__namespace_db, write=False) as txn:
+            indexed_at = txn.get(_NAMESPACE_INDEXED_AT_KEY, db=self.__namespace_info_db)
+            if not indexed_at:
+                return None
+            indexed_at, = _NAMESPACE_INDEXED_AT.unpack(indexed_at)
+            if indexed_at + self.__index_max_age <= time.time():
+                return None
+            cursor = txn.cursor()
+            for variant in _expand_braces(glob):
+                components = variant.split(".")
+                parents = [b""]
+                for component in components[:-1]:
+                    parents = [
+                        name
+                        for parent in parents
+                        for name, flags in self.__index_children(txn, cursor, parent, component)
+                        if flags & _NAMESPACE_DIRECTORY
+                    ]
+                for parent in parents:
+                    for name, flags in self.__index_children(txn, cursor, parent, components[-1]):
+                        if flags & _NAMESPACE_METRIC:
+                            metrics.add(name)
+                        if flags & _NAMESPACE_DIRECTORY:
+                            directories.add(name)
+        if not metrics and not directories:
+            return None
+        return sorted(metrics), sorted(directories)
+
+    def add_to_index(self, metric_names, directory_names=()):
+        """Add names found by the accessor to the namespace index.
+
+        Args:
+          metric_names: An iterable of names of existing metrics.
+          directory_names: An iterable of names of existing directories.
+        """
+        if self.__index_max_age is None or not (metric_names or directory_names):
+            return
+        with self.__env.begin(self.__namespace_db, write=True) as txn:
+            for metric_name in metric_names:
+                self.__index(txn, bg_accessor.encode_metric_name(metric_name))
+            for directory_name in directory_names:
+                self.__index(
+                    txn, bg_accessor.encode_metric_name(directory_name), _NAMESPACE_DIRECTORY)
+
+    @staticmethod
+    def __index_children(txn, cursor, parent, pattern):
+        """Yield (name, flags) of the children of parent matching the pattern."""
+        key_prefix = parent + _GLOB_KEY_SEPARATOR
+        name_prefix = parent + "." if parent else b""
+        wildcard = _GLOB_WILDCARD_RE.search(pattern)
+        if not wildcard:
+            flags = txn.get(key_prefix + pattern)
+            if flags:
+                yield name_prefix + pattern, _NAMESPACE_FLAGS.unpack(flags)[0]
+            return
+        # Only children starting like the pattern are read.
+        key_prefix += pattern[:wildcard.start()]
+        if not cursor.set_range(key_prefix):
+            return
+        for key, flags in cursor:
+            if not key.startswith(key_prefix):
+                break
+            child = key[len(parent) + len(_GLOB_KEY_SEPARATOR):]
+            if fnmatch.fnmatchcase(child, pattern):
+                yield name_prefix + child, _NAMESPACE_FLAGS.unpack(flags)[0]
 
     def get_metric(self, metric_name):
         """Return a Metric for this metric_name, None if no such metric."""
-        metric_name = bg_accessor.encode_metric_name(metric_name)
+        return self.get_metrics([metric_name])[0]
+
+    def get_metrics(self, metric_names):
+        """Return a Metric for each of metric_names, None for those that do not exist.
+
+        Names missing from the cache are read in one lmdb transaction, then the ones not
+        in lmdb are read together from the accessor.
+
+        Args:
+          metric_names: A list of metric names.
+
+        Returns:
+          A list of Metric or None, in the order of metric_names.
+        """
+        metric_names = [bg_accessor.encode_metric_name(name) for name in metric_names]
+        metrics = [None] * len(metric_names)
+        now = time.time()
+        front_misses = []
+        for i, metric_name in enumerate(metric_names):
+            entry = self.__front_cache.get(metric_name)
+            if entry is not None and entry[1] > now:
+                metrics[i] = entry[0]
+            else:
+                front_misses.append(i)
+        self.front_hit_count += len(metric_names) - len(front_misses)
+        self.front_miss_count += len(front_misses)
+        self.hit_count += len(metric_names) - len(front_misses)
+        if not front_misses:
+            return metrics
+
+        misses = []
         with self.__env.begin(self.__metric_to_metadata_db, write=False) as txn:
-            metadata_str = txn.get(metric_name)
-        if metadata_str:
-            # on disk cache hit
-            self.hit_count += 1
-            with self.__json_cache_lock:
-                metadata = self.__json_cache.get(metadata_str)
-                if not metadata:
-                    metadata = bg_accessor.MetricMetadata.from_json(metadata_str)
-                    self.__json_cache[metadata_str] = metadata
-        else:
-            # on disk cache miss
-            self.miss_count += 1
-            with self.__accessor_lock:
-                metadata = self.__accessor.get_metric(metric_name)
-            self._cache(metric_name, metadata)
-
-        if metadata:
-            return bg_accessor.Metric(metric_name, metadata)
-        else:
-            return None
+            for i in front_misses:
+                metric_name = metric_names[i]
+                pending = self.__pending.get(metric_name)
+                if pending is not None:
+                    metadata, queued = pending
+                    if metadata and (not self.__ttl or queued + self.__ttl > now):
+                        self.hit_count += 1
+                        metrics[i] = bg_accessor.Metric(metric_name, metadata)
+                        continue
+                    if not metadata and queued + self.__absent_ttl > now:
+                        self.hit_count += 1
+                        self.absent_hit_count += 1
+                        continue
+                if self.__absent_ttl:
+                    absent_str = txn.get(metric_name, db=self.__absent_db)
+                    if absent_str and _ABSENT_EXPIRATION.unpack(absent_str)[0] > now:
+                        self.hit_count += 1
+                        self.absent_hit_count += 1
+                        continue
+                metadata_str = txn.get(metric_name)
+                if not metadata_str:
+                    misses.append(i)
+                    continue
+                written, = _METADATA_WRITE_TIME.unpack_from(metadata_str)
+                if self.__ttl and written + self.__ttl <= now:
+                    misses.append(i)  # Expired.
+                    continue
+                # on disk cache hit
+                self.hit_count += 1
+                metrics[i] = self.__make_metric(
+                    metric_name, metadata_str[_METADATA_WRITE_TIME.size:])
+        if not misses:
+            return metrics
 
-    def _cache(self, metric_name, metadata):
-        """If metadata add it to the cache."""
-        if not metadata:
-            # Do not cache absent metrics, they will probably soon be created.
-            return None
-        metadata_json = metadata.as_json()
+        # on disk cache miss
+        self.miss_count += len(misses)
+        found = self.__lookup([metric_names[i] for i in misses])
+        for i, metric in zip(misses, found):
+            metrics[i] = metric
+        return metrics
+
+    def __lookup(self, metric_names):
+        """Read metrics from the accessor and cache them.
+
+        Concurrent lookups of a given name are done once: threads wait for the one that
+        started first rather than all asking the accessor.
+
+        Returns:
+          A list of Metric or None, in the order of metric_names.
+        """
+        lookups = []
+        started = []
+        with self.__lookups_lock:
+            for metric_name in metric_names:
+                lookup = self.__lookups.get(metric_name)
+                if lookup is None:
+                    lookup = self.__lookups[metric_name] = _Lookup()
+                    started.append((metric_name, lookup))
+                lookups.append(lookup)
+
+        if started:
+            try:
+                found = self.__accessor_get_metrics([name for name, _ in started])
+                self._cache([
+                    (metric_name, metric.metadata if metric else None)
+                    for (metric_name, _), metric in zip(started, found)
+                ])
+                expiration = self.__expiration()
+                for (metric_name, lookup), metric in zip(started, found):
+                    if metric:
+                        metric = bg_accessor.Metric(metric_name, metric.metadata)
+                        self.__front_cache.put(metric_name, (metric, expiration))
+                    lookup.metric = metric
+            except Exception as e:
+                for _, lookup in started:
+                    lookup.exception = e
+                raise
+            finally:
+                # Later lookups find these in lmdb.
+                with self.__lookups_lock:
+                    for metric_name, lookup in started:
+                        del self.__lookups[metric_name]
+                        lookup.done.set()
+
+        # Lookups started by other threads.
+        for lookup in lookups:
+            lookup.done.wait()
+            if lookup.exception is not None:
+                raise lookup.exception
+        return [lookup.metric for lookup in lookups]
+
+    def __accessor_get_metrics(self, metric_names):
+        """Call get_metrics() on the accessor, one thread at a time unless it is safe."""
+        if self.__accessor.THREAD_SAFE_LOOKUPS:
+            return self.__accessor.get_metrics(metric_names)
+        with self.__accessor_lock:
+            return self.__accessor.get_metrics(metric_names)
+
+    def __make_metric(self, metric_name, metadata_str):
+        """Return a Metric from JSON metadata, and keep it in memory."""
+        with self.__json_cache_lock:
+            metadata = self.__json_cache.get(metadata_str)
+            if not metadata:
+                metadata = bg_accessor.MetricMetadata.from_json(metadata_str)
+                self.__json_cache[metadata_str] = metadata
+        metric = bg_accessor.Metric(metric_name, metadata)
+        self.__front_cache.put(metric_name, (metric, self.__expiration()))
+        return metric
+
+    def __expiration(self):
+        """Return until when a Metric read now can be kept in memory."""
+        # Entries are kept in memory at most half their TTL, as they may have been
+        # written to lmdb that long ago.
+        if not self.__ttl:
+            return float("inf")
+        return time.time() + self.__ttl / 2.0
+
+    def refresh(self, max_age=None, min_interval=None):
+        """Read again from the accessor the entries written more than max_age ago.
+
+        Entries of metrics that do not exist anymore are removed, as are expired globs.
+
+        Args:
+          max_age: Age in seconds of the entries to refresh, half the TTL if None (all
+            entries without TTL).
+          min_interval: If set, number of seconds during which refresh() does nothing
+            after any process sharing the cache started a refresh with min_interval set.
+
+        Returns:
+          The number of refreshed entries.
+        """
+        if max_age is None:
+            max_age = self.__ttl / 2.0 if self.__ttl else 0
+        if min_interval is not None and not self.__claim_refresh(min_interval):
+            return 0
+        self.flush()
+        self.__remove_expired_globs()
+        written_before = time.time() - max_age
+        with self.__env.begin(self.__metric_to_metadata_db, write=False) as txn:
+            metric_names = [
+                metric_name
+                for metric_name, metadata_str in txn.cursor()
+                if _METADATA_WRITE_TIME.unpack_from(metadata_str)[0] < written_before
+            ]
+        refreshed = 0
+        for start in xrange(0, len(metric_names), self._REFRESH_BATCH_SIZE):
+            if self.__stopped.is_set():
+                break
+            batch = metric_names[start:start + self._REFRESH_BATCH_SIZE]
+            metrics = self.__accessor_get_metrics(batch)
+            self._cache([
+                (metric_name, metric.metadata)
+                for metric_name, metric in zip(batch, metrics) if metric
+            ])
+            with self.__env.begin(self.__metric_to_metadata_db, write=True) as txn:
+                for metric_name, metric in zip(batch, metrics):
+                    if not metric:
+                        txn.delete(metric_name)
+                        self.__unindex(txn, metric_name)
+            refreshed += len(batch)
+        return refreshed
+
+    def __claim_refresh(self, min_interval):
+        """Return whether no process started refreshing in the last min_interval seconds.
+
+        If so, record that this one does. lmdb write transactions are exclusive across
+        processes, so only one of them can claim a given interval.
+        """
+        now = time.time()
+        with self.__env.begin(self.__info_db, write=True) as txn:
+            refreshed_at = txn.get(_INFO_REFRESHED_AT_KEY)
+            if refreshed_at:
+                refreshed_at, = _INFO_REFRESHED_AT.unpack(refreshed_at)
+                if refreshed_at + min_interval > now:
+                    return False
+            txn.put(_INFO_REFRESHED_AT_KEY, _INFO_REFRESHED_AT.pack(now))
+        return True
+
+    def __remove_expired_globs(self):
+        now = time.time()
+        with self.__env.begin(self.__globs_db, write=True) as txn:
+            cursor = txn.cursor()
+            if not cursor.first():
+                return
+            while cursor.key():
+                if _GLOB_HEADER.unpack_from(cursor.value())[0] <= now:
+                    cursor.delete()
+                elif not cursor.next():
+                    break
+
+    def fill(self, metrics, complete=False):
+        """Add metrics to the cache, in large transactions.
+
+        Args:
+          metrics: An iterable of Metric, usually from Accessor.iter_all_metrics().
+          complete: Whether metrics are all the existing metrics. If so, the namespace
+            index is rebuilt from them and is up to date as of when fill() was called.
+
+        Returns:
+          The number of metrics added.
+        """
+        count = 0
+        batch = []
+        now = time.time()
+        if complete:
+            with self.__env.begin(self.__namespace_db, write=True) as txn:
+                txn.delete(_NAMESPACE_INDEXED_AT_KEY, db=self.__namespace_info_db)
+                txn.drop(self.__namespace_db, delete=False)
+        for metric in metrics:
+            batch.append((metric.name, metric.metadata, now))
+            if len(batch) >= self._FILL_BATCH_SIZE:
+                self.__write(batch, {}, ())
+                count += len(batch)
+                del batch[:]
+        self.__write(batch, {}, ())
+        if complete:
+            with self.__env.begin(self.__namespace_info_db, write=True) as txn:
+                txn.put(_NAMESPACE_INDEXED_AT_KEY, _NAMESPACE_INDEXED_AT.pack(now))
+        return count + len(batch)
+
+    def export_snapshot(self, path):
+        """Write all cached metrics to a snapshot file, for import_snapshot().
+
+        The file is written to a temporary file next to path then renamed, so that
+        readers never see a partially written snapshot, even with concurrent exports.
+
+        Args:
+          path: path of the snapshot file.
+
+        Returns:
+          The number of exported metrics.
+        """
+        self.flush()
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os_path.basename(path) + ".", suffix=".tmp", dir=os_path.dirname(path))
+        metadata_to_index = {}
+        count = 0
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION))
+                with self.__env.begin(self.__metric_to_metadata_db, write=False) as txn:
+                    for metric_name, metadata_str in txn.cursor():
+                        written, = _METADATA_WRITE_TIME.unpack_from(metadata_str)
+                        metadata_json = metadata_str[_METADATA_WRITE_TIME.size:]
+                        index = metadata_to_index.get(metadata_json)
+                        new_metadata = index is None
+                        if new_metadata:
+                            index = metadata_to_index[metadata_json] = len(metadata_to_index)
+                        f.write(_SNAPSHOT_ENTRY.pack(len(metric_name), index, written))
+                        f.write(metric_name)
+                        if new_metadata:
+                            f.write(_SNAPSHOT_METADATA.pack(len(metadata_json)))
+                            f.write(metadata_json)
+                        count += 1
+            # mkstemp() only lets the owner read the file.
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return count
+
+    def import_snapshot(self, path):
+        """Add the metrics of a snapshot written by export_snapshot() to the cache.
+
+        Entries already in the cache are kept, imported ones keep their write time so
+        that they expire as they would have on the exporting host.
+
+        Args:
+          path: path of the snapshot file.
+
+        Returns:
+          The number of imported metrics.
+
+        Raises:
+          SnapshotError: if the file is not a valid snapshot.
+        """
+        def read(f, size):
+            data = f.read(size)
+            if len(data) != size:
+                raise SnapshotError("%s: truncated snapshot" % path)
+            return data
+
+        count = 0
+        batch = []
+        try:
+            with gzip.open(path, "rb") as f:
+                magic, version = _SNAPSHOT_HEADER.unpack(read(f, _SNAPSHOT_HEADER.size))
+                if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+                    raise SnapshotError("%s: unsupported snapshot format" % path)
+                metadata_jsons = []
+                while True:
+                    entry = f.read(_SNAPSHOT_ENTRY.size)
+                    if not entry:
+                        break
+                    if len(entry) != _SNAPSHOT_ENTRY.size:
+                        raise SnapshotError("%s: truncated snapshot" % path)
+                    name_len, index, written = _SNAPSHOT_ENTRY.unpack(entry)
+                    metric_name = read(f, name_len)
+                    if index == len(metadata_jsons):
+                        json_len, = _SNAPSHOT_METADATA.unpack(read(f, _SNAPSHOT_METADATA.size))
+                        metadata_jsons.append(read(f, json_len))
+                    elif index > len(metadata_jsons):
+                        raise SnapshotError("%s: invalid metadata index" % path)
+                    batch.append((
+                        metric_name,
+                        _METADATA_WRITE_TIME.pack(written) + metadata_jsons[index]))
+                    if len(batch) >= self._FILL_BATCH_SIZE:
+                        count += self.__put_if_absent(batch)
+                        del batch[:]
+        except (IOError, EOFError, struct.error, zlib.error) as e:
+            raise SnapshotError("%s: invalid snapshot (%s)" % (path, e))
+        return count + self.__put_if_absent(batch)
+
+    def __put_if_absent(self, names_and_metadata_strs):
+        """Write raw entries of the metadata DB, keeping existing ones.
+
+        Returns:
+          The number of written entries.
+        """
+        count = 0
         with self.__env.begin(self.__metric_to_metadata_db, write=True) as txn:
-            txn.put(metric_name, metadata_json, dupdata=False, overwrite=True)
+            for metric_name, metadata_str in names_and_metadata_strs:
+                if txn.put(metric_name, metadata_str, overwrite=False):
+                    count += 1
+        return count
+
+    def __refresh_periodically(self):
+        """Refresh entries until close() is called."""
+        interval = self.__ttl / 4.0
+        while not self.__stopped.wait(interval):
+            try:
+                self.refresh(min_interval=interval)
+            except Exception:
+                logging.exception("Failed to refresh the metadata cache")
+
+    def __write_periodically(self):
+        """Commit queued writes until close() is called."""
+        while not self.__stopped.wait(self.__write_delay):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Failed to write to the metadata cache")
+
+    def flush(self):
+        """Commit queued writes in a single transaction."""
+        with self.__pending_lock:
+            pending = self.__pending.items()
+            pending_globs = self.__pending_globs.copy()
+            created = self.__created
+            self.__created = set()
+        if not pending and not pending_globs and not created:
+            return
+        self.__write([
+            (metric_name, metadata, queued)
+            for metric_name, (metadata, queued) in pending
+        ], pending_globs, created)
+        # Entries are only forgotten now that they can be read from lmdb.
+        with self.__pending_lock:
+            for metric_name, value in pending:
+                if self.__pending.get(metric_name) is value:
+                    del self.__pending[metric_name]
+            for glob, value in pending_globs.iteritems():
+                if self.__pending_globs.get(glob) is value:
+                    del self.__pending_globs[glob]
+
+    def _cache(self, names_and_metadata, created=False):
+        """Add metadata to the cache, or record that metrics are absent if None.
+
+        Writes are queued for the writer thread, if any.
+
+        Args:
+          names_and_metadata: An iterable of (metric name, MetricMetadata or None).
+          created: Whether the metrics were just created, so that cached globs which
+            could match them are removed.
+        """
+        now = time.time()
+        if not self.__writer:
+            names_and_metadata = list(names_and_metadata)
+            self.__write(
+                [(metric_name, metadata, now) for metric_name, metadata in names_and_metadata],
+                {},
+                [metric_name for metric_name, _ in names_and_metadata] if created else (),
+            )
+            return
+        with self.__pending_lock:
+            for metric_name, metadata in names_and_metadata:
+                self.__pending[metric_name] = (metadata, now)
+                if created:
+                    self.__created.add(metric_name)
+                    # Results queued by this process are outdated too.
+                    self.__pending_globs.clear()
+
+    def __write(self, entries, globs, created):
+        """Write entries to lmdb in a single transaction.
+
+        Args:
+          entries: An iterable of (metric name, MetricMetadata or None, write time).
+          globs: A dict associating globs to (metrics, directories, expiration).
+          created: An iterable of names of created metrics, whose globs are removed
+            after globs are written.
+        """
+        with self.__env.begin(self.__metric_to_metadata_db, write=True) as txn:
+            for glob, (metrics, directories, expiration) in globs.iteritems():
+                value = _GLOB_HEADER.pack(expiration, len(metrics))
+                value += _GLOB_NAMES_SEPARATOR.join(metrics + directories)
+                txn.put(_glob_key(glob), value, db=self.__globs_db)
+            if created and self.__glob_ttl:
+                self.__remove_globs(txn, created)
+            for metric_name, metadata, write_time in entries:
+                if metadata:
+                    metadata_str = _METADATA_WRITE_TIME.pack(write_time) + metadata.as_json()
+                    txn.put(metric_name, metadata_str, dupdata=False, overwrite=True)
+                    txn.delete(metric_name, db=self.__absent_db)
+                    self.__index(txn, metric_name)
+                elif self.__absent_ttl:
+                    # Absent metrics are often created soon after, and metrics can be
+                    # created by processes not sharing this cache: only trust this for a
+                    # while.
+                    absent_expiration = _ABSENT_EXPIRATION.pack(write_time + self.__absent_ttl)
+                    txn.put(metric_name, absent_expiration, db=self.__absent_db)
+
+    def __index(self, txn, name, flag=_NAMESPACE_METRIC):
+        """Add a metric or directory and its parent directories to the namespace index."""
+        while name:
+            key = _namespace_key(name)
+            flags_str = txn.get(key, db=self.__namespace_db)
+            flags = _NAMESPACE_FLAGS.unpack(flags_str)[0] if flags_str else 0
+            if flags & flag:
+                # Parents were added with it.
+                return
+            txn.put(key, _NAMESPACE_FLAGS.pack(flags | flag), db=self.__namespace_db)
+            name = name.rpartition(".")[0]
+            flag = _NAMESPACE_DIRECTORY
+
+    def __unindex(self, txn, metric_name):
+        """Remove a metric from the namespace index, and the directories it leaves empty."""
+        cursor = txn.cursor(db=self.__namespace_db)
+        name = metric_name
+        flag = _NAMESPACE_METRIC
+        while name:
+            key = _namespace_key(name)
+            flags_str = txn.get(key, db=self.__namespace_db)
+            if not flags_str:
+                return
+            flags = _NAMESPACE_FLAGS.unpack(flags_str)[0] & ~flag
+            if flags:
+                txn.put(key, _NAMESPACE_FLAGS.pack(flags), db=self.__namespace_db)
+            else:
+                txn.delete(key, db=self.__namespace_db)
+            name = name.rpartition(".")[0]
+            flag = _NAMESPACE_DIRECTORY
+            children_prefix = name + _GLOB_KEY_SEPARATOR
+            if cursor.set_range(children_prefix) and cursor.key().startswith(children_prefix):
+                return
+
+    def __remove_globs(self, txn, metric_names):
+        """Remove the cached globs whose results could include metric_names."""
+        prefixes = set()
+        for metric_name in metric_names:
+            prefix = b""
+            prefixes.add(prefix)
+            for component in metric_name.split(".")[:-1]:
+                prefix += component + "."
+                prefixes.add(prefix)
+        cursor = txn.cursor(db=self.__globs_db)
+        for prefix in prefixes:
+            key_prefix = prefix + _GLOB_KEY_SEPARATOR
+            if not cursor.set_range(key_prefix):
+                continue
+            while cursor.key().startswith(key_prefix):
+                if not cursor.delete():
+                    break
@@ -20,12 +20,24 @@ from __future__ import absolute_import  # Otherwise carbon is this module.
 # upstream commit 3d260b0f663b5577bc3a0fc3f0741802109a28c4 or apply this
 # patch: https://goo.gl/1gAcz1 .
 # test-requirements.txt as a URL pinned at the correct version.
+import atexit
+import functools
+import threading
+import time
+
 from carbon import database
 from carbon import exceptions as carbon_exceptions
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python import log
+
+from biggraphite.drivers import cassandra as bg_cassandra
 
 from biggraphite import graphite_utils
 from biggraphite import accessor
 from biggraphite import metadata_cache
+from biggraphite import writer_pool
 
 # Ignore D102: Missing docstring in public method: Most of them come from upstream module.
 # pylama:ignore=D102
@@ -33,6 +45,9 @@ from biggraphite import metadata_cache
 
 _DEFAULT_PORT = 9042
 
+# How often to persist in-memory state (e.g. downsampling aggregates) of the accessor.
+_CHECKPOINT_INTERVAL_SECONDS = 60
+
 
 # TODO: Add a cache for metadata. lmdb is a reasonable candidate so that the
 # cache is shared by all processes and is backed by mmap'd memory.
@@ -42,27 +57,86 @@ class BigGraphiteDatabase(database.TimeSeriesDatabase):
 
     The class definition registers the plugin thanks to TimeSeriesDatabase's metaclass.
 
-    It performs an asynchronous (non durable) write most of the time, except once
-    every _SYNC_EVERY_N_WRITE to give errors a chance to bubble up and bound the
-    number of points we may lose when the process terminates.
+    It performs asynchronous (non durable) writes. The accessor bounds the number of
+    writes in flight, which bounds memory usage and the number of points we may lose when
+    the process terminates. Errors of asynchronous writes are raised by the next call to
+    write() so that they bubble up to carbon.
     Writing every point synchronously increase CPU usage by ~300% as per https://goo.gl/xP5fD9 .
+
+    Writes of all metrics are also batched, so that the accessor only handles them once
+    BG_WRITE_BATCH_POINTS points were collected or BG_WRITE_BATCH_DELAY_MS milliseconds
+    after the first one, whichever comes first.
+
+    With BG_WRITER_PROCESSES, batches are instead written by a pool of writer processes,
+    see biggraphite.writer_pool. The accessor of this process is then only used for
+    metadata.
+
+    A thread flushes batches that carbon stopped feeding and checkpoints the accessor, see
+    Accessor.checkpoint(), outside of the write path. Call stop() to write the last batch
+    and checkpoint one last time, it is called at exit.
+
+    Code running in the reactor can use the *_async() methods instead, which return
+    Deferreds. They run in the reactor's thread pool, as metadata cache misses and a full
+    write window block, and fire from the reactor.
+
+    With BG_CASSANDRA_CONNECTION set to "twisted", the accessor connects once Carbon runs
+    the reactor: the driver would otherwise run it in a thread, and Carbon's own
+    reactor.run() would fail. Calls that need the accessor wait for the connection, so
+    they must not be made from the reactor's thread before.
     """
 
     plugin_name = "biggraphite"
 
-    # See class pydoc for the rational.
-    _SYNC_EVERY_N_WRITE = 100
-
     def __init__(self, settings):
+        self._write_error = None
+        self._writer_pool = None
+        # Set once the accessor is connected, or failed to.
+        self._connected = threading.Event()
+        self._connect_error = None
         try:
             self._accessor = graphite_utils.accessor_from_settings(settings)
-            self._accessor.connect()
+            writer_processes = graphite_utils.writer_processes_from_settings(settings)
+            if writer_processes:
+                self._writer_pool = writer_pool.WriterPool(
+                    functools.partial(graphite_utils.accessor_from_settings, settings),
+                    writer_processes, on_error=self._on_write_done)
+                # Forked before connecting and starting threads, which children would
+                # not get.
+                self._writer_pool.start()
+                atexit.register(self._writer_pool.stop)
+            connection = graphite_utils.cassandra_connection_from_settings(settings)
+            if connection == bg_cassandra.CONNECTION_TWISTED:
+                reactor.callWhenRunning(self._connect_from_reactor)
+            else:
+                self._connect()
         except graphite_utils.ConfigError as e:
             raise carbon_exceptions.CarbonConfigException(e)
         storage_path = graphite_utils.storage_path_from_settings(settings)
-        self._cache = metadata_cache.DiskCache(self._accessor, storage_path)
+        self._cache = metadata_cache.DiskCache(
+            self._accessor, storage_path,
+            ttl=graphite_utils.metadata_cache_ttl_from_settings(settings))
         self._cache.open()
-        self._sync_countdown = 0
+        self._next_checkpoint = time.time() + _CHECKPOINT_INTERVAL_SECONDS
+        self._batch_max_points, self._batch_max_delay = (
+            graphite_utils.write_batch_from_settings(settings))
+        self._batch_lock = threading.Lock()
+        # List of (Metric, datapoints) not handed to the accessor yet.
+        self._batch = []
+        # Called with the result of the current batch, for write_async().
+        self._batch_callbacks = []
+        self._batch_points = 0
+        self._batch_deadline = None
+        # Held while handing batches to the accessor or checkpointing it, as accessors and
+        # their downsamplers are not all thread-safe. Batches are collected meanwhile.
+        self._write_lock = threading.Lock()
+        # Batches are otherwise only flushed by write(), which carbon stops calling when
+        # it has nothing to write.
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name="BatchFlusher")
+        self._flusher.daemon = True
+        self._flusher.start()
+        # Registered after the writer pool, so that it runs before the pool is stopped.
+        atexit.register(self.stop)
 
         # TODO: we may want to use/implement these
         # settings.WHISPER_AUTOFLUSH:
@@ -70,25 +144,193 @@ class BigGraphiteDatabase(database.TimeSeriesDatabase):
         # settings.WHISPER_FALLOCATE_CREATE:
         # settings.WHISPER_LOCK_WRITES:
 
+    def _connect(self):
+        self._accessor.connect()
+        self._connected.set()
+
+    def _connect_from_reactor(self):
+        """Connect from the reactor's thread pool, as connecting waits for the reactor."""
+        d = threads.deferToThread(self._connect)
+        d.addErrback(self._on_connect_error)
+
+    def _on_connect_error(self, failure):
+        # Carbon cannot do anything without a connection.
+        log.err(failure, "Failed to connect BigGraphite's accessor")
+        self._connect_error = failure.value
+        self._connected.set()
+        reactor.stop()
+
+    def _wait_connected(self):
+        """Wait for the accessor to be connected, raising the error if it failed to."""
+        self._connected.wait()
+        if self._connect_error:
+            raise self._connect_error
+
+    def _on_write_done(self, exception):
+        # Called from the driver's threads.
+        if exception:
+            self._write_error = exception
+
     def write(self, metric_name, datapoints):
+        self._write(metric_name, datapoints)
+        # Only raised now that the points we were given are handled.
+        error, self._write_error = self._write_error, None
+        if error:
+            raise error
+
+    def write_async(self, metric_name, datapoints):
+        """Like write(), but return a Deferred fired once the points are written.
+
+        With writer processes, it is fired once they are handed to writers.
+        """
+        d = defer.Deferred()
+
+        def on_done(exception):
+            # Called from the driver's threads, once the batch is written.
+            if exception:
+                reactor.callFromThread(d.errback, exception)
+            else:
+                reactor.callFromThread(d.callback, None)
+
+        def write():
+            metric, points = self._prepare(metric_name, datapoints)
+            try:
+                self._add_to_batch(metric, points, on_done)
+            except Exception:
+                # Errors of the batch were passed to on_done, which fires d.
+                pass
+
+        written = threads.deferToThread(write)
+        # Only errors raised before on_done was queued.
+        written.addErrback(d.errback)
+        return d
+
+    def _write(self, metric_name, datapoints):
+        metric, datapoints = self._prepare(metric_name, datapoints)
+        self._add_to_batch(metric, datapoints)
+
+    def _prepare(self, metric_name, datapoints):
+        """Return the Metric and the datapoints to add to the batch."""
         # Get a Metric object from metric name.
+        self._wait_connected()
         metric = self._cache.get_metric(metric_name=metric_name)
+        if not metric:
+            # Deleted since carbon created it, the accessor only takes existing metrics.
+            raise ValueError("%s: No such metric" % metric_name)
         # Round down timestamp because inner functions expect integers.
         datapoints = [(int(timestamp), value) for timestamp, value in datapoints]
+        return metric, datapoints
+
+    def _add_to_batch(self, metric, datapoints, on_done=None):
+        """Add points to the batch, and write it if full or too old.
+
+        Errors of the write are passed to the callbacks of the batch, then raised.
+        """
+        now = time.time()
+        batch, callbacks = [], []
+        with self._batch_lock:
+            if not self._batch:
+                self._batch_deadline = now + self._batch_max_delay
+            self._batch.append((metric, datapoints))
+            if on_done:
+                self._batch_callbacks.append(on_done)
+            self._batch_points += len(datapoints)
+            if self._batch_points >= self._batch_max_points or now >= self._batch_deadline:
+                batch, callbacks = self._take_batch()
+        self._write_batch(batch, callbacks)
+
+    def flush(self):
+        """Hand the points collected so far to the accessor."""
+        with self._batch_lock:
+            batch, callbacks = self._take_batch()
+        self._write_batch(batch, callbacks)
+
+    def stop(self):
+        """Stop the flusher thread, then flush and checkpoint one last time."""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._flusher.join()
+        self.flush()
+        self._checkpoint()
+
+    def _take_batch(self):
+        """Return the batch and its callbacks, and start a new one.
+
+        Called with _batch_lock held.
+        """
+        batch, self._batch = self._batch, []
+        callbacks, self._batch_callbacks = self._batch_callbacks, []
+        self._batch_points = 0
+        return batch, callbacks
+
+    def _checkpoint(self):
+        if not self._connected.is_set() or self._connect_error:
+            # Nothing was written without a connection.
+            return
+        with self._write_lock:
+            self._accessor.checkpoint()
+
+    def _write_batch(self, batch, callbacks):
+        if not batch:
+            return
+        on_done = self._on_write_done
+        if callbacks:
+            def on_done(exception):
+                self._on_write_done(exception)
+                for callback in callbacks:
+                    callback(exception)
 
         # Writing every point synchronously increase CPU usage by ~300% as per https://goo.gl/xP5fD9
-        if self._sync_countdown < 1:
-            self._accessor.insert_points(metric=metric, datapoints=datapoints)
-            self._sync_countdown = self._SYNC_EVERY_N_WRITE
-        else:
-            self._sync_countdown -= 1
-            self._accessor.insert_points_async(metric=metric, datapoints=datapoints)
+        try:
+            with self._write_lock:
+                if self._writer_pool:
+                    # Errors of writers are reported to _on_write_done() by the pool.
+                    self._writer_pool.insert_points_batch(batch)
+                else:
+                    self._accessor.insert_points_batch_async(batch, on_done=on_done)
+        except Exception as e:
+            for callback in callbacks:
+                callback(e)
+            raise
+        if self._writer_pool:
+            for callback in callbacks:
+                callback(None)
+
+    def _flush_periodically(self):
+        interval = _CHECKPOINT_INTERVAL_SECONDS
+        if self._batch_max_delay > 0:
+            interval = min(interval, self._batch_max_delay)
+        while not self._stopped.wait(interval):
+            now = time.time()
+            try:
+                batch, callbacks = [], []
+                with self._batch_lock:
+                    if self._batch and now >= self._batch_deadline:
+                        batch, callbacks = self._take_batch()
+                self._write_batch(batch, callbacks)
+                if now >= self._next_checkpoint:
+                    self._next_checkpoint = now + _CHECKPOINT_INTERVAL_SECONDS
+                    self._checkpoint()
+            except Exception as e:
+                # Raised by the next call to write().
+                self._on_write_done(e)
 
     def exists(self, metric_name):
         # If exists returns "False" then "create" will be called.
         # New metrics are also throttled by some settings.
+        self._wait_connected()
         return bool(self._cache.get_metric(metric_name=metric_name))
 
+    def exists_async(self, metric_name):
+        """Like exists(), but return a Deferred firing with the result."""
+        return threads.deferToThread(self.exists, metric_name)
+
+    def create_async(self, metric_name, retentions, xfilesfactor, aggregation_method):
+        """Like create(), but return a Deferred fired once the metric is created."""
+        return threads.deferToThread(
+            self.create, metric_name, retentions, xfilesfactor, aggregation_method)
+
     def create(self, metric_name, retentions, xfilesfactor, aggregation_method):
         metadata = accessor.MetricMetadata(
             aggregator=accessor.Aggregator.from_carbon_name(aggregation_method),
@@ -96,12 +338,14 @@ class BigGraphiteDatabase(database.TimeSeriesDatabase):
             carbon_xfilesfactor=xfilesfactor,
         )
         metric = accessor.Metric(metric_name, metadata)
+        self._wait_connected()
         self._cache.create_metric(metric)
 
     def getMetadata(self, metric_name, key):
         if key != "aggregationMethod":
             msg = "%s[%s]: Unsupported metadata" % (metric_name, key)
             raise ValueError(msg)
+        self._wait_connected()
         metadata = self._cache.get_metric(metric_name=metric_name)
         if not metadata:
             raise ValueError("%s: No such metric" % metric_name)
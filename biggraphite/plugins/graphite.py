@@ -34,13 +34,45 @@ class Error(Exception):
     """Base class for all exceptions from this module."""
 
 
+class _MetricsPrefetcher(object):
+    """Look up the metadata of all the metrics found by a query on first use.
+
+    Graphite usually reads all the leaves a query found, looking them up together saves
+    a round-trip for each.
+    """
+
+    __slots__ = ("_metadata_cache", "_metric_names", "_metrics", )
+
+    def __init__(self, metadata_cache, metric_names):
+        """Create a new prefetcher for metric_names."""
+        self._metadata_cache = metadata_cache
+        self._metric_names = metric_names
+        self._metrics = None
+
+    def get_metric(self, metric_name):
+        """Return a Metric for this metric_name, None if no such metric."""
+        if self._metrics is None:
+            metrics = self._metadata_cache.get_metrics(self._metric_names)
+            self._metrics = dict(zip(self._metric_names, metrics))
+        if metric_name not in self._metrics:
+            return self._metadata_cache.get_metric(metric_name)
+        return self._metrics[metric_name]
+
+
 class Reader(object):
     """As per the Graphite API, fetches points for and metadata for a given metric."""
 
     __slots__ = ("_accessor", "_metadata_cache", "_metric", "_metric_name", )
 
     def __init__(self, accessor, metadata_cache, metric_name):
-        """Create a new reader."""
+        """Create a new reader.
+
+        Args:
+          accessor: The accessor to read points from.
+          metadata_cache: Anything with a get_metric(metric_name) method, usually a
+            DiskCache, to read the metadata of the metric from.
+          metric_name: The name of the metric to read.
+        """
         self._accessor = accessor
         self._metadata_cache = metadata_cache
         self._metric = None
@@ -143,15 +175,24 @@ class Finder(object):
         if metadata_cache:
             self._metadata_cache = metadata_cache
         else:
-            self._metadata_cache = bg_metadata_cache.DiskCache(self._accessor, storage_path)
+            self._metadata_cache = bg_metadata_cache.DiskCache(
+                self._accessor, storage_path,
+                ttl=graphite_utils.metadata_cache_ttl_from_settings(django_settings),
+                index_max_age=graphite_utils.index_max_age_from_settings(django_settings))
             self._metadata_cache.open()
 
     def find_nodes(self, query):
         """Find nodes matching a query."""
         # TODO: handle directories constructor argument/property
-        metric_names, directories = graphite_utils.glob(self._accessor, query.pattern)
+        # Dashboards send the same queries from all workers, share their results.
+        found = self._metadata_cache.get_glob(query.pattern)
+        if found is None:
+            found = graphite_utils.glob(self._accessor, query.pattern, self._metadata_cache)
+            self._metadata_cache.cache_glob(query.pattern, *found)
+        metric_names, directories = found
+        prefetcher = _MetricsPrefetcher(self._metadata_cache, metric_names)
         for metric_name in metric_names:
-            reader = Reader(self._accessor, self._metadata_cache, metric_name)
+            reader = Reader(self._accessor, prefetcher, metric_name)
             yield node.LeafNode(metric_name, reader)
 
         for directory in directories:
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mergeable summaries of distributions of values, used by percentile aggregators."""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import math
+import struct
+
+
+class Error(Exception):
+    """Base class for all exceptions from this module."""
+
+
+class InvalidSketchError(Error):
+    """A serialized sketch could not be parsed."""
+
+
+# All sketches share the same accuracy so that any two of them can be merged.
+_RELATIVE_ACCURACY = 0.01
+_GAMMA = (1 + _RELATIVE_ACCURACY) / (1 - _RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+# Values closer to zero than this are counted as zeros.
+_MIN_VALUE = 1e-9
+# Maximum number of bins per sign, enough to be accurate on 17 orders of magnitude.
+_MAX_BINS = 2048
+
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct("<BIII")  # version, zeros, negative bins, positive bins
+_BIN = struct.Struct("<iI")  # index, count
+
+
+class QuantileSketch(object):
+    """Summary of a distribution answering quantiles with a bounded relative error.
+
+    This is a DDSketch (https://arxiv.org/abs/1908.10693): values are counted in
+    logarithmically sized bins, so that any value returned by quantile() is within
+    _RELATIVE_ACCURACY of the actual one. Merging two sketches is exact.
+
+    The number of bins grows with the logarithm of the ratio between the greatest and the
+    smallest absolute values, a few hundred for most metrics. It is capped to _MAX_BINS
+    per sign by merging the bins of the smallest absolute values, which are then the only
+    inaccurate ones.
+    """
+
+    __slots__ = (
+        "count",
+        "_zeros",
+        "_negative_bins",
+        "_positive_bins",
+    )
+
+    def __init__(self):
+        """Create an empty sketch."""
+        self.count = 0
+        self._zeros = 0
+        # Associate the bin index of the absolute value to a count.
+        self._negative_bins = {}
+        self._positive_bins = {}
+
+    def __eq__(self, other):
+        if not isinstance(other, QuantileSketch):
+            return False
+        return (
+            self._zeros == other._zeros and
+            self._negative_bins == other._negative_bins and
+            self._positive_bins == other._positive_bins
+        )
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def add(self, value, count=1):
+        """Add a value to the sketch, NaNs and infinities are ignored.
+
+        Args:
+          value: The value, as a float.
+          count: How many times to add it.
+        """
+        if math.isnan(value) or math.isinf(value):
+            return
+        self.count += count
+        if -_MIN_VALUE < value < _MIN_VALUE:
+            self._zeros += count
+            return
+        if value > 0:
+            bins = self._positive_bins
+        else:
+            bins = self._negative_bins
+            value = -value
+        index = int(math.ceil(math.log(value) / _LOG_GAMMA))
+        if index in bins:
+            bins[index] += count
+        else:
+            bins[index] = count
+            self._collapse(bins)
+
+    def merge(self, other):
+        """Add all values of another sketch to this one."""
+        self.count += other.count
+        self._zeros += other._zeros
+        for bins, other_bins in (
+                (self._negative_bins, other._negative_bins),
+                (self._positive_bins, other._positive_bins)):
+            for index, count in other_bins.iteritems():
+                bins[index] = bins.get(index, 0) + count
+            self._collapse(bins)
+
+    @staticmethod
+    def _collapse(bins):
+        """Merge the bins of the smallest absolute values until at most _MAX_BINS remain."""
+        excess = len(bins) - _MAX_BINS
+        if excess <= 0:
+            return
+        indexes = sorted(bins)
+        smallest = indexes[excess]
+        for index in indexes[:excess]:
+            bins[smallest] += bins.pop(index)
+
+    def quantile(self, q):
+        """Return the approximate value below which a given fraction of values fall.
+
+        Args:
+          q: The fraction, between 0 and 1 (0.5 is the median).
+
+        Returns:
+          The value as a float, NaN if the sketch is empty.
+        """
+        if not self.count:
+            return float("nan")
+        rank = q * (self.count - 1)
+        seen = 0
+        # Negative values first, from the greatest absolute value to the smallest.
+        for index in sorted(self._negative_bins, reverse=True):
+            seen += self._negative_bins[index]
+            if seen > rank:
+                return -self._bin_value(index)
+        seen += self._zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self._positive_bins):
+            seen += self._positive_bins[index]
+            if seen > rank:
+                return self._bin_value(index)
+        # Only reached because of rounding errors on rank.
+        return self._bin_value(max(self._positive_bins)) if self._positive_bins else 0.0
+
+    @staticmethod
+    def _bin_value(index):
+        """Return the value with the smallest relative error to all values of a bin."""
+        return 2 * _GAMMA ** index / (_GAMMA + 1)
+
+    def to_bytes(self):
+        """Serialize the sketch into a string from_bytes() can parse."""
+        parts = [_HEADER.pack(
+            _FORMAT_VERSION, self._zeros,
+            len(self._negative_bins), len(self._positive_bins))]
+        for bins in self._negative_bins, self._positive_bins:
+            for index, count in sorted(bins.iteritems()):
+                parts.append(_BIN.pack(index, count))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Parse a sketch serialized by to_bytes().
+
+        Raises:
+          InvalidSketchError: if data is not a serialized sketch.
+        """
+        try:
+            version, zeros, negatives, positives = _HEADER.unpack_from(data, 0)
+            if version != _FORMAT_VERSION:
+                raise InvalidSketchError("Unknown sketch version: %d" % version)
+            if len(data) != _HEADER.size + (negatives + positives) * _BIN.size:
+                raise InvalidSketchError("Invalid sketch size: %d" % len(data))
+            sketch = cls()
+            sketch._zeros = zeros
+            sketch.count = zeros
+            offset = _HEADER.size
+            for bins, size in (
+                    (sketch._negative_bins, negatives),
+                    (sketch._positive_bins, positives)):
+                for _ in xrange(size):
+                    index, count = _BIN.unpack_from(data, offset)
+                    offset += _BIN.size
+                    bins[index] = count
+                    sketch.count += count
+        except struct.error as e:
+            raise InvalidSketchError(e)
+        return sketch
@@ -29,6 +29,7 @@ import tempfile
 import shutil
 import unittest
 import logging
+import zlib
 
 from cassandra import cluster as c_cluster
 import mock
@@ -197,6 +198,36 @@ class FakeAccessor(bg_accessor.Accessor):
         super(FakeAccessor, self).glob_directory_names(glob)
         return self.__glob_names(self._directory_names, glob)
 
+    @staticmethod
+    def __iter_ranges(names, ranges):
+        # Like Cassandra's tokens, crc32 spreads names uniformly on a ring.
+        for name in names:
+            token = zlib.crc32(name) & 0xffffffff
+            if any(start <= token < end for start, end in ranges):
+                yield name
+
+    def scan_ranges(self, count):
+        """See the real Accessor for a description."""
+        super(FakeAccessor, self).scan_ranges(count)
+        step = 2 ** 32 // count
+        bounds = [n * step for n in xrange(count)] + [2 ** 32]
+        return zip(bounds[:-1], bounds[1:])
+
+    def iter_all_metrics(self, ranges=None):
+        """See the real Accessor for a description."""
+        super(FakeAccessor, self).iter_all_metrics(ranges)
+        if ranges is None:
+            ranges = self.scan_ranges(1)
+        for name in self.__iter_ranges(list(self._metric_names), ranges):
+            yield bg_accessor.Metric(name, self._metric_to_metadata[name])
+
+    def iter_all_directories(self, ranges=None):
+        """See the real Accessor for a description."""
+        super(FakeAccessor, self).iter_all_directories(ranges)
+        if ranges is None:
+            ranges = self.scan_ranges(1)
+        return self.__iter_ranges(list(self._directory_names), ranges)
+
     def get_metric(self, metric_name):
         """See the real Accessor for a description."""
         super(FakeAccessor, self).get_metric(metric_name)
@@ -206,9 +237,10 @@ class FakeAccessor(bg_accessor.Accessor):
         else:
             return None
 
-    def fetch_points(self, metric, time_start, time_end, stage):
+    def fetch_points(self, metric, time_start, time_end, stage, aggregator=None, step=None):
         """See the real Accessor for a description."""
-        super(FakeAccessor, self).fetch_points(metric, time_start, time_end, stage)
+        super(FakeAccessor, self).fetch_points(
+            metric, time_start, time_end, stage, aggregator, step)
         points = self._metric_to_points[metric.name]
         rows = []
         for ts in points.irange(time_start, time_end):
@@ -219,7 +251,9 @@ class FakeAccessor(bg_accessor.Accessor):
 
         time_start_ms = int(time_start) * 1000
         time_end_ms = int(time_end) * 1000
-        return bg_accessor.PointGrouper(metric, time_start_ms, time_end_ms, stage, query_results)
+        step_ms = step * 1000 if step else None
+        return bg_accessor.PointGrouper(
+            metric, time_start_ms, time_end_ms, stage, query_results, aggregator, step_ms)
 
 
 class TestCaseWithTempDir(unittest.TestCase):
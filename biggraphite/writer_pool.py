@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Offloads writes of points to a pool of writer processes.
+
+Downsampling, serialization and the callbacks of the driver are CPU bound, and a process
+only gets one core for them. The pool forks writer processes, each with its own accessor
+(connected after the fork) and thus its own downsampler. Metrics are sharded by name, so
+that each metric is always downsampled by the same writer.
+
+Each writer is fed through a ring buffer in shared memory, which holds points as columns
+of metric ids, timestamps and values. Metrics are sent once through a queue, with an id
+that later points refer to. Errors of writers are sent back through another queue.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import itertools
+import logging
+import multiprocessing
+from multiprocessing import sharedctypes
+import threading
+import time
+import zlib
+
+from biggraphite import accessor as bg_accessor
+
+
+class Error(Exception):
+    """Base class for all exceptions from this module."""
+
+
+class WriterError(Error):
+    """A writer process failed to write points."""
+
+
+class _Ring(object):
+    """A single producer, single consumer ring buffer of points in shared memory.
+
+    Slots between tail and head (counted since the creation of the ring) hold points
+    written by the producer and not read yet. Only the producer writes slots after head,
+    only the consumer reads slots before it, so the lock only guards head and tail.
+    """
+
+    def __init__(self, capacity):
+        """Create an empty ring of capacity points, before forking."""
+        self.capacity = capacity
+        self.__ids = sharedctypes.RawArray("I", capacity)
+        self.__timestamps = sharedctypes.RawArray("l", capacity)
+        self.__values = sharedctypes.RawArray("d", capacity)
+        self.__head = sharedctypes.RawValue("L", 0)
+        self.__tail = sharedctypes.RawValue("L", 0)
+        self.__cond = multiprocessing.Condition()
+
+    def put(self, ids, timestamps, values, consumer=None):
+        """Write points, waiting for free slots if needed.
+
+        Args:
+          ids: metric ids of the points.
+          timestamps: timestamps of the points.
+          values: values of the points.
+          consumer: multiprocessing.Process reading the ring, if any, so that waiting
+            for free slots stops once it exited.
+
+        Raises:
+          WriterError: if the consumer exited while waiting for free slots.
+        """
+        offset = 0
+        while offset < len(ids):
+            with self.__cond:
+                while self.__head.value - self.__tail.value >= self.capacity:
+                    if consumer and not consumer.is_alive():
+                        raise WriterError("%s exited with code %s" % (
+                            consumer.name, consumer.exitcode))
+                    self.__cond.wait(_PUT_TIMEOUT)
+                head = self.__head.value
+                count = min(self.capacity - (head - self.__tail.value), len(ids) - offset)
+            for column, data in ((self.__ids, ids),
+                                 (self.__timestamps, timestamps),
+                                 (self.__values, values)):
+                self.__copy_in(column, head, data[offset:offset + count])
+            with self.__cond:
+                self.__head.value = head + count
+                self.__cond.notify_all()
+            offset += count
+
+    def get(self, timeout):
+        """Read all available points, waiting up to timeout seconds for some.
+
+        Returns:
+          A tuple of (ids, timestamps, values) lists, None if there was none.
+        """
+        with self.__cond:
+            if self.__head.value == self.__tail.value:
+                self.__cond.wait(timeout)
+            head, tail = self.__head.value, self.__tail.value
+        if head == tail:
+            return None
+        columns = tuple(
+            self.__copy_out(column, tail, head - tail)
+            for column in (self.__ids, self.__timestamps, self.__values)
+        )
+        with self.__cond:
+            self.__tail.value = head
+            self.__cond.notify_all()
+        return columns
+
+    def __copy_in(self, column, position, data):
+        start = position % self.capacity
+        split = min(len(data), self.capacity - start)
+        column[start:start + split] = data[:split]
+        column[:len(data) - split] = data[split:]
+
+    def __copy_out(self, column, position, count):
+        start = position % self.capacity
+        split = min(count, self.capacity - start)
+        return column[start:start + split] + column[:count - split]
+
+
+class _Writer(object):
+    """The state of a writer process, kept by the process feeding it."""
+
+    __slots__ = ("ring", "metrics", "process", "_metric_ids", "_next_id", )
+
+    def __init__(self, ring_capacity):
+        self.ring = _Ring(ring_capacity)
+        # Receives (id, metric name, metadata as JSON) before points referring to id.
+        self.metrics = multiprocessing.Queue()
+        self.process = None
+        # Associates metric names to (id, MetricMetadata) of metrics already sent.
+        self._metric_ids = {}
+        self._next_id = 0
+
+    def metric_id(self, metric):
+        """Return the id of metric, sending it to the writer first if needed."""
+        known = self._metric_ids.get(metric.name)
+        if known is not None:
+            metric_id, metadata = known
+            if metadata is metric.metadata or metadata.as_json() == metric.metadata.as_json():
+                return metric_id
+        # New metrics, and metrics whose metadata changed, get a new id.
+        metric_id = self._next_id
+        self._next_id += 1
+        self._metric_ids[metric.name] = (metric_id, metric.metadata)
+        self.metrics.put((metric_id, metric.name, metric.metadata.as_json()))
+        return metric_id
+
+
+def _run_writer(index, accessor_factory, ring, metrics, errors, stopped,
+                checkpoint_interval):
+    """Main function of writer processes, their exceptions are sent to errors."""
+    try:
+        _write_until_stopped(
+            index, accessor_factory, ring, metrics, errors, stopped, checkpoint_interval)
+    except Exception as e:
+        errors.put("writer %d exited: %s" % (index, e))
+        raise
+
+
+def _write_until_stopped(index, accessor_factory, ring, metrics, errors, stopped,
+                         checkpoint_interval):
+    """Main loop of writer processes, write points until stopped and drained."""
+    accessor = accessor_factory(index)
+    accessor.connect()
+    id_to_metric = {}
+
+    def on_done(exception):
+        # Exceptions of drivers are not always picklable.
+        if exception:
+            errors.put("writer %d: %s" % (index, exception))
+
+    next_checkpoint = time.time() + checkpoint_interval
+    try:
+        while True:
+            columns = ring.get(timeout=_READ_TIMEOUT)
+            if columns is None and stopped.is_set():
+                break
+            if columns is not None:
+                # Points of a given metric are written together. They are contiguous in
+                # the ring (see insert_points_batch()), and kept as columns.
+                batch = collections.OrderedDict()
+                ids, timestamps, values = columns
+                start = 0
+                for metric_id, run in itertools.groupby(ids):
+                    end = start + len(list(run))
+                    while metric_id not in id_to_metric:
+                        new_id, name, metadata_json = metrics.get()
+                        metadata = bg_accessor.MetricMetadata.from_json(metadata_json)
+                        id_to_metric[new_id] = bg_accessor.Metric(name, metadata)
+                    entry = batch.get(metric_id)
+                    if entry is None:
+                        batch[metric_id] = (id_to_metric[metric_id], bg_accessor.DatapointColumns(
+                            timestamps[start:end], values[start:end]))
+                    else:
+                        entry[1].timestamps.extend(timestamps[start:end])
+                        entry[1].values.extend(values[start:end])
+                    start = end
+                try:
+                    accessor.insert_points_batch_async(batch.values(), on_done)
+                except Exception as e:
+                    on_done(e)
+            now = time.time()
+            if now >= next_checkpoint:
+                accessor.checkpoint()
+                next_checkpoint = now + checkpoint_interval
+    finally:
+        accessor.shutdown()
+
+
+# How long writers wait for points before checking whether they should stop.
+_READ_TIMEOUT = 0.1
+# How long insert_points_batch() waits for free slots before checking that the writer
+# is alive.
+_PUT_TIMEOUT = 1
+
+
+class WriterPool(object):
+    """Writes points from a pool of writer processes.
+
+    insert_points_batch() must be called by one thread at a time.
+    """
+
+    # Default number of points each ring buffer can hold, 20 bytes each.
+    DEFAULT_RING_CAPACITY = 100 * 1000
+    # Default number of seconds between checkpoints of the accessors of writers.
+    DEFAULT_CHECKPOINT_INTERVAL = 60
+
+    def __init__(self, accessor_factory, processes, on_error=None,
+                 ring_capacity=DEFAULT_RING_CAPACITY,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        """Create a stopped pool, call start() to fork the writers.
+
+        Args:
+          accessor_factory: Called with the index of a writer, in its process, to return
+            its accessor. It is connected by the writer and shut down once stopped.
+            Accessors of different writers must not share downsampler checkpoints.
+          processes: The number of writer processes.
+          on_error: Called with a WriterError when a writer fails to write points or
+            exits on an exception, from a thread of the pool.
+          ring_capacity: The number of points the ring buffer of each writer can hold,
+            insert_points_batch() waits for writers past that.
+          checkpoint_interval: Number of seconds between checkpoints of writers.
+        """
+        if processes < 1:
+            raise bg_accessor.InvalidArgumentError(
+                "Can not start %s writer processes" % processes)
+        self.__accessor_factory = accessor_factory
+        self.__on_error = on_error
+        self.__checkpoint_interval = checkpoint_interval
+        self.__writers = [_Writer(ring_capacity) for _ in xrange(processes)]
+        self.__errors = multiprocessing.Queue()
+        self.__stopped = multiprocessing.Event()
+        self.__error_reader = None  # setup by start()
+
+    def start(self):
+        """Fork the writer processes.
+
+        Call this before connecting accessors or starting threads in this process.
+        """
+        for index, writer in enumerate(self.__writers):
+            writer.process = multiprocessing.Process(
+                target=_run_writer,
+                name="BigGraphiteWriter-%d" % index,
+                args=(index, self.__accessor_factory, writer.ring, writer.metrics,
+                      self.__errors, self.__stopped, self.__checkpoint_interval),
+            )
+            writer.process.daemon = True
+            writer.process.start()
+        self.__error_reader = threading.Thread(
+            target=self.__read_errors, name="WriterPoolErrors")
+        self.__error_reader.daemon = True
+        self.__error_reader.start()
+
+    def insert_points_batch(self, metrics_and_datapoints):
+        """Hand points to the writers of their metrics.
+
+        Args:
+          metrics_and_datapoints: A list of (Metric, datapoints), see
+            Accessor.insert_points_batch_async().
+
+        Raises:
+          WriterError: if a writer exited while waiting for it to read points.
+        """
+        columns = [([], [], []) for _ in self.__writers]
+        for metric, datapoints in metrics_and_datapoints:
+            index = self.__writer_index(metric.name)
+            metric_id = self.__writers[index].metric_id(metric)
+            ids, timestamps, values = columns[index]
+            for timestamp, value in datapoints:
+                ids.append(metric_id)
+                timestamps.append(timestamp)
+                values.append(value)
+        for writer, (ids, timestamps, values) in zip(self.__writers, columns):
+            if ids:
+                writer.ring.put(ids, timestamps, values, writer.process)
+
+    def __writer_index(self, metric_name):
+        # Stable across processes and restarts, unlike hash(), so that the downsampling
+        # aggregates of a metric are in the checkpoint of its writer.
+        return (zlib.crc32(metric_name) & 0xffffffff) % len(self.__writers)
+
+    def stop(self):
+        """Wait for writers to write the points they were given, then stop them."""
+        self.__stopped.set()
+        for writer in self.__writers:
+            if writer.process:
+                writer.process.join()
+                writer.process = None
+        if self.__error_reader:
+            self.__errors.put(None)
+            self.__error_reader.join()
+            self.__error_reader = None
+
+    def __read_errors(self):
+        while True:
+            message = self.__errors.get()
+            if message is None:
+                return
+            logging.error("Failed to write points: %s", message)
+            if self.__on_error:
+                self.__on_error(WriterError(message))
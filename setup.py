@@ -56,6 +56,8 @@ setuptools.setup(
             'bg-carbon-cache = biggraphite.cli.bg_carbon_cache:main',
             'bg-import-whisper = biggraphite.cli.import_whisper:main',
             'bg-clusters-diff = biggraphite.cli.clusters_diff:main',
+            'bg-cache-warm = biggraphite.cli.cache_warm:main',
+            'bg-upgrade-schema = biggraphite.cli.upgrade_schema:main',
         ]
     },
 )
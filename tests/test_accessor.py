@@ -20,7 +20,9 @@ import unittest
 import mock
 
 from biggraphite import accessor as bg_accessor
+from biggraphite import sketches
 from biggraphite import test_utils as bg_test_utils
+from biggraphite.drivers import _downsampling as bg_ds
 
 _METRIC = bg_test_utils.make_metric("test.metric")
 _NAN = float("nan")
@@ -39,6 +41,8 @@ class TestAggregator(unittest.TestCase):
             ("minimum", 0),
             ("maximum", 3),
             ("total", 6),
+            ("percentile_50", 1),
+            ("percentile_99", 2),
         )
         for name, value_expected in expectations:
             aggregator = bg_accessor.Aggregator.from_config_name(name)
@@ -75,6 +79,7 @@ class TestAggregator(unittest.TestCase):
             ("minimum", 10),
             ("maximum", 120),
             ("total", 130),
+            ("percentile_90", 20),  # Approximated by the average.
         )
         for name, value_expected in expectations:
             aggregator = bg_accessor.Aggregator.from_config_name(name)
@@ -93,6 +98,92 @@ class TestAggregator(unittest.TestCase):
         )
         self.assertIsNone(bg_accessor.Aggregator.from_carbon_name(""))
 
+    def test_merge_sketches(self):
+        aggregator = bg_accessor.Aggregator.percentile_90
+        first, second = sketches.QuantileSketch(), sketches.QuantileSketch()
+        for v in xrange(50):
+            first.add(v)
+            second.add(v + 50)
+        merged = aggregator.merge_sketches([first.to_bytes(), second.to_bytes()])
+        self.assertAlmostEqual(89, merged, delta=89 * 0.01)
+
+
+class TestPointGrouper(unittest.TestCase):
+
+    def test_sketches(self):
+        metric = bg_test_utils.make_metric(
+            "test.metric", retention="60*1s:60*10s",
+            aggregator=bg_accessor.Aggregator.percentile_50)
+        stage = metric.retention[1]
+        # The median of the first two buckets is 0, the one of all values is 100.
+        values = [0] * 6 + [100] * 4 + [0] * 6 + [100] * 4 + [100] * 10
+        evicted = []
+        downsampler = bg_ds.Downsampler(
+            on_evict=lambda metric, points: evicted.extend(points))
+        evicted.extend(downsampler.feed(metric, list(enumerate(values))))
+        downsampler.flush()
+        # Points of open buckets are returned again once updated, keep the last ones.
+        stage_points = dict((p[0], p) for p in evicted if p[3] == stage)
+        rows = [
+            (timestamp * 1000, 0, value, count, extras["sketch"])
+            for timestamp, value, count, _, extras in sorted(stage_points.values())
+        ]
+        self.assertEqual(3, len(rows))
+
+        # The step of the points is the precision of the stage by default.
+        grouper = bg_accessor.PointGrouper(
+            metric, 0, 3 * stage.precision_ms, stage, [(True, rows)])
+        timestamps, values = zip(*grouper)
+        self.assertEqual((0, 10, 20), timestamps)
+        for expected, value in zip((0, 0, 100), values):
+            self.assertAlmostEqual(expected, value, delta=1)
+
+        # Coarser points are computed from the merged sketches of the stage.
+        grouper = bg_accessor.PointGrouper(
+            metric, 0, 3 * stage.precision_ms, stage, [(True, rows)],
+            step_ms=3 * stage.precision_ms)
+        (timestamp, value), = list(grouper)
+        self.assertEqual(0, timestamp)
+        self.assertAlmostEqual(100, value, delta=1)
+
+        # Without sketches, values are used.
+        rows = [row[:4] for row in rows]
+        grouper = bg_accessor.PointGrouper(
+            metric, 0, 3 * stage.precision_ms, stage, [(True, rows)],
+            step_ms=3 * stage.precision_ms)
+        self.assertEqual([(0, 0)], list(grouper))
+
+    def test_aggregator(self):
+        metric = bg_test_utils.make_metric(
+            "test.metric", aggregator=bg_accessor.Aggregator.last)
+        stage = metric.retention[1]
+        rows = [
+            (0, 0, 3.0, 2, None, 1.0, 3.0, 4.0),
+            (0, 1000, 5.0, 1, None, 5.0, 5.0, 5.0),
+            # Without all aggregates, the value is used.
+            (0, 2000, 6.0, 2),
+        ]
+        for aggregator, expected in (
+                (bg_accessor.Aggregator.minimum, 1.0),
+                (bg_accessor.Aggregator.maximum, 6.0),
+                (bg_accessor.Aggregator.total, 21.0),
+                (bg_accessor.Aggregator.average, 21.0 / 5)):
+            grouper = bg_accessor.PointGrouper(
+                metric, 0, stage.precision_ms, stage, [(True, rows)], aggregator)
+            self.assertEqual([(0, expected)], list(grouper), aggregator)
+
+    def test_fetch_points_aggregator(self):
+        accessor = bg_test_utils.FakeAccessor()
+        accessor.connect()
+        metric = bg_test_utils.make_metric(
+            "test.metric", aggregator=bg_accessor.Aggregator.average)
+        stage = metric.retention[0]
+        accessor.fetch_points(metric, 0, stage.precision, stage, bg_accessor.Aggregator.total)
+        self.assertRaises(
+            bg_accessor.InvalidArgumentError,
+            accessor.fetch_points, metric, 0, stage.precision, stage,
+            bg_accessor.Aggregator.percentile_90)
+
 
 class TestStage(unittest.TestCase):
     # A lot is tested through TestRetention
@@ -163,6 +254,17 @@ class TestMetric(unittest.TestCase):
         self.assertIn("carbon_xfilesfactor", dir(metric))
 
 
+class TestDatapointColumns(unittest.TestCase):
+
+    def test_sorted(self):
+        columns = bg_accessor.DatapointColumns([1, 2, 3], [10, 20, 30])
+        self.assertIs(columns, columns.sorted())
+        self.assertEqual([(1, 10), (2, 20), (3, 30)], list(columns))
+
+        columns = bg_accessor.DatapointColumns([2, 1, 2], [20, 10, 0])
+        self.assertEqual(sorted(columns), list(columns.sorted()))
+
+
 class TestAccessor(bg_test_utils.TestCaseWithFakeAccessor):
 
     def test_context_manager(self):
@@ -172,6 +274,24 @@ class TestAccessor(bg_test_utils.TestCaseWithFakeAccessor):
             self.assertTrue(self.accessor.is_connected)
         self.assertFalse(self.accessor.is_connected)
 
+    def test_get_metrics(self):
+        metric = bg_test_utils.make_metric("test.metric")
+        self.accessor.create_metric(metric)
+        metrics = self.accessor.get_metrics(["test.absent", metric.name])
+        self.assertIsNone(metrics[0])
+        self.assertEqual(metric.name, metrics[1].name)
+
+    def test_insert_points_batch_async(self):
+        metrics = [bg_test_utils.make_metric(name) for name in "test.a", "test.b"]
+        for metric in metrics:
+            self.accessor.create_metric(metric)
+        on_done = mock.Mock()
+        self.accessor.insert_points_batch_async(
+            [(metrics[0], [(1, 42)]), (metrics[1], [(1, 43)])], on_done)
+        on_done.assert_called_once_with(None)
+        stage = metrics[0].retention[0]
+        self.assertEqual([(1, 43)], list(self.accessor.fetch_points(metrics[1], 1, 2, stage)))
+
     def test_insert_error(self):
         """Check that errors propagate from asynchronous API calls to synchronous ones."""
         class CustomException(Exception):
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import os
+from os import path as os_path
+import shutil
+import tempfile
+import unittest
+
+from biggraphite import metadata_cache as bg_metadata_cache
+from biggraphite import test_utils as bg_test_utils
+from biggraphite.cli import cache_warm
+
+
+class TestMain(bg_test_utils.TestCaseWithFakeAccessor):
+
+    def setUp(self):
+        super(TestMain, self).setUp()
+        self.fake_drivers()
+        # self.tempdir is already used by self.metadata_cache, and lmdb environments
+        # must not be opened twice by a process.
+        self.storage_dirs = []
+        for _ in xrange(2):
+            storage_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, storage_dir)
+            self.storage_dirs.append(storage_dir)
+        self.metric_names = ["a.b.c", "a.b.d", "x.y"]
+        for metric_name in self.metric_names:
+            self.accessor.create_metric(bg_test_utils.make_metric(metric_name))
+
+    def get_cache_counts(self, storage_dir):
+        """Return (hit_count, miss_count) for a lookup of all metrics."""
+        cache = bg_metadata_cache.DiskCache(self.accessor, storage_dir)
+        cache.open()
+        try:
+            cache.get_metrics(self.metric_names)
+            return cache.hit_count, cache.miss_count
+        finally:
+            cache.close()
+
+    def test_scan_export_import(self):
+        first, second = self.storage_dirs
+        snapshot = os_path.join(first, "snapshot")
+        cache_warm.main(["scan", first, "localhost"])
+        self.assertEqual((3, 0), self.get_cache_counts(first))
+
+        cache_warm.main(["export", first, snapshot])
+        # The temporary file was renamed.
+        self.assertEqual(["biggraphite", "snapshot"], sorted(os.listdir(first)))
+        cache_warm.main(["import", second, snapshot])
+        self.assertEqual((3, 0), self.get_cache_counts(second))
+
+    def test_import_corrupted(self):
+        snapshot = os_path.join(self.storage_dirs[0], "snapshot")
+        with open(snapshot, "wb") as f:
+            # A gzip header followed by an invalid deflate block.
+            f.write(b"\x1f\x8b\x08\x00" + b"\x00" * 6 + b"\xff" * 8)
+        self.assertRaises(
+            SystemExit, cache_warm.main, ["import", self.storage_dirs[1], snapshot])
+
+    def test_import_invalid(self):
+        snapshot = os_path.join(self.storage_dirs[0], "snapshot")
+        with open(snapshot, "w") as f:
+            f.write("not a snapshot")
+        self.assertRaises(
+            SystemExit, cache_warm.main, ["import", self.storage_dirs[1], snapshot])
+
+
+if __name__ == "__main__":
+    unittest.main()
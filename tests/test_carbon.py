@@ -17,10 +17,14 @@ from __future__ import print_function
 from biggraphite import test_utils as bg_test_utils   # noqa
 bg_test_utils.prepare_graphite_imports()  # noqa
 
+import os
+import threading
 import unittest
 
+import mock
 from carbon import conf as carbon_conf
 from carbon import exceptions as carbon_exceptions
+from twisted.internet import defer
 
 from biggraphite.plugins import carbon as bg_carbon
 
@@ -38,6 +42,7 @@ class TestCarbonDatabase(bg_test_utils.TestCaseWithFakeAccessor):
         settings["BG_KEYSPACE"] = self.KEYSPACE
         settings["STORAGE_DIR"] = self.tempdir
         self._plugin = bg_carbon.BigGraphiteDatabase(settings)
+        self.addCleanup(self._plugin.stop)
         self._plugin.create(
             _TEST_METRIC,
             retentions=[(1, 60)],
@@ -86,12 +91,153 @@ class TestCarbonDatabase(bg_test_utils.TestCaseWithFakeAccessor):
         metric = bg_test_utils.make_metric(_TEST_METRIC)
         points = [(1, 42)]
         self.accessor.create_metric(metric)
-        # Writing twice (the first write is sync and the next one isn't)
         self._plugin.write(metric.name, points)
         self._plugin.write(metric.name, points)
+        self._plugin.flush()
         actual_points = self.accessor.fetch_points(metric, 1, 2, stage=metric.retention[0])
         self.assertEqual(points, list(actual_points))
 
+    def test_write_absent(self):
+        self.accessor.insert_points_batch_async = mock.Mock()
+        self.assertRaises(ValueError, self._plugin.write, "test.absent", [(1, 42)])
+        self._plugin.flush()
+        self.accessor.insert_points_batch_async.assert_not_called()
+
+    def test_stop(self):
+        metric = bg_test_utils.make_metric(_TEST_METRIC)
+        self.accessor.create_metric(metric)
+        self.accessor.checkpoint = mock.Mock()
+        self._plugin.write(metric.name, [(1, 42)])
+        self._plugin.stop()
+        self.assertFalse(self._plugin._flusher.is_alive())
+        actual_points = self.accessor.fetch_points(metric, 1, 2, stage=metric.retention[0])
+        self.assertEqual([(1, 42)], list(actual_points))
+        self.accessor.checkpoint.assert_called_once_with()
+
+    def test_write_error(self):
+        metric = bg_test_utils.make_metric(_TEST_METRIC)
+        self.accessor.create_metric(metric)
+
+        class WriteError(Exception):
+            pass
+
+        def insert_points_async(metric, datapoints, on_done=None):
+            on_done(WriteError("write failed"))
+
+        self.accessor.insert_points_async = insert_points_async
+        self._plugin.write(metric.name, [(1, 42)])
+        self._plugin.flush()
+        # Errors of asynchronous writes are raised by the following write.
+        self.assertRaises(WriteError, self._plugin.write, metric.name, [(1, 42)])
+        # And only once.
+        self.accessor.insert_points_async = mock.Mock()
+        self._plugin.write(metric.name, [(1, 42)])
+
+    def test_write_batch(self):
+        metric = bg_test_utils.make_metric(_TEST_METRIC)
+        self.accessor.create_metric(metric)
+        self.accessor.insert_points_batch_async = mock.Mock()
+        self._plugin._batch_max_points = 3
+        self._plugin.write(metric.name, [(1, 42), (2, 42)])
+        self.accessor.insert_points_batch_async.assert_not_called()
+
+        self._plugin.write(metric.name, [(3, 42)])
+        self.assertEqual(1, self.accessor.insert_points_batch_async.call_count)
+        batch = self.accessor.insert_points_batch_async.call_args[0][0]
+        self.assertEqual([[(1, 42), (2, 42)], [(3, 42)]], [points for _, points in batch])
+
+    def test_write_async(self):
+        metric = bg_test_utils.make_metric(_TEST_METRIC)
+        self.accessor.create_metric(metric)
+        results = []
+        with mock.patch.object(bg_carbon.threads, "deferToThread", defer.maybeDeferred), \
+                mock.patch.object(bg_carbon.reactor, "callFromThread", lambda f, *a: f(*a)):
+            d = self._plugin.write_async(metric.name, [(1, 42)])
+            d.addCallback(results.append)
+            self.assertEqual([], results)
+            self._plugin.flush()
+            self.assertEqual([None], results)
+
+            d = self._plugin.exists_async(metric.name)
+            d.addCallback(results.append)
+            self.assertEqual([None, True], results)
+
+    def test_write_async_error(self):
+        metric = bg_test_utils.make_metric(_TEST_METRIC)
+        self.accessor.create_metric(metric)
+
+        class WriteError(Exception):
+            pass
+
+        self.accessor.insert_points_batch_async = mock.Mock(side_effect=WriteError())
+        self._plugin._batch_max_points = 1
+        written = []
+
+        def defer_to_thread(f, *args):
+            written.append(defer.maybeDeferred(f, *args))
+            return written[-1]
+
+        failures = []
+        with mock.patch.object(bg_carbon.threads, "deferToThread", defer_to_thread), \
+                mock.patch.object(bg_carbon.reactor, "callFromThread", lambda f, *a: f(*a)):
+            d = self._plugin.write_async(metric.name, [(1, 42)])
+            d.addErrback(failures.append)
+            # Errors of the batch are reported once.
+            written[0].addErrback(failures.append)
+            self.assertEqual([WriteError], [failure.type for failure in failures])
+
+            # Errors raised before the points are batched are reported too.
+            d = self._plugin.write_async("test.absent", [(1, 42)])
+            d.addErrback(failures.append)
+            self.assertEqual(ValueError, failures[-1].type)
+
+    def test_checkpoint(self):
+        metric = bg_test_utils.make_metric(_TEST_METRIC)
+        self.accessor.create_metric(metric)
+        checkpointed = threading.Event()
+        self.accessor.checkpoint = mock.Mock(side_effect=checkpointed.set)
+        self._plugin.write(metric.name, [(1, 42)])
+        self.accessor.checkpoint.assert_not_called()
+
+        # Checkpoints are done by the flusher thread.
+        self._plugin._next_checkpoint = 0
+        self.assertTrue(checkpointed.wait(10))
+
+    def _make_twisted_plugin(self):
+        settings = carbon_conf.Settings()
+        settings["BG_CONTACT_POINTS"] = "host1,host2"
+        settings["BG_KEYSPACE"] = self.KEYSPACE
+        settings["BG_CASSANDRA_CONNECTION"] = "twisted"
+        # The cache of the plugin of setUp() cannot be opened twice.
+        settings["STORAGE_DIR"] = os.path.join(self.tempdir, "twisted")
+        os.mkdir(settings["STORAGE_DIR"])
+        with mock.patch.object(bg_carbon.reactor, "callWhenRunning") as call_when_running:
+            plugin = bg_carbon.BigGraphiteDatabase(settings)
+        self.addCleanup(plugin.stop)
+        call_when_running.assert_called_once_with(plugin._connect_from_reactor)
+        return plugin
+
+    def test_twisted_connection(self):
+        self.accessor.connect = mock.Mock()
+        plugin = self._make_twisted_plugin()
+        # Connecting before Carbon runs the reactor would run it in a thread.
+        self.accessor.connect.assert_not_called()
+        with mock.patch.object(bg_carbon.threads, "deferToThread", defer.maybeDeferred):
+            plugin._connect_from_reactor()
+        self.accessor.connect.assert_called_once_with()
+        self.assertTrue(plugin.exists(_TEST_METRIC))
+
+    def test_twisted_connection_error(self):
+        self.accessor.connect = mock.Mock(side_effect=IOError("connection refused"))
+        plugin = self._make_twisted_plugin()
+        with mock.patch.object(bg_carbon.threads, "deferToThread", defer.maybeDeferred), \
+                mock.patch.object(bg_carbon.reactor, "stop") as stop, \
+                mock.patch.object(bg_carbon.log, "err"):
+            plugin._connect_from_reactor()
+        stop.assert_called_once_with()
+        # Instead of waiting forever.
+        self.assertRaises(IOError, plugin.exists, _TEST_METRIC)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -14,10 +14,12 @@
 # limitations under the License.
 from __future__ import print_function
 
+import threading
 import unittest
 
 from biggraphite import accessor as bg_accessor
 from biggraphite import test_utils as bg_test_utils
+from biggraphite.drivers import cassandra as bg_cassandra
 
 _METRIC = bg_test_utils.make_metric("test.metric")
 
@@ -35,6 +37,32 @@ _USEFUL_POINTS = _POINTS[_EXTRA_POINTS:-_EXTRA_POINTS]
 assert _QUERY_RANGE == len(_USEFUL_POINTS)
 
 
+class TestCassandraHelpers(unittest.TestCase):
+
+    def test_time_window_seconds(self):
+        row_size_s = bg_cassandra._ROW_SIZE_MS // 1000
+        for retention in "60*1s", "86400*1s", "2000*60s", "365*86400s":
+            stage = bg_accessor.Stage.from_string(retention)
+            window = bg_cassandra._time_window_seconds(stage)
+            self.assertEqual(0, window % row_size_s)
+            self.assertGreaterEqual(window, row_size_s)
+            self.assertLessEqual(stage.duration // window, bg_cassandra._MAX_WINDOWS_PER_TABLE)
+
+    def test_split_token_ring(self):
+        ranges = bg_cassandra._split_token_ring(7)
+        self.assertEqual(7, len(ranges))
+        self.assertEqual(bg_cassandra._MIN_TOKEN, ranges[0][0])
+        self.assertEqual(bg_cassandra._MAX_TOKEN, ranges[-1][1])
+        for (_, prev_end), (start, end) in zip(ranges, ranges[1:]):
+            self.assertEqual(prev_end, start)
+            self.assertLess(start, end)
+
+    def test_unknown_connection(self):
+        self.assertRaises(
+            bg_cassandra.InvalidArgumentError,
+            bg_cassandra.connect, "keyspace", ["localhost"], connection="nosuchloop")
+
+
 class TestAccessorWithCassandra(bg_test_utils.TestCaseWithAccessor):
 
     def fetch(self, metric, *args, **kwargs):
@@ -77,6 +105,22 @@ class TestAccessorWithCassandra(bg_test_utils.TestCaseWithAccessor):
         self.assertEqual(_USEFUL_POINTS[-10:], fetched[-10:])
         self.assertEqual(_USEFUL_POINTS, fetched)
 
+    def test_insert_batch_fetch(self):
+        other_metric = bg_test_utils.make_metric(_METRIC.name + "_other")
+        done = threading.Event()
+        exceptions = []
+
+        def on_done(exception):
+            exceptions.append(exception)
+            done.set()
+
+        self.accessor.insert_points_batch_async(
+            [(_METRIC, _POINTS), (other_metric, _POINTS[:1])], on_done)
+        self.addCleanup(self.accessor.drop_all_metrics)
+        done.wait()
+        self.assertEqual([None], exceptions)
+        self.assertEqual(_USEFUL_POINTS, self.fetch(_METRIC, _QUERY_START, _QUERY_END))
+
     @staticmethod
     def _remove_after_dot(string):
         if "." not in string:
@@ -123,6 +167,20 @@ class TestAccessorWithCassandra(bg_test_utils.TestCaseWithAccessor):
         self.accessor.drop_all_metrics()
         assert_find("*", [])
 
+    def test_iter_all(self):
+        names = ["a", "a.b", "x.y.z"]
+        for name in names:
+            self.accessor.create_metric(bg_test_utils.make_metric(name))
+
+        self.assertEqual(names, sorted(m.name for m in self.accessor.iter_all_metrics()))
+        self.assertEqual(["a", "x", "x.y"], sorted(self.accessor.iter_all_directories()))
+
+        # Scanning each range on its own gives the same results.
+        found = []
+        for token_range in self.accessor.scan_ranges(5):
+            found.extend(m.name for m in self.accessor.iter_all_metrics([token_range]))
+        self.assertEqual(names, sorted(found))
+
     def test_create_metrics(self):
         meta_dict = {
             "aggregator": bg_accessor.Aggregator.last,
@@ -137,6 +195,61 @@ class TestAccessorWithCassandra(bg_test_utils.TestCaseWithAccessor):
         for k, v in meta_dict.iteritems():
             self.assertEqual(v, getattr(metric_again.metadata, k))
 
+    def test_get_metrics(self):
+        metric = bg_test_utils.make_metric("a.b.c.d.e.f")
+        self.accessor.create_metric(metric)
+        absent, metric_again = self.accessor.get_metrics(["a.b.c.d.e.absent", metric.name])
+        self.assertIsNone(absent)
+        self.assertEqual(metric.name, metric_again.name)
+        self.assertEqual(metric.metadata.as_json(), metric_again.metadata.as_json())
+
+    def test_upgrade_datapoints_tables(self):
+        self.accessor.insert_points(_METRIC, _POINTS[:1])
+        stage = _METRIC.retention[0]
+        self.accessor.shutdown()
+
+        twcs_accessor = bg_cassandra.connect(
+            self.KEYSPACE, self.contact_points, self.port,
+            compaction_strategy=bg_cassandra.TIME_WINDOW_COMPACTION,
+        )
+        twcs_accessor.connect()
+        self.addCleanup(twcs_accessor.shutdown)
+        table_name = "datapoints_{}p_{}s".format(stage.points, stage.precision)
+        session = twcs_accessor._CassandraAccessor__session
+
+        def get_compaction_class():
+            rows = list(session.execute(
+                "SELECT compaction FROM system_schema.tables"
+                " WHERE keyspace_name = %s AND table_name = %s;",
+                (self.KEYSPACE, table_name)))
+            return rows[0][0]["class"]
+
+        # Connecting does not alter tables.
+        self.assertIn("DateTieredCompactionStrategy", get_compaction_class())
+        twcs_accessor.upgrade_datapoints_tables()
+        self.assertIn("TimeWindowCompactionStrategy", get_compaction_class())
+
+    def test_missing_columns(self):
+        self.accessor.insert_points(_METRIC, _POINTS[:1])
+        self.addCleanup(self.accessor.drop_all_metrics)
+        stage = _METRIC.retention[0]
+        table_name = "datapoints_{}p_{}s".format(stage.points, stage.precision)
+        session = self.accessor._CassandraAccessor__session
+        for column, _ in bg_cassandra._DATAPOINTS_ADDED_COLUMNS:
+            session.execute("ALTER TABLE \"%s\".%s DROP %s;" % (self.KEYSPACE, table_name, column))
+        # So that statements are prepared again.
+        self.accessor.shutdown()
+        self.accessor.connect()
+
+        # Tables created before the columns were added are still readable and writable.
+        self.accessor.insert_points(_METRIC, _POINTS[1:2])
+        self.assertEqual(_POINTS[:2], self.fetch(_METRIC, _POINTS_START, _POINTS_START + 2))
+
+        self.accessor.upgrade_datapoints_tables()
+        columns = self.accessor._CassandraAccessor__lazy_statements._get_columns(stage)
+        for column, _ in bg_cassandra._DATAPOINTS_ADDED_COLUMNS:
+            self.assertIn(column, columns)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -15,12 +15,32 @@
 
 from __future__ import print_function
 
+import os
+import random
+import shutil
+import tempfile
+import threading
 import unittest
 
+import mock
+
 from biggraphite import accessor as bg_accessor
+from biggraphite import sketches
 from biggraphite.drivers import _downsampling as bg_ds
 
 
+class TestSortedPoints(unittest.TestCase):
+
+    def test_sorted_points(self):
+        points = [(0, 1), (1, 0), (2, 2)]
+        self.assertIs(points, bg_ds._sorted_points(points))
+        self.assertEqual([], bg_ds._sorted_points([]))
+        self.assertEqual(points, bg_ds._sorted_points([(1, 0), (0, 1), (2, 2)]))
+        self.assertEqual(points, bg_ds._sorted_points(iter(points)))
+        # Points with the same timestamp are still sorted by value.
+        self.assertEqual([(0, 1), (0, 2)], bg_ds._sorted_points([(0, 2), (0, 1)]))
+
+
 class TestDownsampler(unittest.TestCase):
     METRIC_NAME = "test.metric"
     PRECISION = 10
@@ -105,6 +125,384 @@ class TestDownsampler(unittest.TestCase):
         result = self.ds.feed(self.metric, points)
         self.assertEqual(result, expected)
 
+    def test_columns(self):
+        """Check that points fed as columns produce the same points as tuples."""
+        points = [(self.PRECISION * 4, 4), (0, 1), (self.PRECISION, 2)]
+        expected = self.ds.feed(self.metric, points)
+        ds = bg_ds.Downsampler(self.CAPACITY)
+        columns = bg_accessor.DatapointColumns(*zip(*points))
+        self.assertEqual(expected, ds.feed(self.metric, columns))
+
+    def test_eviction(self):
+        """Check that least recently used metrics are flushed and evicted."""
+        on_evict = mock.Mock()
+        ds = bg_ds.Downsampler(self.CAPACITY, max_metrics=2, on_evict=on_evict)
+        other_metrics = [
+            bg_accessor.Metric(self.METRIC_NAME + str(n), self.metric.metadata)
+            for n in xrange(2)
+        ]
+        points = [(0, 1), (self.PRECISION, 2)]
+        self.assertEqual([], ds.feed(self.metric, points))
+        self.assertEqual([], ds.feed(other_metrics[0], points))
+        # self.metric is now the most recently used.
+        self.assertEqual([], ds.feed(self.metric, []))
+        on_evict.assert_not_called()
+
+        ds.feed(other_metrics[1], points)
+        expected = [
+            (0, 1, 1, self.stage_0),
+            (self.PRECISION, 2, 1, self.stage_0),
+            (0, 3, 2, self.stage_1),
+        ]
+        on_evict.assert_called_once_with(other_metrics[0], expected)
+
+        on_evict.reset_mock()
+        ds.flush()
+        self.assertEqual(2, on_evict.call_count)
+
+    def test_eviction_reentry(self):
+        """Check that metrics fed again after eviction merge their open buckets."""
+        on_evict = mock.Mock()
+        ds = bg_ds.Downsampler(self.CAPACITY, max_metrics=1, on_evict=on_evict)
+        other_metric = bg_accessor.Metric(self.METRIC_NAME + "2", self.metric.metadata)
+        ds.feed(self.metric, [(0, 1), (self.PRECISION, 2)])
+        ds.feed(other_metric, [(0, 1)])
+        self.assertIn((0, 3, 2, self.stage_1), on_evict.call_args[0][1])
+
+        # The bucket written on eviction is complemented, not overwritten.
+        ds.feed(self.metric, [(2 * self.PRECISION, 4)])
+        ds.flush()
+        self.assertIn((0, 7, 3, self.stage_1), on_evict.call_args[0][1])
+
+        # Restored buckets are closed by points of later buckets.
+        on_evict.reset_mock()
+        ds.feed(self.metric, [(self.PRECISION ** 2, 8)])
+        ds.flush()
+        self.assertIn((self.PRECISION ** 2, 8, 1, self.stage_1), on_evict.call_args[0][1])
+        self.assertIn((0, 7, 3, self.stage_1), on_evict.call_args[0][1])
+
+        # Feeding no points restores them too.
+        ds.feed(self.metric, [])
+        ds.flush()
+        self.assertIn((self.PRECISION ** 2, 8, 1, self.stage_1), on_evict.call_args[0][1])
+
+    def test_eviction_matches_unbounded(self):
+        """Check that evicting metrics does not change the points written in the end."""
+        metrics = [
+            bg_accessor.Metric(self.METRIC_NAME + str(n), bg_accessor.MetricMetadata(
+                aggregator=aggregator, retention=self.metric.metadata.retention))
+            for n, aggregator in enumerate((
+                bg_accessor.Aggregator.total,
+                bg_accessor.Aggregator.average,
+                bg_accessor.Aggregator.percentile_50,
+                bg_accessor.Aggregator.maximum,
+            ))
+        ]
+        # Random feeds, with points out of order, fed again, stale or none at all.
+        rng = random.Random(0)
+        clocks = dict.fromkeys(metrics, 0)
+        feeds = []
+        for _ in xrange(500):
+            metric = rng.choice(metrics)
+            clocks[metric] += rng.randint(0, self.PRECISION * self.CAPACITY)
+            points = [
+                (max(0, clocks[metric] - rng.randint(0, 2 * self.PRECISION ** 2)),
+                 float(rng.randint(0, 10)))
+                for _ in xrange(rng.randint(0, 3))
+            ]
+            feeds.append((metric, points))
+
+        def written_points(ds):
+            # The last point written for each bucket of each stage of each metric.
+            written = {}
+
+            def write(metric, points):
+                for point in points:
+                    written[metric.name, point[3].precision, point[0]] = point[1:3] + point[4:]
+
+            ds._on_evict = write
+            for metric, points in feeds:
+                write(metric, ds.feed(metric, points))
+            ds.flush()
+            return written
+
+        for all_aggregates in False, True:
+            expected = written_points(bg_ds.Downsampler(
+                self.CAPACITY, all_aggregates=all_aggregates))
+            actual = written_points(bg_ds.Downsampler(
+                self.CAPACITY, max_metrics=1, all_aggregates=all_aggregates))
+            self.assertEqual(expected, actual)
+
+    def test_slab(self):
+        """Check that metrics of the same shape share a slab and reuse slots."""
+        ds = bg_ds.Downsampler(self.CAPACITY, max_metrics=2)
+        for n in xrange(3):
+            metric = bg_accessor.Metric(self.METRIC_NAME + str(n), self.metric.metadata)
+            ds.feed(metric, [(0, n)])
+        slab, = ds._slabs
+        self.assertEqual(2, len(slab))
+        # The evicted metric's slot was reused rather than a new one allocated.
+        self.assertEqual(2 * slab.stages, len(slab.counts))
+
+        ds.flush()
+        self.assertEqual(0, len(slab))
+
+    def test_percentile(self):
+        """Check that coarse points of percentile aggregators come with sketches."""
+        metadata = bg_accessor.MetricMetadata(
+            aggregator=bg_accessor.Aggregator.percentile_90,
+            retention=self.metric.metadata.retention)
+        metric = bg_accessor.Metric(self.METRIC_NAME, metadata)
+        points = [(t, t) for t in xrange(0, self.PRECISION ** 2, self.PRECISION)]
+        # Expire all points from the raw buffer.
+        points.append((self.PRECISION ** 3, 0))
+        result = self.ds.feed(metric, points)
+
+        stage_0_points = [p for p in result if p[3] == self.stage_0]
+        self.assertTrue(all(len(p) == 4 for p in stage_0_points))
+        (timestamp, value, count, stage, extras), = [p for p in result if p[3] == self.stage_1]
+        self.assertEqual((0, 10, self.stage_1), (timestamp, count, stage))
+        self.assertAlmostEqual(80, value, delta=0.8)
+        sketch = sketches.QuantileSketch.from_bytes(extras["sketch"])
+        self.assertEqual(value, sketch.quantile(0.9))
+
+        # Sketches of open buckets survive checkpoints.
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, "checkpoint")
+        self.ds.feed(metric, [(self.PRECISION ** 3 + self.PRECISION, 1)])
+        self.ds.save(path)
+        ds = bg_ds.Downsampler(self.CAPACITY)
+        ds.load(path)
+        later_points = [(self.PRECISION ** 4, 0)]
+        self.assertEqual(
+            self.ds.feed(metric, later_points), ds.feed(metric, later_points))
+
+    def test_all_aggregates(self):
+        """Check that coarse points carry all aggregates when asked to."""
+        ds = bg_ds.Downsampler(self.CAPACITY, all_aggregates=True)
+        points = [(0, 3), (self.PRECISION, 1), (2 * self.PRECISION, 2)]
+        # Expire all points from the raw buffer.
+        points.append((self.PRECISION ** 2, 5))
+        result = ds.feed(self.metric, points)
+
+        stage_0_points = [p for p in result if p[3] == self.stage_0]
+        self.assertTrue(all(len(p) == 4 for p in stage_0_points))
+        stage_1_points = [p for p in result if p[3] == self.stage_1]
+        self.assertEqual([
+            (0, 6, 3, self.stage_1, {"minimum": 1, "maximum": 3, "total": 6}),
+        ], stage_1_points)
+
+        # Extras survive checkpoints.
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, "checkpoint")
+        ds.save(path)
+        other = bg_ds.Downsampler(self.CAPACITY)
+        other.load(path)
+        later_points = [(self.PRECISION ** 2 + self.PRECISION, 4), (self.PRECISION ** 3, 0)]
+        result = other.feed(self.metric, later_points)
+        self.assertEqual(result, ds.feed(self.metric, later_points))
+        self.assertIn(
+            (self.PRECISION ** 2, 9, 2, self.stage_1, {"minimum": 4, "maximum": 5, "total": 9}),
+            result)
+
+        # Percentile aggregators get both sketches and extras.
+        metadata = bg_accessor.MetricMetadata(
+            aggregator=bg_accessor.Aggregator.percentile_50,
+            retention=self.metric.metadata.retention)
+        metric = bg_accessor.Metric("test.percentile", metadata)
+        stage_1_extras = [p[4] for p in ds.feed(metric, points) if p[3] == self.stage_1]
+        self.assertEqual(["maximum", "minimum", "sketch", "total"], sorted(stage_1_extras[0]))
+
+    def test_closed_buckets_only(self):
+        """Check that points of open buckets are only returned once closed."""
+        on_evict = mock.Mock()
+        ds = bg_ds.Downsampler(self.CAPACITY, on_evict=on_evict, open_buckets_interval=None)
+        # Expires (0, 1) from the raw buffer, buckets of stage 0 only hold one raw point
+        # so that its bucket is closed, unlike the one of stage 1.
+        points = [(0, 1), (self.PRECISION * self.CAPACITY, 2)]
+        self.assertEqual([(0, 1, 1, self.stage_0)], ds.feed(self.metric, points))
+
+        # Expires (30, 2), points of stage 0 are not returned twice.
+        points = [(self.PRECISION ** 2 + self.PRECISION * self.CAPACITY, 3)]
+        self.assertEqual(
+            [(self.PRECISION * self.CAPACITY, 2, 1, self.stage_0)],
+            ds.feed(self.metric, points))
+        self.assertEqual([], ds.feed(self.metric, []))
+
+        # Open buckets are returned when flushed.
+        ds.flush()
+        self.assertIn((0, 3, 2, self.stage_1), on_evict.call_args[0][1])
+
+    def test_open_buckets_interval(self):
+        """Check that points of open buckets are returned at most every interval."""
+        ds = bg_ds.Downsampler(self.CAPACITY, open_buckets_interval=60)
+        points = [(0, 1), (self.PRECISION * self.CAPACITY, 2)]
+        with mock.patch("time.time", return_value=1000):
+            self.assertEqual(2, len(ds.feed(self.metric, points)))
+        with mock.patch("time.time", return_value=1030):
+            self.assertEqual([], ds.feed(self.metric, []))
+        with mock.patch("time.time", return_value=1060):
+            self.assertEqual(2, len(ds.feed(self.metric, [])))
+
+    def test_flush_idle(self):
+        """Check that only metrics not fed recently are evicted."""
+        on_evict = mock.Mock()
+        ds = bg_ds.Downsampler(self.CAPACITY, on_evict=on_evict)
+        other_metric = bg_accessor.Metric(self.METRIC_NAME + "2", self.metric.metadata)
+        with mock.patch("time.time", return_value=1000):
+            ds.feed(self.metric, [(0, 1)])
+        with mock.patch("time.time", return_value=1100):
+            ds.feed(other_metric, [(0, 1)])
+
+        ds.flush_idle(60, now=1150)
+        on_evict.assert_called_once_with(
+            self.metric, [(0, 1, 1, self.stage_0), (0, 1, 1, self.stage_1)])
+        ds.flush_idle(60, now=1200)
+        self.assertEqual(2, on_evict.call_count)
+
+    def test_save_load(self):
+        """Check that a checkpoint restores aggregates."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, "checkpoint")
+        points = [(0, 1), (self.PRECISION, 2)]
+        self.ds.feed(self.metric, points)
+        self.ds.save(path)
+
+        # Temporary files were renamed.
+        self.assertEqual(["checkpoint"], os.listdir(tempdir))
+
+        ds = bg_ds.Downsampler(self.CAPACITY)
+        ds.load(path)
+        # Both instances produce the same points from now on.
+        later_points = [(self.PRECISION ** 3, 3)]
+        expected = self.ds.feed(self.metric, later_points)
+        self.assertNotEqual([], expected)
+        self.assertEqual(expected, ds.feed(self.metric, later_points))
+
+    def test_load_errors(self):
+        """Check that missing checkpoints are ignored and invalid ones rejected."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, "checkpoint")
+        self.ds.load(path)
+
+        self.ds.feed(self.metric, [(0, 1)])
+        self.ds.save(path)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+        self.assertRaises(bg_ds.CheckpointError, self.ds.load, path)
+
+        with open(path, "wb") as f:
+            f.write("not a checkpoint")
+        self.assertRaises(bg_ds.CheckpointError, self.ds.load, path)
+
+
+class TestShardedDownsampler(unittest.TestCase):
+    PRECISION = 10
+    CAPACITY = 3
+
+    def setUp(self):
+        retention = bg_accessor.Retention.from_string(
+            "%d*%ds:%d*%ds" % (self.CAPACITY, self.PRECISION, self.CAPACITY, self.PRECISION ** 2))
+        self.metadata = bg_accessor.MetricMetadata(
+            aggregator=bg_accessor.Aggregator.total, retention=retention)
+        self.metrics = [bg_accessor.Metric("test.metric%d" % n, self.metadata) for n in xrange(20)]
+
+    def test_feed_concurrently(self):
+        """Check that threads feeding the same metrics produce consistent aggregates."""
+        on_evict = mock.Mock()
+        ds = bg_ds.ShardedDownsampler(4, self.CAPACITY, on_evict=on_evict)
+        points = [(t, 1) for t in xrange(0, self.PRECISION ** 2, self.PRECISION)]
+
+        def feed():
+            for metric in self.metrics:
+                for point in points:
+                    ds.feed(metric, [point])
+
+        threads = [threading.Thread(target=feed) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ds.flush()
+
+        self.assertEqual(len(self.metrics), on_evict.call_count)
+        stage_1 = self.metadata.retention[1]
+        for (metric, evicted), _ in on_evict.call_args_list:
+            self.assertIn((0, 10, 10, stage_1), evicted)
+
+    def test_feed_batch(self):
+        """Check that feeding a batch produces the same points as feeding metrics."""
+        ds = bg_ds.ShardedDownsampler(4, self.CAPACITY)
+        other = bg_ds.ShardedDownsampler(4, self.CAPACITY)
+        points = [(t, 1) for t in xrange(0, self.PRECISION ** 2, self.PRECISION)]
+        produced = ds.feed_batch([(metric, points) for metric in self.metrics])
+
+        expected = [(metric, other.feed(metric, points)) for metric in self.metrics]
+        self.assertEqual(
+            sorted((metric.name, points) for metric, points in expected),
+            sorted((metric.name, points) for metric, points in produced))
+        # Metrics without points are left out.
+        metric = bg_accessor.Metric("test.other", self.metadata)
+        self.assertEqual([], ds.feed_batch([(metric, [])]))
+
+    def test_idle_flusher(self):
+        """Check that the flusher thread evicts idle metrics."""
+        evicted = threading.Event()
+        ds = bg_ds.ShardedDownsampler(4, self.CAPACITY, on_evict=lambda *args: evicted.set())
+        flusher = bg_ds.IdleFlusher(ds, max_idle=0.01, interval=0.01)
+        flusher.start()
+        self.addCleanup(flusher.stop)
+        ds.feed(self.metrics[0], [(0, 1)])
+        self.assertTrue(evicted.wait(5))
+
+    def test_save_load(self):
+        """Check that a checkpoint restores metrics in the right shards."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, "checkpoint")
+        ds = bg_ds.ShardedDownsampler(4, self.CAPACITY)
+        # Entries of percentile aggregators have a variable size.
+        percentile_metadata = bg_accessor.MetricMetadata(
+            aggregator=bg_accessor.Aggregator.percentile_90,
+            retention=self.metadata.retention)
+        metrics = self.metrics + [
+            bg_accessor.Metric("test.percentile%d" % n, percentile_metadata)
+            for n in xrange(4)
+        ]
+        for metric in metrics:
+            ds.feed(metric, [(0, 1)])
+        ds.save(path)
+
+        on_evict = mock.Mock()
+        other = bg_ds.ShardedDownsampler(4, self.CAPACITY, on_evict=on_evict)
+        other.load(path)
+        other.flush()
+        self.assertEqual(
+            sorted(m.name for m in metrics),
+            sorted(args[0].name for args, _ in on_evict.call_args_list))
+
+    def test_on_evict_unlocked(self):
+        """Check that on_evict is called once shards are unlocked."""
+        locked = []
+
+        def on_evict(metric, points):
+            lock = ds._locks[ds._shard_index(metric.name)]
+            if lock.acquire(False):
+                lock.release()
+            else:
+                locked.append(metric)
+
+        ds = bg_ds.ShardedDownsampler(1, self.CAPACITY, max_metrics=1, on_evict=on_evict)
+        for metric in self.metrics[:2]:
+            ds.feed(metric, [(0, 1)])
+        ds.feed_batch([(self.metrics[2], [(0, 1)])])
+        ds.flush()
+        self.assertEqual([], locked)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -15,10 +15,12 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import threading
 import unittest
 
 import mock
 
+from biggraphite import accessor as bg_accessor
 from biggraphite.drivers import _utils
 
 
@@ -48,5 +50,64 @@ class CountDownTest(unittest.TestCase):
         self.on_zero.assert_called_with(None)
 
 
+class WriteWindowTest(unittest.TestCase):
+
+    _CAPACITY = 4
+
+    def test_oversized(self):
+        window = _utils.WriteWindow(self._CAPACITY)
+        self.assertTrue(window.acquire(self._CAPACITY * 2))
+        self.assertEqual(self._CAPACITY * 2, window.in_flight)
+        window.release(self._CAPACITY * 2)
+        self.assertEqual(0, window.in_flight)
+
+    def test_block(self):
+        window = _utils.WriteWindow(self._CAPACITY)
+        self.assertTrue(window.acquire(self._CAPACITY))
+
+        acquired = threading.Event()
+
+        def acquire():
+            window.acquire(1)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        window.on_cassandra_result(None)
+        thread.join()
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(self._CAPACITY, window.in_flight)
+
+    def test_drop(self):
+        window = _utils.WriteWindow(self._CAPACITY, _utils.WriteWindow.DROP)
+        self.assertTrue(window.acquire(self._CAPACITY))
+        self.assertFalse(window.acquire(2))
+        self.assertEqual(2, window.dropped_count)
+        window.on_cassandra_failure(Exception())
+        self.assertTrue(window.acquire(1))
+
+    def test_callback(self):
+        on_capacity = mock.Mock()
+        window = _utils.WriteWindow(self._CAPACITY, _utils.WriteWindow.CALLBACK, on_capacity)
+        self.assertTrue(window.acquire(self._CAPACITY))
+        window.release()
+        on_capacity.assert_not_called()
+
+        self.assertFalse(window.acquire(2))
+        # Called once the window is half empty.
+        window.release()
+        on_capacity.assert_called_once_with()
+        window.release()
+        on_capacity.assert_called_once_with()
+
+    def test_invalid_policy(self):
+        self.assertRaises(
+            bg_accessor.InvalidArgumentError, _utils.WriteWindow, self._CAPACITY, "nosuchpolicy")
+        self.assertRaises(
+            bg_accessor.InvalidArgumentError,
+            _utils.WriteWindow, self._CAPACITY, _utils.WriteWindow.CALLBACK)
+
+
 if __name__ == "__main__":
     unittest.main()
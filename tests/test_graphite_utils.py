@@ -19,6 +19,7 @@ import unittest
 
 from biggraphite import test_utils as bg_test_utils
 from biggraphite import graphite_utils as bg_gu
+from biggraphite import metadata_cache as bg_metadata_cache
 
 
 class TestGraphiteUtilsInternals(unittest.TestCase):
@@ -48,6 +49,38 @@ class TestGraphiteUtilsInternals(unittest.TestCase):
         for s in lacks_contact_points, lacks_keyspace:
             self._check_settings_exception(s)
 
+    def test_local_driver_settings(self):
+        import types
+        settings = types.ModuleType("local_driver")
+        settings.BG_DRIVER = "local"
+        settings.BG_LOCAL_PATH = "/nonexistent"
+        accessor = bg_gu.accessor_from_settings(settings)
+        self.assertTrue(accessor.backend_name.startswith("local:"))
+
+        settings.BG_DRIVER = "nosuchdriver"
+        self._check_settings_exception(settings)
+
+    def test_bool_settings(self):
+        import types
+        settings = types.ModuleType("bool_settings")
+        self.assertFalse(bg_gu._get_bool_setting(settings, "BG_FLAG"))
+        for value in True, 1, "True", "yes", " on ":
+            settings.BG_FLAG = value
+            self.assertTrue(bg_gu._get_bool_setting(settings, "BG_FLAG"))
+        for value in False, 0, "False", "no", "off":
+            settings.BG_FLAG = value
+            self.assertFalse(bg_gu._get_bool_setting(settings, "BG_FLAG"))
+        for value in "ture", "", 2:
+            settings.BG_FLAG = value
+            self.assertRaises(bg_gu.ConfigError, bg_gu._get_bool_setting, settings, "BG_FLAG")
+
+    def test_metadata_cache_ttl_settings(self):
+        import types
+        settings = types.ModuleType("metadata_cache_ttl")
+        self.assertIsNone(bg_gu.metadata_cache_ttl_from_settings(settings))
+        settings.BG_METADATA_CACHE_TTL = "3600"
+        self.assertEqual(3600, bg_gu.metadata_cache_ttl_from_settings(settings))
+
     def test_is_graphite_glob(self):
         self.assertTrue(bg_gu._is_graphite_glob("a*"))
         self.assertTrue(bg_gu._is_graphite_glob("a.b*"))
@@ -89,6 +122,25 @@ class TestGraphiteUtils(bg_test_utils.TestCaseWithFakeAccessor):
         self.assertEqual((["a.a.a", "a.b.c", "a.b.d", "x.y.c"], []), bg_gu.glob(self.accessor, "*.*.*"))
         self.assertEqual((["a.b.c", "a.b.d"], []), bg_gu.glob(self.accessor, "*.{b,c,d,5}.?"))
 
+    def test_glob_namespace_index(self):
+        self.metadata_cache.close()
+        metadata_cache = bg_metadata_cache.DiskCache(
+            self.accessor, self.tempdir, index_max_age=3600)
+        metadata_cache.open()
+        self.addCleanup(metadata_cache.close)
+        metric = bg_test_utils.make_metric("a.b")
+        self.accessor.create_metric(metric)
+        self.assertEqual((["a.b"], []), bg_gu.glob(self.accessor, "a.*", metadata_cache))
+
+        # Once built, the index is used instead of the accessor.
+        metadata_cache.fill([bg_test_utils.make_metric("a.c")], complete=True)
+        self.assertEqual((["a.c"], []), bg_gu.glob(self.accessor, "a.*", metadata_cache))
+
+        # Unless it has no match, names found by the accessor are then indexed.
+        self.accessor.create_metric(bg_test_utils.make_metric("x.y"))
+        self.assertEqual(([], ["x"]), bg_gu.glob(self.accessor, "x", metadata_cache))
+        self.assertEqual(([], ["x"]), metadata_cache.glob("x"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import os
+from os import path as os_path
+import unittest
+
+from biggraphite import accessor as bg_accessor
+from biggraphite import test_utils as bg_test_utils
+from biggraphite.drivers import local as bg_local
+
+_METRIC = bg_test_utils.make_metric("test.metric", retention="60*1s:60*60s")
+
+# Points injected in the test DB, the first ones are expired by the retention.
+_POINTS_START = 3600 * 24 * 10
+_POINTS_END = _POINTS_START + 120
+_POINTS = [(t, v) for v, t in enumerate(xrange(_POINTS_START, _POINTS_END))]
+
+
+class TestLocalAccessor(bg_test_utils.TestCaseWithTempDir):
+
+    def setUp(self):
+        super(TestLocalAccessor, self).setUp()
+        self.accessor = bg_local.connect(self.tempdir)
+        self.accessor.connect()
+        self.addCleanup(self.accessor.shutdown)
+
+    def fetch(self, metric, time_start, time_end, stage=None):
+        stage = stage or metric.retention[0]
+        return list(self.accessor.fetch_points(metric, time_start, time_end, stage))
+
+    def test_create_get(self):
+        self.assertIsNone(self.accessor.get_metric(_METRIC.name))
+        self.accessor.create_metric(_METRIC)
+        metric = self.accessor.get_metric(_METRIC.name)
+        self.assertEqual(_METRIC.name, metric.name)
+        self.assertEqual(_METRIC.retention, metric.retention)
+
+    def test_insert_fetch(self):
+        self.accessor.create_metric(_METRIC)
+        self.accessor.insert_points(_METRIC, _POINTS)
+        # The downsampler keeps the last points in memory, the first ones are overwritten.
+        raw_capacity = bg_local._downsampling.Downsampler.CAPACITY
+        written_end = _POINTS_END - raw_capacity
+        expected = [(t, v) for t, v in _POINTS if _POINTS_START + 60 <= t < written_end]
+        self.assertEqual(expected, self.fetch(_METRIC, _POINTS_START + 60, _POINTS_END))
+        # Overwritten points are not returned.
+        self.assertEqual([], self.fetch(_METRIC, _POINTS_START, written_end - 60))
+
+        stage_1 = _METRIC.retention[1]
+        fetched = self.fetch(_METRIC, _POINTS_START, _POINTS_END, stage_1)
+        self.assertEqual([_POINTS_START, _POINTS_START + 60], [ts for ts, _ in fetched])
+
+    def test_fetch_empty(self):
+        self.accessor.create_metric(_METRIC)
+        self.assertEqual([], self.fetch(_METRIC, _POINTS_START, _POINTS_END))
+
+    def test_shared_between_accessors(self):
+        self.accessor.create_metric(_METRIC)
+        self.accessor.insert_points(_METRIC, _POINTS)
+        other = bg_local.connect(self.tempdir)
+        other.connect()
+        self.addCleanup(other.shutdown)
+        self.assertEqual(_METRIC.name, other.get_metric(_METRIC.name).name)
+        self.assertEqual(
+            self.fetch(_METRIC, _POINTS_START, _POINTS_END),
+            list(other.fetch_points(_METRIC, _POINTS_START, _POINTS_END, _METRIC.retention[0])),
+        )
+
+    def test_downsampler_checkpoint(self):
+        checkpoint = os_path.join(self.tempdir, "checkpoint")
+        self.accessor.shutdown()
+        self.accessor = bg_local.connect(self.tempdir, downsampler_checkpoint=checkpoint)
+        self.accessor.connect()
+        self.accessor.create_metric(_METRIC)
+        self.accessor.insert_points(_METRIC, _POINTS)
+        self.accessor.shutdown()
+        with open(checkpoint, "rb") as f:
+            saved = f.read()
+
+        # Accessors that only read neither load nor save it.
+        reader = bg_local.connect(self.tempdir, downsampler_checkpoint=checkpoint)
+        reader.connect()
+        self.assertNotEqual([], list(reader.fetch_points(
+            _METRIC, _POINTS_START, _POINTS_END, _METRIC.retention[0])))
+        os.remove(checkpoint)
+        reader.shutdown()
+        self.assertFalse(os_path.exists(checkpoint))
+        with open(checkpoint, "wb") as f:
+            f.write(saved)
+
+        # Buffered points survive the restart and get written once they expire.
+        self.accessor = bg_local.connect(self.tempdir, downsampler_checkpoint=checkpoint)
+        self.accessor.connect()
+        self.addCleanup(self.accessor.shutdown)
+        self.accessor.insert_points(_METRIC, [(_POINTS_END + 3600, 0)])
+        fetched = self.fetch(_METRIC, _POINTS_START + 60, _POINTS_END)
+        self.assertEqual(_POINTS[-1], fetched[-1])
+
+    def test_downsampler_max_idle(self):
+        self.accessor.shutdown()
+        self.accessor = bg_local.connect(self.tempdir, downsampler_max_idle=0)
+        self.accessor.connect()
+        self.addCleanup(self.accessor.shutdown)
+        other_metric = bg_test_utils.make_metric("test.other", _METRIC.metadata)
+        self.accessor.create_metric(_METRIC)
+        self.accessor.create_metric(other_metric)
+        self.accessor.insert_points(_METRIC, _POINTS)
+        self.assertNotEqual(_POINTS[-1], self.fetch(_METRIC, _POINTS_START, _POINTS_END)[-1])
+
+        # Points buffered for idle metrics are written by the next write.
+        self.accessor.insert_points(other_metric, _POINTS)
+        self.assertEqual(_POINTS[-1], self.fetch(_METRIC, _POINTS_START, _POINTS_END)[-1])
+
+    def test_retention_change(self):
+        self.accessor.create_metric(_METRIC)
+        self.accessor.insert_points(_METRIC, _POINTS)
+        fetched = self.fetch(_METRIC, _POINTS_START, _POINTS_END)
+        metric = bg_test_utils.make_metric(_METRIC.name, retention="120*1s")
+        # Reading with other metadata (e.g. stale) leaves points alone.
+        self.assertEqual([], self.fetch(metric, _POINTS_START, _POINTS_END))
+        other = bg_local.connect(self.tempdir)
+        other.connect()
+        self.addCleanup(other.shutdown)
+        self.assertEqual(
+            fetched,
+            list(other.fetch_points(_METRIC, _POINTS_START, _POINTS_END, _METRIC.retention[0])))
+
+        # Writing with the new retention resets the archive.
+        self.accessor.create_metric(metric)
+        self.accessor.insert_points(metric, _POINTS)
+        self.assertNotEqual([], self.fetch(metric, _POINTS_START, _POINTS_END))
+        self.assertEqual([], list(other.fetch_points(
+            _METRIC, _POINTS_START, _POINTS_END, _METRIC.retention[0])))
+
+    def test_glob(self):
+        for name in "a", "a.a", "a.b", "a.a.a", "x.y.z":
+            self.accessor.create_metric(bg_test_utils.make_metric(name))
+        self.assertEqual(["a.a"], self.accessor.glob_metric_names("a.a"))
+        self.assertEqual(["a"], self.accessor.glob_metric_names("*"))
+        self.assertEqual(["a.a", "a.b"], self.accessor.glob_metric_names("*.*"))
+        self.assertEqual(["a.a.a"], self.accessor.glob_metric_names("a.*.a"))
+        self.assertEqual(["a.a.a", "x.y.z"], self.accessor.glob_metric_names("*.*.*"))
+        self.assertEqual(["a", "x"], self.accessor.glob_directory_names("*"))
+        self.assertEqual(["a.a", "x.y"], self.accessor.glob_directory_names("*.*"))
+
+        self.accessor.drop_all_metrics()
+        self.assertEqual([], self.accessor.glob_metric_names("*"))
+        self.assertEqual([], self.accessor.glob_directory_names("*"))
+
+    def test_iter_all(self):
+        names = ["a", "a.b", "x.y.z"] + ["m%d" % n for n in xrange(bg_local._SCAN_BATCH_SIZE)]
+        for name in names:
+            self.accessor.create_metric(bg_test_utils.make_metric(name))
+        names.sort()
+
+        self.assertEqual(names, sorted(m.name for m in self.accessor.iter_all_metrics()))
+        self.assertEqual(["a", "x", "x.y"], sorted(self.accessor.iter_all_directories()))
+
+        found = []
+        for scan_range in self.accessor.scan_ranges(5):
+            found.extend(m.name for m in self.accessor.iter_all_metrics([scan_range]))
+        self.assertEqual(names, sorted(found))
+
+    def test_archive_path(self):
+        self.assertNotEqual(
+            self.accessor._archive_path("a/b.c"),
+            self.accessor._archive_path("a.b.c"),
+        )
+        self.assertNotEqual(
+            self.accessor._archive_path("a..b"),
+            self.accessor._archive_path("a.b"),
+        )
+
+    def test_invalid_stage(self):
+        self.accessor.create_metric(_METRIC)
+        self.accessor.insert_points(_METRIC, _POINTS)
+        stage = bg_accessor.Stage(points=10, precision=10)
+        self.assertEqual([], self.fetch(_METRIC, _POINTS_START, _POINTS_END, stage))
+        self.assertRaises(
+            bg_accessor.InvalidArgumentError, self.accessor.fetch_points,
+            _METRIC, _POINTS_START, _POINTS_END, _METRIC.retention[1], step=90)
+
+    def test_fetch_step(self):
+        self.accessor.create_metric(_METRIC)
+        self.accessor.insert_points(_METRIC, _POINTS)
+        stage_0 = _METRIC.retention[0]
+        fetched = list(self.accessor.fetch_points(
+            _METRIC, _POINTS_START + 60, _POINTS_END, stage_0, step=20))
+        self.assertEqual([_POINTS_START + 60, _POINTS_START + 80], [ts for ts, _ in fetched])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,8 +15,14 @@
 # limitations under the License.
 from __future__ import print_function
 
+import threading
+import time
 import unittest
 
+import mock
+
+from biggraphite import accessor as bg_accessor
+from biggraphite import metadata_cache as bg_metadata_cache
 from biggraphite import test_utils as bg_test_utils
 
 _TEST_METRIC = bg_test_utils.make_metric("a.b.c")
@@ -48,6 +54,216 @@ class TestGraphiteUtilsInternals(bg_test_utils.TestCaseWithFakeAccessor):
         hit += 1
         self._assert_hit_miss(hit, miss)
 
+    def test_front_cache(self):
+        """Check that metrics are read from lmdb only once."""
+        self.metadata_cache.create_metric(_TEST_METRIC)
+        first = self.metadata_cache.get_metric(_TEST_METRIC.name)
+        self.assertEqual(1, self.metadata_cache.front_hit_count)
+        self.assertEqual(0, self.metadata_cache.front_miss_count)
+
+        # Once reopened, it has to be read from disk first.
+        self.metadata_cache.close()
+        self.metadata_cache.open()
+        for _ in xrange(2):
+            second = self.metadata_cache.get_metric(_TEST_METRIC.name)
+            self.assertEqual(first.metadata.as_json(), second.metadata.as_json())
+        self.assertEqual(2, self.metadata_cache.front_hit_count)
+        self.assertEqual(1, self.metadata_cache.front_miss_count)
+        self._assert_hit_miss(3, 0)
+
+    def test_absent_cache(self):
+        """Check that absent metrics are cached until created."""
+        self.assertIsNone(self.metadata_cache.get_metric(_TEST_METRIC.name))
+        self.assertIsNone(self.metadata_cache.get_metric(_TEST_METRIC.name))
+        self._assert_hit_miss(1, 1)
+        self.assertEqual(1, self.metadata_cache.absent_hit_count)
+
+        # Creating the metric makes it visible right away.
+        self.metadata_cache.create_metric(_TEST_METRIC)
+        self.assertIsNotNone(self.metadata_cache.get_metric(_TEST_METRIC.name))
+        self._assert_hit_miss(2, 1)
+
+    def test_absent_cache_expiration(self):
+        # lmdb environments must not be opened twice by a process.
+        self.metadata_cache.close()
+        cache = bg_metadata_cache.DiskCache(self.accessor, self.tempdir, absent_ttl=0.01)
+        cache.open()
+        self.addCleanup(cache.close)
+        cache.get_metric(_TEST_METRIC.name)
+        # Created without going through the cache, so only visible once expired.
+        self.accessor.create_metric(_TEST_METRIC)
+        self.assertIsNone(cache.get_metric(_TEST_METRIC.name))
+        time.sleep(0.01)
+        self.assertIsNotNone(cache.get_metric(_TEST_METRIC.name))
+
+    def test_expiration(self):
+        self.metadata_cache.close()
+        cache = bg_metadata_cache.DiskCache(self.accessor, self.tempdir, ttl=0.1)
+        cache.open()
+        self.addCleanup(cache.close)
+        cache.create_metric(_TEST_METRIC)
+        # The metric is recreated with another aggregator, bypassing the cache.
+        metric = bg_test_utils.make_metric(
+            _TEST_METRIC.name, aggregator=bg_accessor.Aggregator.maximum)
+        self.accessor.create_metric(metric)
+        self.assertEqual(
+            _TEST_METRIC.metadata.aggregator, cache.get_metric(metric.name).metadata.aggregator)
+        time.sleep(0.1)
+        self.assertEqual(
+            bg_accessor.Aggregator.maximum, cache.get_metric(metric.name).metadata.aggregator)
+
+    def test_refresh(self):
+        self.metadata_cache.create_metric(_TEST_METRIC)
+        other_metric = bg_test_utils.make_metric("a.b.d")
+        self.metadata_cache.create_metric(other_metric)
+        self.assertEqual(0, self.metadata_cache.refresh(max_age=3600))
+        self.accessor.drop_all_metrics()
+        self.accessor.create_metric(other_metric)
+        self.assertEqual(2, self.metadata_cache.refresh(max_age=0, min_interval=3600))
+        # Another refresh started less than min_interval ago, possibly by another process.
+        self.assertEqual(0, self.metadata_cache.refresh(max_age=0, min_interval=3600))
+
+        # Deleted metrics are gone once reopened (which clears the in-memory cache).
+        self.metadata_cache.close()
+        self.metadata_cache.open()
+        self.assertIsNone(self.metadata_cache.get_metric(_TEST_METRIC.name))
+        self.assertIsNotNone(self.metadata_cache.get_metric(other_metric.name))
+        self._assert_hit_miss(1, 1)
+
+    def test_write_behind(self):
+        """Check that queued writes are readable before and after being committed."""
+        self.metadata_cache.close()
+        cache = bg_metadata_cache.DiskCache(self.accessor, self.tempdir, write_delay=3600)
+        cache.open()
+        cache.create_metric(_TEST_METRIC)
+        self.assertIsNone(cache.get_metric("a.b.absent"))
+        self.assertIsNotNone(cache.get_metric(_TEST_METRIC.name))
+        self.assertIsNone(cache.get_metric("a.b.absent"))
+        self.assertEqual(1, cache.absent_hit_count)
+
+        # close() commits queued writes.
+        cache.close()
+        misses = cache.miss_count
+        self.accessor.drop_all_metrics()
+        cache.open()
+        self.addCleanup(cache.close)
+        self.assertIsNotNone(cache.get_metric(_TEST_METRIC.name))
+        self.assertIsNone(cache.get_metric("a.b.absent"))
+        self.assertEqual(misses, cache.miss_count)
+
+    def test_glob_cache(self):
+        self.assertIsNone(self.metadata_cache.get_glob("a.*.c"))
+        self.metadata_cache.cache_glob("a.*.c", ["a.b.c"], ["a.d.c"])
+        self.metadata_cache.cache_glob("a.b.*", [], [])
+        self.metadata_cache.cache_glob("x.*", ["x.y"], [])
+        self.metadata_cache.close()
+        self.metadata_cache.open()
+        self.assertEqual((["a.b.c"], ["a.d.c"]), self.metadata_cache.get_glob("a.*.c"))
+        self.assertEqual(([], []), self.metadata_cache.get_glob("a.b.*"))
+
+        # Only globs that could match the created metric are removed.
+        self.metadata_cache.create_metric(bg_test_utils.make_metric("a.e.c"))
+        self.metadata_cache.flush()
+        self.assertIsNone(self.metadata_cache.get_glob("a.*.c"))
+        self.assertEqual(([], []), self.metadata_cache.get_glob("a.b.*"))
+        self.assertEqual((["x.y"], []), self.metadata_cache.get_glob("x.*"))
+
+    def test_glob_cache_expiration(self):
+        self.metadata_cache.close()
+        cache = bg_metadata_cache.DiskCache(
+            self.accessor, self.tempdir, glob_ttl=0.01, write_delay=0)
+        cache.open()
+        self.addCleanup(cache.close)
+        cache.cache_glob("a.*", ["a.b"], [])
+        time.sleep(0.01)
+        self.assertIsNone(cache.get_glob("a.*"))
+
+    def test_namespace_index(self):
+        self.metadata_cache.close()
+        cache = bg_metadata_cache.DiskCache(
+            self.accessor, self.tempdir, write_delay=0, index_max_age=3600)
+        cache.open()
+        self.addCleanup(cache.close)
+        names = ["a", "a.b.c", "a.b.d", "x.y.c", "a.a.a", "a.bb.c"]
+        metrics = [bg_test_utils.make_metric(name) for name in names]
+        self.assertIsNone(cache.glob("*"))
+        cache.fill(metrics[1:], complete=True)
+        cache.create_metric(metrics[0])
+
+        self.assertEqual((["a"], ["a", "x"]), cache.glob("*"))
+        self.assertEqual(([], ["a.b"]), cache.glob("a.b"))
+        self.assertEqual((["a.b.c", "a.bb.c", "x.y.c"], []), cache.glob("*.*.c"))
+        self.assertEqual((["a.b.c", "a.bb.c"], []), cache.glob("a.b*.c"))
+        self.assertEqual((["a.b.c", "a.b.d"], []), cache.glob("*.{b,c,d,5}.?"))
+        self.assertEqual((["a.a.a"], []), cache.glob("a.[a-a].*"))
+        # Names created since the scan may be missing, the accessor is used instead.
+        self.assertIsNone(cache.glob("b.*"))
+
+        # Metrics found missing by refresh() are removed with the directories they empty.
+        for metric in metrics[1:4]:
+            self.accessor.create_metric(metric)
+        cache.refresh(max_age=0)
+        self.assertEqual((["a.b.c", "a.b.d", "x.y.c"], []), cache.glob("*.*.*"))
+        self.assertEqual((["a"], ["a", "x"]), cache.glob("*"))
+        self.assertEqual(([], ["a.b"]), cache.glob("a.*"))
+
+        # A complete fill replaces the index.
+        cache.fill(metrics[:1], complete=True)
+        self.assertEqual((["a"], []), cache.glob("*"))
+
+    def test_namespace_index_expiration(self):
+        self.metadata_cache.close()
+        cache = bg_metadata_cache.DiskCache(self.accessor, self.tempdir, index_max_age=0.01)
+        cache.open()
+        self.addCleanup(cache.close)
+        cache.fill([_TEST_METRIC], complete=True)
+        self.assertEqual(([_TEST_METRIC.name], []), cache.glob(_TEST_METRIC.name))
+        time.sleep(0.01)
+        self.assertIsNone(cache.glob(_TEST_METRIC.name))
+
+    def test_get_metrics(self):
+        other_metric = bg_test_utils.make_metric("a.b.d")
+        self.accessor.create_metric(other_metric)
+        self.metadata_cache.create_metric(_TEST_METRIC)
+        names = [_TEST_METRIC.name, "a.b.absent", other_metric.name]
+        metrics = self.metadata_cache.get_metrics(names)
+        self.assertEqual([_TEST_METRIC.name, None, other_metric.name],
+                         [metric.name if metric else None for metric in metrics])
+        self._assert_hit_miss(1, 2)
+        # Now in memory, or known to be absent.
+        self.metadata_cache.get_metrics(names)
+        self._assert_hit_miss(4, 2)
+        self.assertEqual(1, self.metadata_cache.absent_hit_count)
+
+    def test_concurrent_lookups(self):
+        """Check that concurrent misses of a metric do a single lookup."""
+        self.accessor.create_metric(_TEST_METRIC)
+        get_metrics = self.accessor.get_metrics
+        started, proceed = threading.Event(), threading.Event()
+
+        def slow_get_metrics(metric_names):
+            started.set()
+            proceed.wait()
+            return get_metrics(metric_names)
+
+        results = []
+        with mock.patch.object(
+                self.accessor, "get_metrics", side_effect=slow_get_metrics) as mocked:
+            thread = threading.Thread(
+                target=lambda: results.append(self.metadata_cache.get_metric(_TEST_METRIC.name)))
+            thread.start()
+            started.wait()
+            # This one waits for the lookup of the first thread.
+            waiter = threading.Thread(
+                target=lambda: results.append(self.metadata_cache.get_metric(_TEST_METRIC.name)))
+            waiter.start()
+            proceed.set()
+            thread.join()
+            waiter.join()
+        self.assertEqual(1, mocked.call_count)
+        self.assertEqual(2, len(results))
+        self.assertTrue(all(result.name == _TEST_METRIC.name for result in results))
+
     def test_instance_cache(self):
         """Check that we do cache JSON instances."""
         self.metadata_cache.create_metric(_TEST_METRIC)
@@ -62,5 +278,25 @@ class TestGraphiteUtilsInternals(bg_test_utils.TestCaseWithFakeAccessor):
         self.metadata_cache.get_metric(metric_name)
 
 
+class TestSecondChanceCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = bg_metadata_cache._SecondChanceCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        # "a" was read, so "b" is evicted instead.
+        cache.put("c", 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_disabled(self):
+        cache = bg_metadata_cache._SecondChanceCache(0)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import math
+import random
+import unittest
+
+from biggraphite import sketches
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def assertAccurate(self, expected, actual):
+        self.assertAlmostEqual(expected, actual, delta=abs(expected) * 0.01)
+
+    def test_empty(self):
+        sketch = sketches.QuantileSketch()
+        self.assertEqual(0, sketch.count)
+        self.assertTrue(math.isnan(sketch.quantile(0.5)))
+
+    def test_quantile(self):
+        values = [random.uniform(-1000, 1000) for _ in xrange(1001)] + [0]
+        sketch = sketches.QuantileSketch()
+        for v in values:
+            sketch.add(v)
+        sketch.add(float("nan"))
+        self.assertEqual(len(values), sketch.count)
+
+        values.sort()
+        for q in 0, 0.1, 0.5, 0.9, 0.99, 1:
+            self.assertAccurate(values[int(q * (len(values) - 1))], sketch.quantile(q))
+
+    def test_infinities(self):
+        sketch = sketches.QuantileSketch()
+        for v in float("inf"), float("-inf"), 1:
+            sketch.add(v)
+        self.assertEqual(1, sketch.count)
+        self.assertAccurate(1, sketch.quantile(1))
+
+    def test_max_bins(self):
+        sketch = sketches.QuantileSketch()
+        # A bin per value, or almost.
+        values = [1.1 ** n for n in xrange(3001)]
+        for v in values:
+            sketch.add(v)
+        self.assertEqual(len(values), sketch.count)
+        self.assertEqual(sketches._MAX_BINS, len(sketch._positive_bins))
+        # Bins of the smallest absolute values are merged, the others stay accurate.
+        for q in 0.95, 1:
+            self.assertAccurate(values[int(q * (len(values) - 1))], sketch.quantile(q))
+        self.assertLess(sketch.quantile(0), values[len(values) / 2])
+
+        merged = sketches.QuantileSketch()
+        merged.merge(sketch)
+        merged.merge(sketch)
+        self.assertEqual(len(sketch.to_bytes()), len(merged.to_bytes()))
+
+    def test_merge(self):
+        merged, first, second = (sketches.QuantileSketch() for _ in xrange(3))
+        for v in xrange(100):
+            merged.add(v)
+            (first if v % 2 else second).add(v)
+        first.merge(second)
+        self.assertEqual(merged, first)
+        self.assertEqual(100, first.count)
+
+    def test_serialization(self):
+        sketch = sketches.QuantileSketch()
+        for v in -2.5, 0, 1, 1, 1e6:
+            sketch.add(v)
+        parsed = sketches.QuantileSketch.from_bytes(sketch.to_bytes())
+        self.assertEqual(sketch, parsed)
+        self.assertEqual(sketch.count, parsed.count)
+
+        self.assertRaises(
+            sketches.InvalidSketchError, sketches.QuantileSketch.from_bytes, b"")
+        self.assertRaises(
+            sketches.InvalidSketchError,
+            sketches.QuantileSketch.from_bytes, sketch.to_bytes()[:-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import unittest
+
+import mock
+
+from biggraphite.cli import upgrade_schema
+from biggraphite.drivers import cassandra as bg_cassandra
+
+
+class TestMain(unittest.TestCase):
+
+    def test_upgrades_datapoints_tables(self):
+        accessor = mock.Mock()
+        with mock.patch.object(bg_cassandra, "connect", return_value=accessor) as connect:
+            upgrade_schema.main([
+                "host1", "host2", "--keyspace", "ks",
+                "--compaction-strategy", bg_cassandra.TIME_WINDOW_COMPACTION,
+            ])
+        connect.assert_called_once_with(
+            keyspace="ks", contact_points=["host1", "host2"], port=9042,
+            compaction_strategy=bg_cassandra.TIME_WINDOW_COMPACTION)
+        accessor.connect.assert_called_once_with()
+        accessor.upgrade_datapoints_tables.assert_called_once_with()
+        accessor.shutdown.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    unittest.main()
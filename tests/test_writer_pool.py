@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Copyright 2016 Criteo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+from os import path as os_path
+import unittest
+
+import mock
+
+from biggraphite import accessor as bg_accessor
+from biggraphite import test_utils as bg_test_utils
+from biggraphite import writer_pool as bg_writer_pool
+from biggraphite.drivers import local as bg_local
+
+
+class TestRing(unittest.TestCase):
+
+    def test_wrap_around(self):
+        ring = bg_writer_pool._Ring(3)
+        self.assertIsNone(ring.get(timeout=0))
+        ring.put([1, 2], [10, 20], [0.5, 1.5])
+        self.assertEqual(([1, 2], [10, 20], [0.5, 1.5]), ring.get(timeout=0))
+        ring.put([3, 4, 5], [30, 40, 50], [2.5, 3.5, 4.5])
+        self.assertEqual(([3, 4, 5], [30, 40, 50], [2.5, 3.5, 4.5]), ring.get(timeout=0))
+        self.assertIsNone(ring.get(timeout=0))
+
+    def test_consumer_exited(self):
+        ring = bg_writer_pool._Ring(1)
+        consumer = mock.Mock()
+        consumer.is_alive.return_value = False
+        ring.put([1], [10], [0.5], consumer)
+        self.assertRaises(bg_writer_pool.WriterError, ring.put, [2], [20], [1.5], consumer)
+
+
+class TestWriterPool(bg_test_utils.TestCaseWithTempDir):
+
+    def _make_accessor(self, writer_index):
+        checkpoint = os_path.join(self.tempdir, "checkpoint.%d" % writer_index)
+        return bg_local.connect(self.tempdir, downsampler_checkpoint=checkpoint)
+
+    def test_invalid_processes(self):
+        self.assertRaises(
+            bg_accessor.InvalidArgumentError,
+            bg_writer_pool.WriterPool, self._make_accessor, 0)
+
+    def test_insert_points_batch(self):
+        pool = bg_writer_pool.WriterPool(self._make_accessor, 2, ring_capacity=10)
+        pool.start()
+        accessor = bg_local.connect(self.tempdir)
+        accessor.connect()
+        self.addCleanup(accessor.shutdown)
+        metrics = [bg_test_utils.make_metric("test.metric%d" % n) for n in xrange(4)]
+        for metric in metrics:
+            accessor.create_metric(metric)
+
+        # More points than rings hold, so that writers have to keep up.
+        points = [(ts, float(ts)) for ts in xrange(1000, 1040)]
+        pool.insert_points_batch([(metric, points) for metric in metrics])
+        pool.stop()
+
+        # Writers handled all the points they were given once stopped. The downsampler
+        # keeps the last ones in memory, see test_local.
+        written = points[:-bg_local._downsampling.Downsampler.CAPACITY]
+        stage = metrics[0].retention[0]
+        for metric in metrics:
+            self.assertEqual(written, list(accessor.fetch_points(metric, 1000, 1040, stage)))
+
+    def test_writer_exception(self):
+        def make_accessor(writer_index):
+            raise ValueError("no accessor")
+
+        on_error = mock.Mock()
+        pool = bg_writer_pool.WriterPool(make_accessor, 1, on_error=on_error, ring_capacity=10)
+        pool.start()
+        self.addCleanup(pool.stop)
+        metric = bg_test_utils.make_metric("test.metric")
+        points = [(ts, float(ts)) for ts in xrange(1000, 1040)]
+        # Rather than waiting forever for the writer to read points.
+        self.assertRaises(
+            bg_writer_pool.WriterError, pool.insert_points_batch, [(metric, points)])
+        pool.stop()
+        exception, = on_error.call_args[0]
+        self.assertIsInstance(exception, bg_writer_pool.WriterError)
+        self.assertIn("no accessor", str(exception))
+
+
+if __name__ == "__main__":
+    unittest.main()